@@ -1,6 +1,15 @@
 from django.contrib import admin
 
-from .models import API, Application, Category, Endpoint, User
+from .models import (
+    API,
+    Application,
+    Category,
+    Endpoint,
+    QuotaPlan,
+    QuotaUsage,
+    User,
+)
+from .proxy.responses import responses
 
 
 @admin.register(Application)
@@ -11,7 +20,10 @@ class ApplicationAdmin(admin.ModelAdmin):
         "name",
         "ip",
         "image",
-        "requests_limit",
+        "plan",
+        "rate_limit",
+        "rate_period",
+        "rate_burst",
         "description",
         "token",
     )
@@ -26,6 +38,32 @@ class APIAdmin(admin.ModelAdmin):
     filter_horizontal = ("endpoints",)
 
 
+@admin.register(Endpoint)
+class EndpointAdmin(admin.ModelAdmin):
+    list_display = ("url", "name", "method", "cache_ttl", "cache_stats")
+    readonly_fields = ("cache_stats",)
+
+    @admin.display(description="Cache hits / misses (this worker)")
+    def cache_stats(self, obj):
+        if obj.pk is None:
+            return "-"
+        stats = responses.endpoint_stats(obj.pk)
+        return f'{stats["hits"]} / {stats["misses"]}'
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context["title"] = "Endpoints (response cache: {})".format(
+            ", ".join(f"{k} {v}" for k, v in responses.stats().items())
+        )
+        return super().changelist_view(request, extra_context)
+
+
+@admin.register(QuotaUsage)
+class QuotaUsageAdmin(admin.ModelAdmin):
+    list_display = ("kind", "account_id", "period", "window", "count")
+    list_filter = ("kind", "period")
+
+
 admin.site.register(User)
 admin.site.register(Category)
-admin.site.register(Endpoint)
+admin.site.register(QuotaPlan)
@@ -0,0 +1,50 @@
+from rest_framework.authentication import (
+    BaseAuthentication,
+    get_authorization_header,
+)
+from rest_framework.exceptions import AuthenticationFailed
+
+from account.proxy import cache, service
+
+
+class ApplicationTokenAuthentication(BaseAuthentication):
+    """
+    ``Authorization: Token <application token>`` for the use-api routes.
+    The token resolves to its application and the application's owner
+    through the in-process lookup caches, so no session is loaded and no
+    CSRF check runs. Requests without the header fall through to the
+    next authentication class.
+    """
+
+    keyword = "Token"
+
+    def authenticate(self, request):
+        header = get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise AuthenticationFailed("Invalid token header.")
+        try:
+            token = header[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed("Invalid token header.")
+        return authenticate_token(token)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+def authenticate_token(token):
+    """``(OwnerRecord, ApplicationRecord)`` of ``token``."""
+    application = service.application_record(token)
+    owner = application and service.owner_record(application.owner_id)
+    if not owner or not owner.is_active:
+        raise AuthenticationFailed("Invalid token.")
+    return owner, application
+
+
+def header_token(request):
+    """The token a request authenticated with, None for other schemes."""
+    if isinstance(request.auth, cache.ApplicationRecord):
+        return request.auth.token
+    return None
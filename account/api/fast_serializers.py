@@ -0,0 +1,136 @@
+"""
+Read-only fast paths for list endpoints. They build the same output as
+``APIListSerializer`` and ``ApplicationSerializer`` from ``values_list``
+rows and one query for all endpoints of a page, without instantiating
+models or going through DRF field machinery.
+"""
+from django.conf import settings
+from rest_framework import serializers
+
+from account import models
+
+API_FIELDS = (
+    "pk",
+    "owner_id",
+    "owner__email",
+    "category_id",
+    "category__name",
+    "name",
+    "short_description",
+    "base_url",
+    "image",
+    "is_public",
+)
+APPLICATION_FIELDS = (
+    "pk",
+    "ip",
+    "name",
+    "description",
+    "image",
+    "token",
+    "created_on",
+)
+ENDPOINT_FIELDS = (
+    "api_id",
+    "endpoint__url",
+    "endpoint__name",
+    "endpoint__description",
+    "endpoint__method",
+)
+
+METHODS = dict(models.EndpointChoices.choices)
+
+# SQLite allows 999 parameters per query
+CHUNK_SIZE = 900
+
+
+def _chunks(items):
+    for start in range(0, len(items), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        yield items[start:end]
+
+
+def _storage(model):
+    return model._meta.get_field("image").storage
+
+
+def api_rows(queryset):
+    return queryset.prefetch_related(None).values_list(*API_FIELDS)
+
+
+def application_rows(queryset):
+    return queryset.values_list(*APPLICATION_FIELDS)
+
+
+def endpoints_by_api(pks):
+    endpoints = {}
+    through = models.API.endpoints.through.objects
+    for chunk in _chunks(pks):
+        rows = through.filter(api_id__in=chunk).order_by("endpoint_id")
+        for api_pk, url, name, description, method in rows.values_list(
+            *ENDPOINT_FIELDS
+        ):
+            endpoints.setdefault(api_pk, []).append(
+                {
+                    "url": url,
+                    "name": name,
+                    "description": description,
+                    "get_method_display": METHODS.get(method, str(method)),
+                }
+            )
+    return endpoints
+
+
+def api_list(rows):
+    """``APIListSerializer(many=True).data`` for ``api_rows`` output."""
+    rows = list(rows)
+    endpoints = endpoints_by_api([row[0] for row in rows])
+    storage = _storage(models.API)
+    return [
+        {
+            "id": pk,
+            "owner": {"id": owner_pk, "email": email},
+            "category": {"id": category_pk, "name": category},
+            "name": name,
+            "short_description": short_description,
+            "base_url": base_url,
+            "image_url": (
+                f"{settings.HOST}{storage.url(image)}" if image else None
+            ),
+            "is_public": is_public,
+            "endpoints": endpoints.get(pk, []),
+        }
+        for (
+            pk,
+            owner_pk,
+            email,
+            category_pk,
+            category,
+            name,
+            short_description,
+            base_url,
+            image,
+            is_public,
+        ) in rows
+    ]
+
+
+def application_list(rows):
+    """``ApplicationSerializer(many=True).data`` for ``application_rows``."""
+    storage = _storage(models.Application)
+    created_on = serializers.DateTimeField()
+    return [
+        {
+            "ip": ip,
+            "name": name,
+            "description": description,
+            "image_url": (
+                f"{settings.HOST}{settings.MEDIA_URL}{storage.url(image)}"
+                if image
+                else None
+            ),
+            "token": token,
+            "created_on": created_on.to_representation(created),
+        }
+        for _, ip, name, description, image, token, created in rows
+    ]
@@ -0,0 +1,172 @@
+import base64
+import binascii
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+EXACT = "exact"
+APPROXIMATE = "approximate"
+NONE = "none"
+
+
+def _position(row):
+    # Model instances or values_list rows starting with the pk
+    return row.pk if hasattr(row, "pk") else row[0]
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination, used once the request passes ``cursor`` (empty for
+    the first page). Querysets are walked in primary key order and the
+    cursor holds the last pk seen, so a deep page costs the same as the
+    first one. Ranked lists are walked by their ranking key instead.
+
+    No total is counted unless ``count`` asks for one: ``exact`` runs
+    COUNT(*), ``approximate`` counts at most ``approximate_count_cap``
+    rows and flags larger totals with ``count_is_exact: false``. Ranked
+    lists count their length, flagged the same way when they were cut
+    short.
+
+    Requests without ``cursor`` go to ``fallback_class``, or are not
+    paginated at all when there is none.
+    """
+
+    page_size = 10
+    page_size_query_param = "limit"
+    max_page_size = 20
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    approximate_count_cap = 1000
+    fallback_class = None
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self):
+        self.fallback = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return self._paginate_fallback(queryset, request, view)
+        self._start(request)
+        if self.reverse:
+            rows = queryset.order_by("-pk")
+            if self.position is not None:
+                rows = rows.filter(pk__lt=self.position)
+        else:
+            rows = queryset.order_by("pk")
+            if self.position is not None:
+                rows = rows.filter(pk__gt=self.position)
+        self._finish(list(rows[: self.size + 1]), _position)
+        self.count, self.count_is_exact = self._count(queryset)
+        return self.page
+
+    def paginate_ranked(self, items, key, request, view=None, complete=True):
+        """
+        Page through ``items`` sorted ascending by ``key(item)``, a tuple
+        of numbers such as ``(-score, pk)``. ``complete`` is False when
+        ``items`` leaves out matches.
+        """
+        if self.cursor_query_param not in request.query_params:
+            return None
+        self._start(request)
+        self.count, self.count_is_exact = (
+            (None, None) if self.count_mode == NONE else (len(items), complete)
+        )
+        if self.position is not None:
+            position = tuple(self.position)
+            if self.reverse:
+                items = [item for item in items if key(item) < position]
+            else:
+                items = [item for item in items if key(item) > position]
+        if self.reverse:
+            items = items[::-1]
+        self._finish(items[: self.size + 1], key)
+        return self.page
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        body = {"next": self.next_link, "previous": self.previous_link}
+        if self.count_is_exact is not None:
+            body["count"] = self.count
+            body["count_is_exact"] = self.count_is_exact
+        body["results"] = data
+        return Response(body)
+
+    def _paginate_fallback(self, queryset, request, view):
+        if self.fallback_class is None:
+            return None
+        self.fallback = self.fallback_class()
+        return self.fallback.paginate_queryset(queryset, request, view)
+
+    def _start(self, request):
+        self.request = request
+        self.size = self._page_size(request)
+        self.count_mode = request.query_params.get(
+            self.count_query_param, NONE
+        )
+        self.reverse, self.position = self._decode(
+            request.query_params[self.cursor_query_param]
+        )
+
+    def _finish(self, rows, position):
+        has_more = len(rows) > self.size
+        rows = rows[: self.size]
+        if self.reverse:
+            rows.reverse()
+        self.page = rows
+        has_next = has_more if not self.reverse else True
+        has_previous = has_more if self.reverse else self.position is not None
+        self.next_link = (
+            self._link(False, position(rows[-1]))
+            if rows and has_next
+            else None
+        )
+        self.previous_link = (
+            self._link(True, position(rows[0]))
+            if rows and has_previous
+            else None
+        )
+
+    def _count(self, queryset):
+        if self.count_mode == EXACT:
+            return queryset.count(), True
+        if self.count_mode == APPROXIMATE:
+            cap = self.approximate_count_cap
+            count = queryset.order_by()[: cap + 1].count()
+            return min(count, cap), count <= cap
+        return None, None
+
+    def _page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def _link(self, reverse, position):
+        if isinstance(position, (list, tuple)):
+            position = ",".join(str(part) for part in position)
+        token = base64.urlsafe_b64encode(
+            f"{'p' if reverse else 'n'}:{position}".encode()
+        ).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, token
+        )
+
+    def _decode(self, token):
+        if not token:
+            return False, None
+        try:
+            direction, position = (
+                base64.urlsafe_b64decode(token.encode()).decode().split(":")
+            )
+            parts = [float(part) for part in position.split(",")]
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if direction not in ("n", "p"):
+            raise NotFound(self.invalid_cursor_message)
+        if len(parts) == 1:
+            return direction == "p", int(parts[0])
+        return direction == "p", parts
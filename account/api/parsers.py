@@ -0,0 +1,16 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from account import openapi
+
+
+class YAMLDocumentParser(BaseParser):
+    """OpenAPI documents posted as YAML, parsed with PyYAML."""
+
+    media_type = "application/yaml"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return openapi.load(stream.read().decode())
+        except (openapi.InvalidDocument, UnicodeError) as exc:
+            raise ParseError(str(exc))
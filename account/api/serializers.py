@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 from account import models
@@ -12,6 +13,47 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
 
+# Bulk write helpers
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    ``many=True`` writes in one ``bulk_create``, or one ``bulk_update`` of
+    the instances passed in the order of the items.
+    """
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        return model.objects.bulk_create(
+            model(**attrs) for attrs in validated_data
+        )
+
+    def update(self, instances, validated_data):
+        fields = set()
+        for instance, attrs in zip(instances, validated_data):
+            for field, value in attrs.items():
+                setattr(instance, field, value)
+            fields.update(attrs)
+        if fields:
+            self.child.Meta.model.objects.bulk_update(instances, fields)
+        return instances
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Resolves every item's key from one query over the whole queryset,
+    shared through the serializer context, instead of a query per item.
+    """
+
+    def to_internal_value(self, data):
+        loaded = self.context.setdefault("related", {})
+        if self.field_name not in loaded:
+            loaded[self.field_name] = self.get_queryset().in_bulk()
+        try:
+            return loaded[self.field_name][int(data)]
+        except (KeyError, TypeError, ValueError):
+            # Fails the way the plain field does
+            return super().to_internal_value(data)
+
+
 # Application serializers
 class ApplicationSerializer(serializers.ModelSerializer):
     class Meta:
@@ -26,6 +68,22 @@ class ApplicationSerializer(serializers.ModelSerializer):
         )
 
 
+class ApplicationBulkSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Application
+        fields = (
+            "id",
+            "ip",
+            "name",
+            "description",
+            "image_url",
+            "token",
+            "created_on",
+        )
+        read_only_fields = ("token",)
+        list_serializer_class = BulkListSerializer
+
+
 class ApplicationDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Application
@@ -73,9 +131,39 @@ class APISerializer(serializers.ModelSerializer):
             "terms_of_use",
             "base_url",
             "is_public",
+            "connect_timeout",
+            "read_timeout",
+            "rate_limit",
+            "rate_period",
+            "rate_burst",
         )
 
 
+class APIBulkSerializer(serializers.ModelSerializer):
+    category = BulkPrimaryKeyRelatedField(
+        queryset=models.Category.objects.all()
+    )
+
+    class Meta:
+        model = models.API
+        fields = (
+            "id",
+            "category",
+            "name",
+            "short_description",
+            "long_description",
+            "terms_of_use",
+            "base_url",
+            "is_public",
+            "connect_timeout",
+            "read_timeout",
+            "rate_limit",
+            "rate_period",
+            "rate_burst",
+        )
+        list_serializer_class = BulkListSerializer
+
+
 class APIDetailSerializer(serializers.ModelSerializer):
     endpoints = EndpointsSerializer(many=True)
     category = CategorySerializer()
@@ -165,3 +253,22 @@ class EndpointSerializer(serializers.ModelSerializer):
 # Token for API
 class TokenSerializer(serializers.Serializer):
     token = serializers.CharField(max_length=255)
+
+
+class BatchCallSerializer(serializers.Serializer):
+    api_pk = serializers.IntegerField()
+    endpoint_pk = serializers.IntegerField()
+
+
+class BatchSerializer(serializers.Serializer):
+    # Optional when the Authorization header carries the token
+    token = serializers.CharField(max_length=255, required=False)
+    calls = BatchCallSerializer(many=True, allow_empty=False)
+
+    def validate_calls(self, value):
+        limit = settings.PROXY_BATCH["MAX_CALLS"]
+        if len(value) > limit:
+            raise serializers.ValidationError(
+                f"Ensure this field has no more than {limit} elements."
+            )
+        return value
@@ -3,7 +3,6 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-
     # Application urls
     path(
         "developer/app-list",
@@ -15,12 +14,16 @@ urlpatterns = [
         views.ApplicationCreateAPIView.as_view(),
         name="app-create",
     ),
+    path(
+        "developer/app/bulk",
+        views.ApplicationBulkAPIView.as_view(),
+        name="app-bulk",
+    ),
     path(
         "developer/app/<int:pk>",
         views.ApplicationDetailAPIView.as_view(),
         name="app-detail",
     ),
-
     # API urls
     path(
         "developer/app/<int:pk>/api-list",
@@ -32,6 +35,11 @@ urlpatterns = [
         views.APICreateAPIView.as_view(),
         name="api-create",
     ),
+    path(
+        "developer/app/<int:pk>/api/bulk",
+        views.APIBulkAPIView.as_view(),
+        name="api-bulk",
+    ),
     path(
         "developer/app/<int:app_pk>/api/<int:api_pk>",
         views.APIDetailAPIView.as_view(
@@ -44,13 +52,22 @@ urlpatterns = [
         ),
         name="api-detail",
     ),
-
+    path(
+        "developer/api/<int:pk>/health",
+        views.APIHealthAPIView.as_view(),
+        name="api-health",
+    ),
     # Endpoint urls
     path(
         "developer/api/<int:pk>/endpoints",
         views.EndpointListCreateAPIView.as_view(),
         name="endpoint-list",
     ),
+    path(
+        "developer/api/<int:pk>/endpoints/import",
+        views.EndpointImportAPIView.as_view(),
+        name="endpoint-import",
+    ),
     path(
         "developer/api/<int:api_pk>/endpoint/<int:endpoint_pk>",
         views.EndpointDetailApiView.as_view(
@@ -63,12 +80,21 @@ urlpatterns = [
         ),
         name="endpoint-detail",
     ),
-
     # Users urls
     path(
         "use-api/<int:api_pk>/endpoint/<int:endpoint_pk>",
         views.APIUseGenericAPIView.as_view(),
         name="use-api",
     ),
+    path(
+        "use-api/batch",
+        views.APIBatchUseGenericAPIView.as_view(),
+        name="use-api-batch",
+    ),
+    path(
+        "use-api-async/<int:api_pk>/endpoint/<int:endpoint_pk>",
+        views.api_use_async_view,
+        name="use-api-async",
+    ),
     path("search/", views.SearchAPIView.as_view(), name="search-list"),
 ]
@@ -0,0 +1,59 @@
+"""
+Session users cached next to the sessions, in the ``SESSION_CACHE_ALIAS``
+cache shared by the workers on the host, whichever backend logged them
+in. Cached users are held to the same session checks as loaded ones,
+see ``session_user``. The ``User`` signals drop an
+entry whenever the user is saved or deleted, so password changes and
+deactivations take effect on the next request. Keys carry the database
+name, so a test run never reads users cached by a server on the host.
+"""
+from django.conf import settings
+from django.contrib import auth
+from django.core.cache import caches
+from django.db import connection
+from django.utils.crypto import constant_time_compare
+
+
+def user_cache():
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def user_key(pk):
+    return f"user:{connection.settings_dict['NAME']}:{pk}"
+
+
+def get_user(pk):
+    return user_cache().get(user_key(pk))
+
+
+def cache_user(user):
+    user_cache().set(user_key(user.pk), user)
+
+
+def forget_user(pk):
+    user_cache().delete(user_key(pk))
+
+
+def session_user(request):
+    """``django.contrib.auth.get_user`` served from the cache when it can."""
+    from django.contrib.auth.models import AnonymousUser
+
+    session = request.session
+    try:
+        user = get_user(auth._get_user_session_key(request))
+        backend_path = session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        user = None
+    if user is None or backend_path not in settings.AUTHENTICATION_BACKENDS:
+        user = auth.get_user(request)
+        if user.is_authenticated:
+            cache_user(user)
+        return user
+    session_hash = session.get(auth.HASH_SESSION_KEY)
+    if not (
+        session_hash
+        and constant_time_compare(session_hash, user.get_session_auth_hash())
+    ):
+        session.flush()
+        return AnonymousUser()
+    return user
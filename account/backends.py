@@ -0,0 +1,13 @@
+from django.contrib.auth.backends import ModelBackend
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    Resolves the sessions that logged in through it. Session users are
+    cached by ``CachedAuthenticationMiddleware`` whatever their backend,
+    so logins go through ``ModelBackend`` alone and a wrong password is
+    only hashed once.
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
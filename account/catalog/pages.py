@@ -0,0 +1,71 @@
+"""
+Rendered catalog pages keyed by the catalog version and the normalized
+query string. Any change to what the pages show bumps the version, so
+stale pages are never served by this process; ``TTL`` bounds how long
+other processes may serve pages made stale elsewhere.
+"""
+import hashlib
+import itertools
+import threading
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+from account.proxy.cache import LRUCache
+
+CachedPage = namedtuple("CachedPage", ("etag", "content_type", "body"))
+
+
+class CatalogVersion:
+    def __init__(self):
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self.value = next(self._counter)
+
+    def bump(self):
+        with self._lock:
+            self.value = next(self._counter)
+
+
+def page_key(request):
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    return (version.value, request.accepted_media_type, query)
+
+
+def lookup(key):
+    return pages.get(key)
+
+
+def store(request, key, body):
+    content_type = request.accepted_media_type
+    if request.accepted_renderer.charset:
+        content_type += f"; charset={request.accepted_renderer.charset}"
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    cached = CachedPage(etag, content_type, body)
+    pages.set(key, cached)
+    return cached
+
+
+def page_response(request, cached, hit):
+    response = HttpResponse(cached.body, content_type=cached.content_type)
+    response["ETag"] = cached.etag
+    response["X-Cache"] = "HIT" if hit else "MISS"
+    return get_conditional_response(
+        request, etag=cached.etag, response=response
+    )
+
+
+def invalidate():
+    version.bump()
+
+
+version = CatalogVersion()
+pages = LRUCache(
+    settings.CATALOG_PAGE_CACHE["MAX_ENTRIES"],
+    settings.CATALOG_PAGE_CACHE["TTL"],
+    max_bytes=settings.CATALOG_PAGE_CACHE["MAX_BYTES"],
+    sizeof=lambda cached: len(cached.body),
+)
@@ -0,0 +1,386 @@
+"""
+In-process full-text index over the API catalog.
+
+Every API is indexed under its name, descriptions, category name and
+endpoint names, with the fields weighted by ``FIELD_WEIGHTS``. Queries
+match every word as a prefix and rank hits with BM25, so a lookup costs
+the size of the matching posting lists rather than a scan of the table.
+
+Like the proxy routing table the index is loaded on first use, patched
+from model signals and reloaded every ``REFRESH_INTERVAL`` to pick up
+changes made by other processes. The reload runs in a background thread
+while searches keep reading the current index, patches made meanwhile
+are replayed on the new one. Patches are applied to a copy that then
+replaces the index, so searches read a snapshot without taking a lock.
+
+At most ``MAX_RESULTS`` hits are ranked, searches matching more APIs say
+so with ``truncated``.
+"""
+import bisect
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+
+FIELD_WEIGHTS = (
+    ("name", 4.0),
+    ("category", 2.0),
+    ("endpoints", 1.5),
+    ("short_description", 1.0),
+    ("long_description", 0.5),
+)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+Document = namedtuple(
+    "Document", ("category_id", "endpoint_ids", "length", "frequencies")
+)
+Hit = namedtuple("Hit", ("pk", "score"))
+Hits = namedtuple("Hits", ("hits", "truncated"))
+
+
+def search_settings():
+    return settings.CATALOG_SEARCH
+
+
+def words(text):
+    return WORD.findall(text.lower()) if text else []
+
+
+def prefix_matches(prefix):
+    """Whether the query word ``prefix`` matches words it starts."""
+    return len(prefix) >= search_settings()["MIN_PREFIX_LENGTH"]
+
+
+def _document(category_id, endpoint_ids, fields):
+    frequencies = {}
+    for name, weight in FIELD_WEIGHTS:
+        for word, count in Counter(words(fields.get(name))).items():
+            frequencies[word] = frequencies.get(word, 0) + count * weight
+    return Document(
+        category_id,
+        frozenset(endpoint_ids),
+        sum(frequencies.values()),
+        frequencies,
+    )
+
+
+def load_documents(**filters):
+    from account.models import API
+
+    apis = API.objects.filter(**filters)
+    endpoints = {}
+    rows = API.endpoints.through.objects.filter(
+        **{f"api__{key}": value for key, value in filters.items()}
+    ).values_list("api_id", "endpoint_id", "endpoint__name")
+    for api_pk, endpoint_pk, name in rows.iterator():
+        endpoints.setdefault(api_pk, []).append((endpoint_pk, name))
+
+    rows = apis.values_list(
+        "pk",
+        "category_id",
+        "name",
+        "category__name",
+        "short_description",
+        "long_description",
+    )
+    for pk, category_id, name, category, short, long in rows.iterator():
+        linked = endpoints.get(pk, ())
+        yield pk, _document(
+            category_id,
+            (endpoint_pk for endpoint_pk, _ in linked),
+            {
+                "name": name,
+                "category": category,
+                "endpoints": " ".join(name for _, name in linked),
+                "short_description": short,
+                "long_description": long,
+            },
+        )
+
+
+class InvertedIndex:
+    """Postings are ``{word: {pk: weighted term frequency}}``."""
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = {}
+        self.total_length = 0.0
+        # Sorted, may hold words whose postings are gone
+        self.vocabulary = []
+        # Words whose postings belong to the index this was copied from
+        self._shared = set()
+
+    def copy(self):
+        """
+        A copy to patch, sharing the postings of every word until it
+        changes them.
+        """
+        index = InvertedIndex()
+        index.documents = dict(self.documents)
+        index.postings = dict(self.postings)
+        index.total_length = self.total_length
+        index.vocabulary = list(self.vocabulary)
+        index._shared = set(self.postings)
+        return index
+
+    def _own(self, word):
+        """The postings of ``word``, copied first if they are shared."""
+        postings = self.postings[word]
+        if word in self._shared:
+            self._shared.discard(word)
+            postings = self.postings[word] = dict(postings)
+        return postings
+
+    def add(self, pk, document, keep_sorted=True):
+        self.remove(pk)
+        self.documents[pk] = document
+        self.total_length += document.length
+        for word, frequency in document.frequencies.items():
+            if word in self.postings:
+                postings = self._own(word)
+            else:
+                postings = self.postings[word] = {}
+                if keep_sorted:
+                    self._insert_word(word)
+            postings[pk] = frequency
+
+    def _insert_word(self, word):
+        position = bisect.bisect_left(self.vocabulary, word)
+        vocabulary = self.vocabulary
+        if position == len(vocabulary) or vocabulary[position] != word:
+            vocabulary.insert(position, word)
+
+    def remove(self, pk):
+        document = self.documents.pop(pk, None)
+        if document is None:
+            return
+        self.total_length -= document.length
+        for word in document.frequencies:
+            postings = self._own(word)
+            del postings[pk]
+            if not postings:
+                del self.postings[word]
+
+    def expand(self, prefix, limit):
+        """
+        Indexed words starting with ``prefix``, the exact word first.
+        Words shorter than ``MIN_PREFIX_LENGTH`` only match exactly.
+        """
+        expanded = [prefix] if prefix in self.postings else []
+        if not prefix_matches(prefix):
+            return expanded
+        position = bisect.bisect_right(self.vocabulary, prefix)
+        for word in self.vocabulary[position:]:
+            if len(expanded) >= limit or not word.startswith(prefix):
+                break
+            if word in self.postings:
+                expanded.append(word)
+        return expanded
+
+    def search(self, query, limit, expansions, category_id=None):
+        """The best ``limit`` hits, as ``Hits``."""
+        terms = [self.expand(prefix, expansions) for prefix in words(query)]
+        if not terms or not all(terms):
+            return Hits([], False)
+        # Every query word has to match, start from the rarest one
+        terms.sort(key=lambda group: sum(len(self.postings[w]) for w in group))
+        candidates = None
+        for group in terms:
+            matched = set()
+            for word in group:
+                postings = self.postings[word]
+                if candidates is None:
+                    matched.update(postings)
+                else:
+                    matched.update(pk for pk in candidates if pk in postings)
+            candidates = matched
+            if not candidates:
+                return Hits([], False)
+        if category_id is not None:
+            candidates = {
+                pk
+                for pk in candidates
+                if self.documents[pk].category_id == category_id
+            }
+
+        count = len(self.documents)
+        average = self.total_length / count
+        scores = dict.fromkeys(candidates, 0.0)
+        for group in terms:
+            for word in group:
+                postings = self.postings[word]
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for pk in candidates:
+                    frequency = postings.get(pk)
+                    if frequency:
+                        length = self.documents[pk].length
+                        scores[pk] += (
+                            idf
+                            * frequency
+                            * (K1 + 1)
+                            / (frequency + K1 * (1 - B + B * length / average))
+                        )
+        hits = [
+            Hit(pk, round(score, 4))
+            for pk, score in heapq.nlargest(
+                limit, scores.items(), key=lambda item: (item[1], -item[0])
+            )
+        ]
+        return Hits(hits, len(scores) > limit)
+
+
+class CatalogSearch:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self._index = None
+        # Patches since the running rebuild started its query, if any
+        self._patches = None
+        self._refreshing = False
+        # Serializes the writers, readers use whichever index is current
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def search(self, query, category_id=None):
+        conf = search_settings()
+        return self._current().search(
+            query,
+            conf["MAX_RESULTS"],
+            conf["MAX_PREFIX_EXPANSIONS"],
+            category_id,
+        )
+
+    def rebuild(self):
+        with self._load_lock:
+            if self._index is not None and not self._expired():
+                return self._index
+            with self._lock:
+                self._patches = []
+            try:
+                index = InvertedIndex()
+                for pk, document in load_documents():
+                    index.add(pk, document, keep_sorted=False)
+                index.vocabulary = sorted(index.postings)
+                with self._lock:
+                    for apply in self._patches:
+                        apply(index)
+                    self._index = index
+                    self.loaded_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._patches = None
+            return index
+
+    def reindex(self, **filters):
+        if self._index is None and self._patches is None:
+            return
+        documents = list(load_documents(**filters))
+
+        def apply(index):
+            for pk, document in documents:
+                index.add(pk, document)
+
+        self._patch(apply)
+
+    def reindex_endpoint(self, pk):
+        """Reindex APIs that link, or until now linked, endpoint ``pk``."""
+        index = self._index
+        if index is None and self._patches is None:
+            return
+        linked = [
+            api_pk
+            for api_pk, document in (index.documents if index else {}).items()
+            if pk in document.endpoint_ids
+        ]
+        self.reindex(pk__in=linked)
+        self.reindex(endpoints=pk)
+
+    def remove(self, pk):
+        self._patch(lambda index: index.remove(pk))
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self.loaded_at = None
+
+    def _patch(self, apply):
+        with self._lock:
+            if self._patches is not None:
+                self._patches.append(apply)
+            if self._index is not None:
+                index = self._index.copy()
+                apply(index)
+                self._index = index
+
+    def _current(self):
+        index = self._index
+        if index is None:
+            index = self.rebuild()
+        elif self._expired():
+            self._refresh_in_background()
+        return index
+
+    def _expired(self):
+        return time.monotonic() - self.loaded_at > self.refresh_interval
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._refresh, name="catalog-refresh", daemon=True
+        ).start()
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Reloading the catalog index failed")
+        finally:
+            self._refreshing = False
+            connection.close()
+
+
+def highlight(text, query):
+    """
+    HTML-escaped ``text`` with the words ``query`` matches in <mark>, by
+    the rules of ``InvertedIndex.expand``.
+    """
+    if not text:
+        return text
+    exact = []
+    prefixes = []
+    for prefix in words(query):
+        (prefixes if prefix_matches(prefix) else exact).append(prefix)
+    prefixes = tuple(prefixes)
+    parts = []
+    position = 0
+    for match in WORD.finditer(text):
+        word = match.group().lower()
+        if word in exact or word.startswith(prefixes):
+            start = match.start()
+            parts.append(escape(text[position:start]))
+            parts.append(f"<mark>{escape(match.group())}</mark>")
+            position = match.end()
+    parts.append(escape(text[position:]))
+    return "".join(parts)
+
+
+catalog = CatalogSearch(settings.CATALOG_SEARCH["REFRESH_INTERVAL"])
@@ -0,0 +1,383 @@
+"""
+Load-test harness behind ``manage.py loadtest``.
+
+A local stub upstream with configurable latency, payload size and error
+rate stands in for third-party APIs. Fixtures are seeded into a database
+of their own, migrated first, next to the configured one. The proxy,
+catalog and developer routes are driven at a fixed concurrency against
+a WSGI or ASGI server started on that database with
+``LOADTEST_DATABASE``, and every fixture is deleted again afterwards.
+"""
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connections
+from django.test import Client
+from django.utils.crypto import get_random_string
+
+from account import runtime
+from account.models import API, Application, Category, Endpoint, User
+
+SERVERS = {
+    "wsgi": (
+        sys.executable,
+        "manage.py",
+        "runserver",
+        "--noreload",
+        "127.0.0.1:{port}",
+    ),
+    "asgi": (
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "config.asgi:application",
+        "--no-access-log",
+        "--port",
+        "{port}",
+    ),
+}
+
+
+def default_database():
+    """The configured database's name with a loadtest suffix."""
+    conf = settings.DATABASES["default"]
+    name = str(conf["NAME"])
+    if conf["ENGINE"].endswith("sqlite3"):
+        root, extension = os.path.splitext(name)
+        return f"{root}-loadtest{extension}"
+    return f"{name}_loadtest"
+
+
+def use_database(name):
+    """
+    Switch this process over to database ``name``, like the servers the
+    environment variable points at it, and migrate it.
+    """
+    connection = connections["default"]
+    connection.close()
+    settings.DATABASES["default"]["NAME"] = name
+    connection.settings_dict["NAME"] = name
+    caches["auth"].key_prefix = runtime.namespace(name)
+    call_command("migrate", interactive=False, verbosity=0)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubUpstream:
+    """Threaded HTTP server answering every request with a JSON payload."""
+
+    def __init__(self, latency=0.0, payload_size=256, error_rate=0.0):
+        body = json.dumps({"data": "x" * payload_size}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_one(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if latency:
+                    time.sleep(latency)
+                failed = error_rate and random.random() < error_rate
+                self.send_response(500 if failed else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = handle_one
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Fixtures:
+    """A developer with ``apis`` APIs on the stub, removed on exit."""
+
+    def __init__(self, base_url, apis=100, endpoints_per_api=4):
+        self.base_url = base_url
+        self.apis = apis
+        self.endpoints_per_api = endpoints_per_api
+
+    def __enter__(self):
+        tag = f"loadtest-{os.getpid()}-{time.time_ns()}"
+        self.user = User.objects.create_user(
+            f"{tag}@example.com", None, is_active=True
+        )
+        self.application = Application.objects.get(owner=self.user)
+        self.category = Category.objects.create(name=tag)
+        self.api_list = API.objects.bulk_create(
+            API(
+                parent=self.application,
+                owner=self.user,
+                category=self.category,
+                name=f"loadtest api {i}",
+                short_description="Load test fixture",
+                base_url=self.base_url,
+                is_public=True,
+            )
+            for i in range(self.apis)
+        )
+        self.endpoints = Endpoint.objects.bulk_create(
+            Endpoint(url=f"/{i}", name=f"{tag} {i}", description=tag)
+            for i in range(self.apis * self.endpoints_per_api)
+        )
+        API.endpoints.through.objects.bulk_create(
+            API.endpoints.through(
+                api=api,
+                endpoint=self.endpoints[i * self.endpoints_per_api + j],
+            )
+            for i, api in enumerate(self.api_list)
+            for j in range(self.endpoints_per_api)
+        )
+        client = Client()
+        client.force_login(self.user)
+        self.cookies = {
+            settings.SESSION_COOKIE_NAME: client.cookies[
+                settings.SESSION_COOKIE_NAME
+            ].value,
+            settings.CSRF_COOKIE_NAME: get_random_string(32),
+        }
+        return self
+
+    def __exit__(self, *exc_info):
+        Endpoint.objects.filter(pk__in=[e.pk for e in self.endpoints]).delete()
+        self.user.delete()
+        self.category.delete()
+
+    def scenarios(self):
+        """
+        ``{name: (method, path, form data, headers)}`` drawn per request.
+        Scenarios with headers send no session cookie.
+        """
+        api = self.api_list[0]
+        endpoint = self.endpoints[0]
+        token = {"token": self.application.token}
+        header = {"Authorization": f"Token {self.application.token}"}
+        use_api = f"/api/v1/use-api/{api.pk}/endpoint/{endpoint.pk}"
+        use_api_async = (
+            f"/api/v1/use-api-async/{api.pk}/endpoint/{endpoint.pk}"
+        )
+        return {
+            "use-api": ("POST", use_api, token, None),
+            "use-api-header": ("POST", use_api, None, header),
+            "use-api-async": ("POST", use_api_async, token, None),
+            "use-api-async-header": ("POST", use_api_async, None, header),
+            "search": ("GET", "/api/v1/search/?search=loadtest", None, None),
+            "app-list": ("GET", "/api/v1/developer/app-list", None, None),
+            "api-list": (
+                "GET",
+                f"/api/v1/developer/app/{self.application.pk}/api-list",
+                None,
+                None,
+            ),
+            "endpoint-list": (
+                "GET",
+                f"/api/v1/developer/api/{api.pk}/endpoints",
+                None,
+                None,
+            ),
+        }
+
+
+class Server:
+    """Runs the project under ``kind`` on ``database`` in a child process."""
+
+    def __init__(self, kind, database):
+        self.kind = kind
+        self.database = database
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        command = [part.format(port=self.port) for part in SERVERS[self.kind]]
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            command,
+            cwd=settings.BASE_DIR,
+            env=dict(os.environ, LOADTEST_DATABASE=self.database),
+            stdout=subprocess.DEVNULL,
+            stderr=self.log,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                self.log.seek(0)
+                raise RuntimeError(
+                    f"{self.kind} server exited: "
+                    f"{self.log.read().decode()[-2000:]}"
+                )
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.process.kill()
+        raise RuntimeError(f"{self.kind} server did not start")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def drive(target, cookies, scenario, requests_count, concurrency):
+    method, path, data, headers = scenario
+    local = threading.local()
+    latencies, queries, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def one(_):
+        http = getattr(local, "http", None)
+        if http is None:
+            http = local.http = requests.Session()
+            if headers is None:
+                http.cookies.update(cookies)
+                http.headers["X-CSRFToken"] = cookies[
+                    settings.CSRF_COOKIE_NAME
+                ]
+            else:
+                http.headers.update(headers)
+        started = time.perf_counter()
+        try:
+            response = http.request(method, target + path, data=data)
+            status = response.status_code
+            count = response.headers.get("X-DB-Queries")
+        except requests.RequestException:
+            status, count = "error", None
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if count is not None:
+                queries.append(int(count))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests_count,
+        "statuses": {str(status): n for status, n in statuses.items()},
+        "rps": round(requests_count / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "db_queries": (
+            {
+                "mean": round(statistics.mean(queries), 2),
+                "max": max(queries),
+            }
+            if queries
+            else None
+        ),
+    }
+
+
+def run(
+    server="wsgi",
+    target=None,
+    scenarios=None,
+    requests_count=500,
+    concurrency=16,
+    warmup=20,
+    latency=0.0,
+    payload_size=256,
+    error_rate=0.0,
+    apis=100,
+    database=None,
+):
+    database = database or default_database()
+    use_database(database)
+    stub = StubUpstream(latency, payload_size, error_rate)
+    with stub, Fixtures(stub.url, apis) as fixtures:
+        available = fixtures.scenarios()
+        chosen = scenarios or list(available)
+        report = {
+            "server": "external" if target else server,
+            "concurrency": concurrency,
+            "upstream": {
+                "latency": latency,
+                "payload_size": payload_size,
+                "error_rate": error_rate,
+            },
+            "apis": apis,
+            "database": database,
+            "scenarios": {},
+        }
+        if target:
+            report["scenarios"] = _drive_all(
+                target,
+                fixtures,
+                available,
+                chosen,
+                requests_count,
+                concurrency,
+                warmup,
+            )
+            return report
+        with Server(server, database) as running:
+            report["scenarios"] = _drive_all(
+                running.url,
+                fixtures,
+                available,
+                chosen,
+                requests_count,
+                concurrency,
+                warmup,
+            )
+        return report
+
+
+def _drive_all(
+    target, fixtures, available, chosen, requests_count, concurrency, warmup
+):
+    results = {}
+    for name in chosen:
+        if warmup:
+            drive(target, fixtures.cookies, available[name], warmup, 1)
+        results[name] = drive(
+            target,
+            fixtures.cookies,
+            available[name],
+            requests_count,
+            concurrency,
+        )
+    return results
@@ -0,0 +1,151 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from account import models
+from account.api import fast_serializers, serializers
+
+SIZES = (20, 100, 1000)
+ENDPOINTS_PER_API = 3
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the DRF list serializers with their fast paths on seeded "
+        "rows. Seeded data is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument(
+            "--json", action="store_true", help="Print results as JSON"
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            owner = self.seed(max(SIZES))
+            results = [
+                result
+                for size in SIZES
+                for result in self.measure(size, options["repeat"], owner)
+            ]
+            transaction.set_rollback(True)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['view']:>9} rows={result['rows']:<5} "
+                f"drf={result['drf_ms']:>8.2f}ms "
+                f"fast={result['fast_ms']:>8.2f}ms "
+                f"speedup={result['speedup']:.1f}x"
+            )
+
+    def seed(self, count):
+        owner = models.User.objects.create_user(
+            f"benchmark-{time.time_ns()}@example.com", None, is_active=True
+        )
+        application = models.Application.objects.get(owner=owner)
+        models.Application.objects.bulk_create(
+            models.Application(
+                owner=owner,
+                name=f"application-{i}",
+                description="Benchmark application",
+                token=models.Application.generate_token(),
+                ip="127.0.0.1",
+            )
+            for i in range(count - 1)
+        )
+        categories = models.Category.objects.bulk_create(
+            models.Category(name=f"category-{i}") for i in range(10)
+        )
+        apis = models.API.objects.bulk_create(
+            models.API(
+                parent=application,
+                owner=owner,
+                category=categories[i % len(categories)],
+                name=f"api-{i}",
+                short_description="Benchmark API",
+                base_url="http://127.0.0.1:9",
+                image=f"api/bench/{i}.png" if i % 2 else None,
+                is_public=bool(i % 3),
+            )
+            for i in range(count)
+        )
+        endpoints = models.Endpoint.objects.bulk_create(
+            models.Endpoint(
+                url=f"/endpoint/{i}",
+                name=f"endpoint-{i}",
+                description="Benchmark endpoint",
+                method=i % len(models.EndpointChoices) + 1,
+            )
+            for i in range(count * ENDPOINTS_PER_API)
+        )
+        models.API.endpoints.through.objects.bulk_create(
+            models.API.endpoints.through(
+                api_id=api.pk,
+                endpoint_id=endpoints[i * ENDPOINTS_PER_API + j].pk,
+            )
+            for i, api in enumerate(apis)
+            for j in range(ENDPOINTS_PER_API)
+        )
+        return owner
+
+    def measure_pair(self, repeat, drf, fast):
+        renderer = JSONRenderer()
+        if renderer.render(drf()) != renderer.render(fast()):
+            raise AssertionError("Fast path output differs from DRF output")
+        timings = []
+        for build in (drf, fast):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                build()
+            timings.append((time.perf_counter() - started) / repeat * 1000)
+        return timings
+
+    def measure(self, size, repeat, owner):
+        apis = (
+            models.API.objects.filter(owner=owner)
+            .select_related("owner", "category")
+            .prefetch_related("endpoints")
+            .order_by("pk")[:size]
+        )
+        applications = models.Application.objects.filter(owner=owner).order_by(
+            "pk"
+        )[:size]
+        results = []
+        for view, drf, fast in (
+            (
+                "api-list",
+                lambda: serializers.APIListSerializer(
+                    apis.all(), many=True
+                ).data,
+                lambda: fast_serializers.api_list(
+                    fast_serializers.api_rows(apis)
+                ),
+            ),
+            (
+                "app-list",
+                lambda: serializers.ApplicationSerializer(
+                    applications.all(), many=True
+                ).data,
+                lambda: fast_serializers.application_list(
+                    fast_serializers.application_rows(applications)
+                ),
+            ),
+        ):
+            drf_ms, fast_ms = self.measure_pair(repeat, drf, fast)
+            results.append(
+                {
+                    "view": view,
+                    "rows": size,
+                    "drf_ms": round(drf_ms, 2),
+                    "fast_ms": round(fast_ms, 2),
+                    "speedup": round(drf_ms / fast_ms, 1),
+                }
+            )
+        return results
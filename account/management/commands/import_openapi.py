@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from account import openapi
+from account.models import API
+
+
+class Command(BaseCommand):
+    help = (
+        "Create and update the endpoints of an API from an OpenAPI or "
+        "Swagger document (JSON or YAML)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("api", type=int, help="Primary key of the API")
+        parser.add_argument("document", help="Path of the document")
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the counts and roll the import back",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            api = API.objects.get(pk=options["api"])
+        except API.DoesNotExist:
+            raise CommandError(f"API {options['api']} does not exist.")
+        try:
+            with open(options["document"], encoding="utf-8") as file:
+                specs, skipped = openapi.operations(openapi.load(file.read()))
+        except (OSError, openapi.InvalidDocument) as exc:
+            raise CommandError(str(exc))
+
+        with transaction.atomic():
+            counts = openapi.import_endpoints(api, specs, skipped)
+            transaction.set_rollback(options["dry_run"])
+        self.stdout.write(json.dumps(counts))
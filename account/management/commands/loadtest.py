@@ -0,0 +1,82 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from account import loadtest
+
+SCENARIOS = (
+    "use-api",
+    "use-api-header",
+    "use-api-async",
+    "use-api-async-header",
+    "search",
+    "app-list",
+    "api-list",
+    "endpoint-list",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the proxy, search and developer routes at a fixed "
+        "concurrency against a local stub upstream and print req/s, "
+        "latency percentiles and query counts as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--server",
+            choices=sorted(loadtest.SERVERS),
+            default="wsgi",
+            help="Server to start, asgi needs uvicorn installed",
+        )
+        parser.add_argument(
+            "--target",
+            help="URL of an already running server to drive, started with "
+            "LOADTEST_DATABASE set to the database",
+        )
+        parser.add_argument(
+            "--database",
+            help="Database to seed, migrated first, defaults to the "
+            "configured one's name with a loadtest suffix",
+        )
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=SCENARIOS,
+            help="Repeat to pick several, defaults to all",
+        )
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--warmup", type=int, default=20)
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="Upstream seconds"
+        )
+        parser.add_argument("--payload-size", type=int, default=256)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--apis", type=int, default=100)
+        parser.add_argument("--output", help="Write the report to a file")
+
+    def handle(self, *args, **options):
+        try:
+            report = loadtest.run(
+                server=options["server"],
+                target=options["target"],
+                scenarios=options["scenario"],
+                requests_count=options["requests"],
+                concurrency=options["concurrency"],
+                warmup=options["warmup"],
+                latency=options["latency"],
+                payload_size=options["payload_size"],
+                error_rate=options["error_rate"],
+                apis=options["apis"],
+                database=options["database"],
+            )
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        self.stdout.write(output)
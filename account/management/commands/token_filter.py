@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from account.models import Application
+from account.proxy import bloom
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the size and false positive rate of the token filter, "
+        "measured with random tokens that were never issued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--probes", type=int, default=100000)
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the filter from the database first",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print the report as JSON"
+        )
+
+    def handle(self, *args, **options):
+        token_filter = bloom.token_filter
+        if options["rebuild"]:
+            token_filter.rebuild(force=True)
+        probes = options["probes"]
+        passed = sum(
+            token_filter.might_contain(Application.generate_token())
+            for _ in range(probes)
+        )
+        report = token_filter.stats()
+        report["measured_false_positive_rate"] = (
+            passed / probes if probes else None
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"tokens={report['tokens']} capacity={report['capacity']} "
+            f"bits={report['bits']} hashes={report['hashes']} "
+            f"size={report['bytes'] / 1024:.1f}KiB"
+        )
+        self.stdout.write(
+            f"false positives: "
+            f"estimated={report['false_positive_rate']:.4%} "
+            f"measured={report['measured_false_positive_rate'] or 0:.4%} "
+            f"({passed}/{probes})"
+        )
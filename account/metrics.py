@@ -0,0 +1,396 @@
+"""
+Process-local metrics exported in the Prometheus text format.
+
+Every metric keeps its series in one ``array("d")``, a fixed number of
+slots per label combination, so recording is a dict lookup and an add
+under a lock. Each worker process writes a snapshot of its arrays into
+``METRICS["DIRECTORY"]`` every ``FLUSH_INTERVAL`` seconds and a scrape
+sums the snapshots of all processes. Counters and histograms of exited
+processes are folded into one archive file, their gauges are dropped.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from account import runtime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = "archive.json"
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def metrics_settings():
+    return settings.METRICS
+
+
+def metrics_directory():
+    return runtime.shared_path(metrics_settings()["DIRECTORY"])
+
+
+class Metric:
+    kind = None
+    width = 1
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.index = {}
+            self.values = array("d")
+
+    def _offset(self, labels):
+        # Callers hold the lock
+        offset = self.index.get(labels)
+        if offset is None:
+            offset = self.index[labels] = len(self.values)
+            self.values.extend(0.0 for _ in range(self.width))
+        return offset
+
+    def _add(self, labels, slot, amount):
+        labels = tuple(str(label) for label in labels)
+        with self.lock:
+            self.values[self._offset(labels) + slot] += amount
+
+    def snapshot(self):
+        with self.lock:
+            values = self.values.tolist()
+            index = list(self.index.items())
+        series = []
+        for labels, offset in index:
+            end = offset + self.width
+            series.append([list(labels), values[offset:end]])
+        return series
+
+    def samples(self, labels, values):
+        yield self.name, labels, values[0]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1.0):
+        self._add(labels, 0, amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1.0):
+        self._add(labels, 0, amount)
+
+    def dec(self, *labels, amount=1.0):
+        self._add(labels, 0, -amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        self.buckets = tuple(buckets)
+        # One slot per bucket, +Inf and the sum
+        self.width = len(self.buckets) + 2
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, *labels):
+        labels = tuple(str(label) for label in labels)
+        with self.lock:
+            offset = self._offset(labels)
+            self.values[offset + bisect_left(self.buckets, value)] += 1
+            self.values[offset + self.width - 1] += value
+
+    def samples(self, labels, values):
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + ("+Inf",), values):
+            cumulative += count
+            le = labels + (("le", str(bound)),)
+            yield self.name + "_bucket", le, cumulative
+        yield self.name + "_sum", labels, values[-1]
+        yield self.name + "_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=()):
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets)
+        )
+
+    def snapshot(self):
+        return {
+            name: metric.snapshot() for name, metric in self.metrics.items()
+        }
+
+    def ensure_flusher(self):
+        """Start this process's flusher, forgetting values from a fork."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Inherited values belong to the parent's snapshot
+                for metric in self.metrics.values():
+                    metric.reset()
+            self._pid = os.getpid()
+        threading.Thread(
+            target=self._run, name="metrics-flusher", daemon=True
+        ).start()
+
+    def _run(self):
+        while True:
+            time.sleep(metrics_settings()["FLUSH_INTERVAL"])
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Writing the metrics snapshot failed")
+
+    def flush(self):
+        directory = metrics_directory()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        _write(path, {"pid": os.getpid(), "metrics": self.snapshot()})
+
+    def collect(self):
+        """``{name: {labels: values}}`` summed over every process."""
+        self.flush()
+        directory = metrics_directory()
+        with _locked(directory):
+            snapshots = _fold_exited(directory, self.metrics)
+        totals = {name: {} for name in self.metrics}
+        for snapshot, alive in snapshots:
+            for name, series in snapshot["metrics"].items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for labels, values in series:
+                    _merge(totals[name], tuple(labels), values)
+        return totals
+
+    def render(self):
+        lines = []
+        for name, series in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, values in sorted(series.items()):
+                pairs = tuple(zip(metric.labelnames, labels))
+                for sample, sample_labels, value in metric.samples(
+                    pairs, values
+                ):
+                    lines.append(
+                        f"{sample}{_labels(sample_labels)} {_number(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def _write(path, snapshot):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(snapshot, file, separators=(",", ":"))
+    os.replace(temporary, path)
+
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(series, labels, values):
+    current = series.get(labels)
+    if current is None:
+        series[labels] = list(values)
+    else:
+        for i, value in enumerate(values):
+            current[i] += value
+
+
+@contextmanager
+def _locked(directory):
+    fd = os.open(os.path.join(directory, ".lock"), os.O_RDWR | os.O_CREAT)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing releases the flock
+        os.close(fd)
+
+
+def _fold_exited(directory, metrics):
+    """
+    ``(snapshot, alive)`` pairs of every process. Counters and histograms
+    of exited processes move into the archive and their files go away.
+    """
+    archive_path = os.path.join(directory, ARCHIVE)
+    archive = _read(archive_path) or {"pid": None, "metrics": {}}
+    snapshots, exited = [], []
+    for name in os.listdir(directory):
+        if not name.endswith(".json") or name == ARCHIVE:
+            continue
+        path = os.path.join(directory, name)
+        snapshot = _read(path)
+        if snapshot is None:
+            continue
+        if _alive(snapshot["pid"]):
+            snapshots.append((snapshot, True))
+        else:
+            exited.append((path, snapshot))
+
+    if exited:
+        folded = {
+            name: {tuple(labels): values for labels, values in series}
+            for name, series in archive["metrics"].items()
+        }
+        for _, snapshot in exited:
+            for name, series in snapshot["metrics"].items():
+                metric = metrics.get(name)
+                if metric is None or metric.kind == "gauge":
+                    continue
+                for labels, values in series:
+                    _merge(folded.setdefault(name, {}), tuple(labels), values)
+        archive["metrics"] = {
+            name: [[list(labels), values] for labels, values in series.items()]
+            for name, series in folded.items()
+        }
+        _write(archive_path, archive)
+        for path, _ in exited:
+            os.remove(path)
+    snapshots.append((archive, False))
+    return snapshots
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "rapid_http_requests_total",
+    "Requests by route, method and status code.",
+    ("route", "method", "status"),
+)
+http_latency = registry.histogram(
+    "rapid_http_request_duration_seconds",
+    "Time spent serving requests by route.",
+    ("route",),
+    LATENCY_BUCKETS,
+)
+proxy_requests = registry.counter(
+    "rapid_proxy_requests_total",
+    "Proxied calls by API, endpoint and status code returned to the user.",
+    ("api", "endpoint", "status"),
+)
+# API and endpoint labels of calls that named no route of the token, so
+# made up primary keys in urls do not add series
+UNRESOLVED_CALL = ("unresolved", "unresolved")
+proxy_cache = registry.counter(
+    "rapid_proxy_cache_total",
+    "Response cache lookups of cacheable calls by result.",
+    ("api", "endpoint", "result"),
+)
+quota_rejections = registry.counter(
+    "rapid_quota_rejections_total",
+    "Calls refused because a user or application quota ran out.",
+    ("kind",),
+)
+upstream_responses = registry.counter(
+    "rapid_upstream_responses_total",
+    "Upstream attempts by API, endpoint and status code, error when the "
+    "attempt failed without a response.",
+    ("api", "endpoint", "status"),
+)
+upstream_latency = registry.histogram(
+    "rapid_upstream_duration_seconds",
+    "Duration of upstream attempts by API and endpoint.",
+    ("api", "endpoint"),
+    LATENCY_BUCKETS,
+)
+rate_limited = registry.counter(
+    "rapid_rate_limited_total",
+    "Calls refused with 429 by the application or API rate limit, by API.",
+    ("api",),
+)
+token_filter = registry.counter(
+    "rapid_token_filter_total",
+    "Unknown tokens by outcome: rejected by the token filter, or let "
+    "through by it and only refused by the database.",
+    ("result",),
+)
+lookup_cache = registry.counter(
+    "rapid_lookup_cache_total",
+    "Proxy lookup cache reads by cache (tokens, owners) and result.",
+    ("cache", "result"),
+)
+proxy_in_flight = registry.gauge(
+    "rapid_proxy_in_flight",
+    "Proxied calls currently being served.",
+)
@@ -0,0 +1,253 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.db import connections
+from django.utils.functional import SimpleLazyObject
+
+from account import authcache, metrics, profiling, timing
+
+logger = logging.getLogger(__name__)
+
+PROXY_ROUTES = frozenset(("use-api", "use-api-async"))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    """``execute_wrapper`` hook counting queries and the time they took."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - started
+
+
+def query_budget(view_func):
+    """The ``query_budget`` a view class or function declares, if any."""
+    view = (
+        getattr(view_func, "cls", None)
+        or getattr(view_func, "view_class", None)
+        or view_func
+    )
+    return getattr(view, "query_budget", None)
+
+
+class AsyncCapableMiddleware:
+    """
+    Base of the middleware here: under ASGI the chain stays async and
+    ``__call__`` hands the request to ``__acall__``.
+    """
+
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+def count_queries(counter):
+    """
+    Hook ``counter`` into the connections of the calling thread, returns
+    the ``ExitStack`` that unhooks it.
+    """
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(counter))
+    return stack
+
+
+class QueryBudgetMiddleware(AsyncCapableMiddleware):
+    """
+    Counts the queries every request runs and their total time into
+    ``request.db_queries`` and ``request.db_time``, and with ``HEADERS``
+    into ``X-DB-Queries`` and ``X-DB-Time`` (ms). Requests to views
+    running more queries than their ``query_budget`` are logged, or fail
+    with ``QueryBudgetExceeded`` when ``QUERY_BUDGET["RAISE"]`` is set.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.QUERY_BUDGET["ENABLED"]:
+            return self.get_response(request)
+
+        counter = QueryCounter()
+        with count_queries(counter):
+            response = self.get_response(request)
+        return self.finish(request, response, counter)
+
+    async def __acall__(self, request):
+        if not settings.QUERY_BUDGET["ENABLED"]:
+            return await self.get_response(request)
+
+        counter = QueryCounter()
+        # Queries run on the request's sync thread, which has connections
+        # of its own, so the hooks go on those
+        stack = await sync_to_async(count_queries)(counter)
+        with stack:
+            response = await self.get_response(request)
+        return self.finish(request, response, counter)
+
+    def finish(self, request, response, counter):
+        request.db_queries = counter.count
+        request.db_time = counter.time
+        if settings.QUERY_BUDGET["HEADERS"]:
+            response["X-DB-Queries"] = str(counter.count)
+            response["X-DB-Time"] = f"{counter.time * 1000:.2f}"
+
+        budget = getattr(request, "query_budget", None)
+        if budget is not None and counter.count > budget:
+            message = (
+                f"{request.method} {request.path} ran {counter.count} "
+                f"queries in {counter.time * 1000:.1f}ms, "
+                f"its budget is {budget}"
+            )
+            if settings.QUERY_BUDGET["RAISE"]:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = query_budget(view_func)
+
+
+class RequestTimingMiddleware(AsyncCapableMiddleware):
+    """
+    Collects the ``timing.phase`` timings of every request, plus the query
+    time ``QueryBudgetMiddleware`` measured, into a ``Server-Timing``
+    header when ``REQUEST_TIMING["HEADER"]`` is set, and runs sampled
+    requests under the profiler when ``REQUEST_TIMING["PROFILE"]`` is.
+    Under ASGI the profiler only sees the event loop thread, not the
+    sync_to_async calls of the view.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        config = settings.REQUEST_TIMING
+        if not config["HEADER"] and not config["PROFILE"]:
+            return self.get_response(request)
+
+        profile = profiling.profile_request()
+        timings, token = timing.start()
+        try:
+            if profile is None:
+                response = self.get_response(request)
+            else:
+                with profile:
+                    response = self.get_response(request)
+        finally:
+            timing.stop(token)
+        return self.finish(request, response, timings, profile)
+
+    async def __acall__(self, request):
+        config = settings.REQUEST_TIMING
+        if not config["HEADER"] and not config["PROFILE"]:
+            return await self.get_response(request)
+
+        profile = profiling.profile_request()
+        # sync_to_async copies the context, so phases timed on the sync
+        # thread land in the same Timings
+        timings, token = timing.start()
+        try:
+            if profile is None:
+                response = await self.get_response(request)
+            else:
+                with profile:
+                    response = await self.get_response(request)
+        finally:
+            timing.stop(token)
+        return self.finish(request, response, timings, profile)
+
+    def finish(self, request, response, timings, profile):
+        if profile is not None:
+            profile.finish(request, time.perf_counter() - timings.started)
+        if settings.REQUEST_TIMING["HEADER"]:
+            db_time = getattr(request, "db_time", None)
+            extra = {} if db_time is None else {"db": db_time}
+            response["Server-Timing"] = timings.header(**extra)
+        return response
+
+
+def label_proxied_call(request, call):
+    """Count ``request`` under the API and endpoint of ``call``."""
+    if getattr(request, "proxied_call", None) is not None:
+        request.proxied_call = (call.api_pk, call.endpoint_pk)
+
+
+class MetricsMiddleware(AsyncCapableMiddleware):
+    """
+    Counts requests and their latency per route into ``account.metrics``,
+    and use-api calls per API and endpoint.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.METRICS["ENABLED"]:
+            return self.get_response(request)
+
+        metrics.registry.ensure_flusher()
+        started = time.perf_counter()
+        request.proxied_call = None
+        response = self.get_response(request)
+        return self.finish(request, response, started)
+
+    async def __acall__(self, request):
+        if not settings.METRICS["ENABLED"]:
+            return await self.get_response(request)
+
+        metrics.registry.ensure_flusher()
+        started = time.perf_counter()
+        request.proxied_call = None
+        response = await self.get_response(request)
+        return self.finish(request, response, started)
+
+    def finish(self, request, response, started):
+        match = request.resolver_match
+        route = match.url_name if match is not None else "unresolved"
+        metrics.http_latency.observe(time.perf_counter() - started, route)
+        metrics.http_requests.inc(route, request.method, response.status_code)
+        if request.proxied_call is not None:
+            metrics.proxy_in_flight.dec()
+            metrics.proxy_requests.inc(
+                *request.proxied_call, response.status_code
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if settings.METRICS["ENABLED"] and match.url_name in PROXY_ROUTES:
+            # Labelled by the view once the route is found, the url alone
+            # is up to the caller
+            request.proxied_call = metrics.UNRESOLVED_CALL
+            metrics.proxy_in_flight.inc()
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """``AuthenticationMiddleware`` resolving users through ``authcache``."""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(
+            lambda: authcache.session_user(request)
+        )
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.10 on 2026-10-16 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("account", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="endpoint",
+            name="cache_ttl",
+            field=models.PositiveIntegerField(
+                default=0,
+                help_text="Seconds to cache GET responses, 0 disables caching",
+                verbose_name="Cache TTL",
+            ),
+        ),
+    ]
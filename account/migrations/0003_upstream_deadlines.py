@@ -0,0 +1,64 @@
+# Generated by Django 4.0.10 on 2026-10-16 23:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("account", "0002_endpoint_cache_ttl"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="api",
+            name="connect_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds, defaults to the global",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="api",
+            name="read_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds, defaults to the global",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="endpoint",
+            name="connect_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds, defaults to the API's",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="endpoint",
+            name="hedged",
+            field=models.BooleanField(
+                default=False,
+                help_text="Send a second GET/PUT/DELETE call when the first one is slower than usual",
+            ),
+        ),
+        migrations.AddField(
+            model_name="endpoint",
+            name="max_retries",
+            field=models.PositiveSmallIntegerField(
+                default=0, help_text="Retries of failed GET/PUT/DELETE calls"
+            ),
+        ),
+        migrations.AddField(
+            model_name="endpoint",
+            name="read_timeout",
+            field=models.FloatField(
+                blank=True,
+                help_text="Seconds, defaults to the API's",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.0.10 on 2026-10-16 23:27
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("account", "0003_upstream_deadlines"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="api",
+            name="rate_burst",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Calls allowed at once, defaults to the rate limit",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="api",
+            name="rate_limit",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Proxied calls per rate period, empty for no limit",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="api",
+            name="rate_period",
+            field=models.PositiveIntegerField(
+                choices=[(1, "second"), (60, "minute")], default=1
+            ),
+        ),
+        migrations.AddField(
+            model_name="application",
+            name="rate_burst",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Calls allowed at once, defaults to the rate limit",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="application",
+            name="rate_limit",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Proxied calls per rate period, empty for no limit",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="application",
+            name="rate_period",
+            field=models.PositiveIntegerField(
+                choices=[(1, "second"), (60, "minute")], default=1
+            ),
+        ),
+    ]
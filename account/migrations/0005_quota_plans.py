@@ -0,0 +1,149 @@
+# Generated by Django 4.0.10 on 2026-10-16 23:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def legacy_plans(apps, schema_editor):
+    """
+    Accounts with a finite requests_limit move to a plan of the calls
+    they had left in total, which never resets like requests_limit, so
+    no account gains or loses calls.
+    """
+    QuotaPlan = apps.get_model("account", "QuotaPlan")
+    plans = {}
+    for name in ("User", "Application"):
+        model = apps.get_model("account", name)
+        limited = model.objects.filter(requests_limit__gte=0)
+        for limit in limited.values_list(
+            "requests_limit", flat=True
+        ).distinct():
+            if limit not in plans:
+                plans[limit] = QuotaPlan.objects.create(
+                    name=f"Legacy {limit} in total", total_limit=limit
+                )
+            limited.filter(requests_limit=limit).update(plan=plans[limit])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("account", "0004_rate_limits"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuotaPlan",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=128)),
+                (
+                    "daily_limit",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="Proxied calls per day, empty for no limit",
+                        null=True,
+                    ),
+                ),
+                (
+                    "monthly_limit",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="Proxied calls per calendar month, empty for no limit",
+                        null=True,
+                    ),
+                ),
+                (
+                    "total_limit",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="Proxied calls in total, never reset, empty for no limit",
+                        null=True,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="QuotaUsage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.PositiveSmallIntegerField(
+                        choices=[(1, "user"), (2, "application")]
+                    ),
+                ),
+                ("account_id", models.PositiveIntegerField()),
+                (
+                    "period",
+                    models.PositiveSmallIntegerField(
+                        choices=[(1, "day"), (2, "month"), (3, "total")]
+                    ),
+                ),
+                ("window", models.PositiveIntegerField()),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="quotausage",
+            constraint=models.UniqueConstraint(
+                fields=("kind", "account_id", "period", "window"),
+                name="account_quotausage_window_unique",
+            ),
+        ),
+        migrations.AddField(
+            model_name="application",
+            name="plan",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Quota of proxied calls, none means unlimited",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="account.quotaplan",
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="plan",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Quota of proxied calls, none means unlimited",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="account.quotaplan",
+            ),
+        ),
+        migrations.RunPython(legacy_plans, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name="application",
+            name="account_application_user_requests_limit_constraint",
+        ),
+        migrations.RemoveConstraint(
+            model_name="user",
+            name="account_user_user_requests_limit_constraint",
+        ),
+        migrations.RemoveField(
+            model_name="application",
+            name="requests_limit",
+        ),
+        migrations.RemoveField(
+            model_name="user",
+            name="requests_limit",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 00:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0005_quota_plans'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='endpoint',
+            name='hedged',
+            field=models.BooleanField(default=False, help_text='Send a second GET/PUT/DELETE call when the first one is slower than usual, on use-api-async only'),
+        ),
+    ]
@@ -4,10 +4,17 @@ import os
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin
-from django.db import models
-from django.db.models.signals import post_save
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
+from account import authcache
+from account.catalog import pages as catalog_pages
+from account.catalog.search import catalog
+from account.proxy import cache as proxy_cache
+from account.proxy import bloom, quota, responses, routing
+
 
 class CustomUserManager(BaseUserManager):
     def create_superuser(self, email, password, **other_fields):
@@ -32,6 +39,60 @@ class CustomUserManager(BaseUserManager):
         return user
 
 
+class QuotaPlan(models.Model):
+    name = models.CharField(max_length=128)
+    daily_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Proxied calls per day, empty for no limit",
+    )
+    monthly_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Proxied calls per calendar month, empty for no limit",
+    )
+    total_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Proxied calls in total, never reset, empty for no limit",
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class QuotaPeriod(models.IntegerChoices):
+    day = 1, "day"
+    month = 2, "month"
+    total = 3, "total"
+
+
+class QuotaKind(models.IntegerChoices):
+    user = 1, "user"
+    application = 2, "application"
+
+
+class QuotaUsage(models.Model):
+    """
+    Proxied calls of a user or application within one quota window, the
+    day ordinal or the month number since year 0, or 0 for the total.
+    """
+
+    kind = models.PositiveSmallIntegerField(choices=QuotaKind.choices)
+    account_id = models.PositiveIntegerField()
+    period = models.PositiveSmallIntegerField(choices=QuotaPeriod.choices)
+    window = models.PositiveIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("kind", "account_id", "period", "window"),
+                name="%(app_label)s_%(class)s_window_unique",
+            )
+        ]
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     email = models.EmailField(
         verbose_name="Email address",
@@ -41,7 +102,13 @@ class User(AbstractBaseUser, PermissionsMixin):
     )
     is_active = models.BooleanField(default=False)
     is_staff = models.BooleanField(default=False)
-    requests_limit = models.IntegerField(default=-1)
+    plan = models.ForeignKey(
+        QuotaPlan,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        help_text="Quota of proxied calls, none means unlimited",
+    )
     objects = CustomUserManager()
 
     USERNAME_FIELD = "email"
@@ -49,13 +116,34 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.email
 
-    class Meta:
-        constraints = [
-            models.CheckConstraint(
-                name="%(app_label)s_%(class)s_user_requests_limit_constraint",
-                check=models.Q(requests_limit__gte=-1),
-            )
-        ]
+
+class RatePeriod(models.IntegerChoices):
+    second = 1, "second"
+    minute = 60, "minute"
+
+
+class ApplicationManager(models.Manager):
+    """
+    Bulk writes skip save() and the signals, so they generate the tokens
+    and update the token filter and lookup cache themselves.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for application in objs:
+            if not application.token:
+                application.token = Application.generate_token()
+        objs = super().bulk_create(objs, *args, **kwargs)
+        allow_tokens(app.token for app in objs)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        updated = super().bulk_update(objs, fields, *args, **kwargs)
+        proxy_cache.forget_applications(app.pk for app in objs)
+        if "token" in fields:
+            allow_tokens(app.token for app in objs)
+        return updated
 
 
 class Application(models.Model):
@@ -66,10 +154,33 @@ class Application(models.Model):
     image = models.ImageField(
         upload_to="applications/%Y/%m/%d", null=True, blank=True
     )
-    requests_limit = models.IntegerField(default=-1)
+    plan = models.ForeignKey(
+        QuotaPlan,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        help_text="Quota of proxied calls, none means unlimited",
+    )
+    rate_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Proxied calls per rate period, empty for no limit",
+    )
+    rate_period = models.PositiveIntegerField(
+        choices=RatePeriod.choices, default=RatePeriod.second
+    )
+    rate_burst = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Calls allowed at once, defaults to the rate limit",
+    )
     token = models.CharField(max_length=255, db_index=True, blank=True)
     created_on = models.DateTimeField(auto_now_add=True)
 
+    objects = ApplicationManager()
+
     def __str__(self):
         return f'{self.name}, {self.created_on.strftime("%Y-%m-%d %H:%M:%S")}'
 
@@ -88,14 +199,6 @@ class Application(models.Model):
             return f"{settings.HOST}{settings.MEDIA_URL}{self.image.url}"
         return None
 
-    class Meta:
-        constraints = [
-            models.CheckConstraint(
-                name="%(app_label)s_%(class)s_user_requests_limit_constraint",
-                check=models.Q(requests_limit__gte=-1),
-            )
-        ]
-
 
 class Category(models.Model):
     name = models.CharField(max_length=128)
@@ -121,6 +224,25 @@ class Endpoint(models.Model):
     name = models.CharField(max_length=32)
     description = models.TextField(max_length=512)
     method = models.IntegerField(choices=EndpointChoices.choices, default=1)
+    cache_ttl = models.PositiveIntegerField(
+        verbose_name="Cache TTL",
+        default=0,
+        help_text="Seconds to cache GET responses, 0 disables caching",
+    )
+    connect_timeout = models.FloatField(
+        null=True, blank=True, help_text="Seconds, defaults to the API's"
+    )
+    read_timeout = models.FloatField(
+        null=True, blank=True, help_text="Seconds, defaults to the API's"
+    )
+    max_retries = models.PositiveSmallIntegerField(
+        default=0, help_text="Retries of failed GET/PUT/DELETE calls"
+    )
+    hedged = models.BooleanField(
+        default=False,
+        help_text="Send a second GET/PUT/DELETE call when the first one "
+        "is slower than usual, on use-api-async only",
+    )
 
     def __str__(self):
         return self.url
@@ -129,6 +251,31 @@ class Endpoint(models.Model):
         ordering = ("id",)
 
 
+class APIManager(models.Manager):
+    """
+    Bulk writes skip the signals, so they refresh the routes, cached
+    responses and the catalog of the written APIs themselves.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        refresh_apis([api.pk for api in objs])
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        updated = super().bulk_update(objs, fields, *args, **kwargs)
+        refresh_apis([api.pk for api in objs])
+        return updated
+
+
+def refresh_apis(pks):
+    routing.routes.reload_apis(pks)
+    responses.forget_apis(pks)
+    catalog.reindex(pk__in=pks)
+    catalog_pages.invalidate()
+
+
 class API(models.Model):
     parent = models.ForeignKey(
         Application, on_delete=models.CASCADE, related_name="apis"
@@ -143,6 +290,29 @@ class API(models.Model):
     base_url = models.URLField()
     endpoints = models.ManyToManyField(Endpoint, blank=True)
     is_public = models.BooleanField(default=False)
+    connect_timeout = models.FloatField(
+        null=True, blank=True, help_text="Seconds, defaults to the global"
+    )
+    read_timeout = models.FloatField(
+        null=True, blank=True, help_text="Seconds, defaults to the global"
+    )
+    rate_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Proxied calls per rate period, empty for no limit",
+    )
+    rate_period = models.PositiveIntegerField(
+        choices=RatePeriod.choices, default=RatePeriod.second
+    )
+    rate_burst = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Calls allowed at once, defaults to the rate limit",
+    )
+
+    objects = APIManager()
 
     def __str__(self):
         return self.name
@@ -165,3 +335,114 @@ def create_default_app(sender, instance=None, created=False, **kwargs):
         Application.objects.create(
             owner=instance, name=f"default-application_{instance.pk}"
         )
+
+
+@receiver((post_save, post_delete), sender=settings.AUTH_USER_MODEL)
+def forget_owner_lookups(sender, instance, **kwargs):
+    proxy_cache.forget_owner(instance.pk)
+    authcache.forget_user(instance.pk)
+
+
+@receiver((post_save, post_delete), sender=Application)
+def forget_application_lookups(sender, instance, **kwargs):
+    proxy_cache.forget_application(instance.pk)
+
+
+def allow_tokens(tokens):
+    """
+    Add ``tokens`` to the token filter once the transaction commits: a
+    rebuild in between would read the database without them and switch
+    to a filter that turns them away.
+    """
+    tokens = [token for token in tokens if token]
+    if tokens:
+        transaction.on_commit(lambda: bloom.token_filter.add_many(tokens))
+
+
+@receiver(post_save, sender=Application)
+def allow_application_token(sender, instance, **kwargs):
+    # Dropped tokens stay in the filter until its next rebuild
+    allow_tokens((instance.token,))
+
+
+@receiver(post_save, sender=API)
+def route_api(sender, instance, **kwargs):
+    routing.routes.reload_api(instance.pk)
+    responses.forget_api(instance.pk)
+    catalog.reindex(pk=instance.pk)
+
+
+@receiver(post_delete, sender=API)
+def unroute_api(sender, instance, **kwargs):
+    routing.routes.drop_api(instance.pk)
+    responses.forget_api(instance.pk)
+    catalog.remove(instance.pk)
+
+
+@receiver(post_save, sender=Endpoint)
+def route_endpoint(sender, instance, **kwargs):
+    routing.routes.reload_endpoint(instance.pk)
+    responses.forget_endpoint(instance.pk)
+    catalog.reindex_endpoint(instance.pk)
+
+
+@receiver(post_delete, sender=Endpoint)
+def unroute_endpoint(sender, instance, **kwargs):
+    routing.routes.drop_endpoint(instance.pk)
+    responses.forget_endpoint(instance.pk)
+    catalog.reindex_endpoint(instance.pk)
+
+
+@receiver(m2m_changed, sender=API.endpoints.through)
+def route_api_endpoints(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        routing.routes.reload_endpoint(instance.pk)
+        responses.forget_endpoint(instance.pk)
+        catalog.reindex_endpoint(instance.pk)
+    else:
+        routing.routes.reload_api(instance.pk)
+        responses.forget_api(instance.pk)
+        catalog.reindex(pk=instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, created=False, **kwargs):
+    if not created:
+        catalog.reindex(category=instance.pk)
+
+
+@receiver((post_save, post_delete), sender=API)
+@receiver((post_save, post_delete), sender=Endpoint)
+@receiver((post_save, post_delete), sender=Category)
+@receiver(m2m_changed, sender=API.endpoints.through)
+def invalidate_catalog_pages(sender, **kwargs):
+    catalog_pages.invalidate()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_catalog_owner(sender, update_fields=None, **kwargs):
+    # Owner emails are part of the pages, logins only touch last_login
+    if update_fields is None or "email" in update_fields:
+        catalog_pages.invalidate()
+
+
+@receiver((post_save, post_delete), sender=QuotaPlan)
+def reload_quota_plans(sender, **kwargs):
+    quota.plans.clear()
+
+
+def _forget_quota(kind, instance):
+    quota.quotas.forget(kind, instance.pk)
+    QuotaUsage.objects.filter(kind=kind, account_id=instance.pk).delete()
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_user_quota(sender, instance, **kwargs):
+    _forget_quota(quota.USER, instance)
+
+
+@receiver(post_delete, sender=Application)
+def forget_application_quota(sender, instance, **kwargs):
+    _forget_quota(quota.APPLICATION, instance)
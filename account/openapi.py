@@ -0,0 +1,157 @@
+"""
+Endpoint import from OpenAPI 3 and Swagger 2 documents.
+
+Every operation under ``paths`` with a method the proxy supports becomes
+an ``Endpoint`` of the API, keyed by its url and method. Endpoints the
+API already has are updated when their name or description changed, new
+ones are created and linked with one insert into ``Endpoint`` and one
+into the ``API.endpoints`` through table, in a single transaction.
+"""
+import json
+from collections import namedtuple
+
+import yaml
+from django.conf import settings
+from django.db import transaction
+
+from account.catalog import pages as catalog_pages
+from account.catalog.search import catalog
+from account.models import Endpoint, EndpointChoices
+
+METHODS = {choice.label.lower(): choice.value for choice in EndpointChoices}
+# Operations the proxy cannot call, counted as skipped
+UNSUPPORTED_METHODS = ("head", "options", "trace")
+
+EndpointSpec = namedtuple(
+    "EndpointSpec", ("url", "method", "name", "description")
+)
+
+
+class InvalidDocument(ValueError):
+    pass
+
+
+def import_settings():
+    return settings.ENDPOINT_IMPORT
+
+
+def _max_length(field):
+    return Endpoint._meta.get_field(field).max_length
+
+
+def load(text):
+    """Parse a JSON document, or a YAML one."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError:
+        raise InvalidDocument("The document is neither JSON nor YAML.")
+
+
+def operations(document):
+    """
+    ``(specs, skipped)``, the importable operations of ``document`` and
+    the number of operations that cannot be imported.
+    """
+    paths = document.get("paths") if isinstance(document, dict) else None
+    if not isinstance(paths, dict):
+        raise InvalidDocument("The document has no paths.")
+    url_length = _max_length("url")
+    name_length = _max_length("name")
+    description_length = _max_length("description")
+
+    specs, skipped = [], 0
+    for url, item in paths.items():
+        if not isinstance(item, dict):
+            continue
+        for method, operation in item.items():
+            method = method.lower()
+            if method not in METHODS:
+                # Path level parameters, servers and $ref are no operations
+                skipped += method in UNSUPPORTED_METHODS
+                continue
+            if len(url) > url_length:
+                skipped += 1
+                continue
+            if not isinstance(operation, dict):
+                operation = {}
+            name = (
+                operation.get("operationId")
+                or operation.get("summary")
+                or f"{method.upper()} {url}"
+            )
+            description = (
+                operation.get("description") or operation.get("summary") or ""
+            )
+            specs.append(
+                EndpointSpec(
+                    url,
+                    METHODS[method],
+                    str(name)[:name_length],
+                    str(description)[:description_length],
+                )
+            )
+
+    limit = import_settings()["MAX_ENDPOINTS"]
+    if len(specs) > limit:
+        raise InvalidDocument(
+            f"Ensure the document has no more than {limit} operations."
+        )
+    return specs, skipped
+
+
+def import_endpoints(api, specs, skipped=0):
+    """
+    Upsert ``specs`` as endpoints of ``api``. Returns the created,
+    updated and skipped (unchanged, repeated or unsupported) counts.
+    """
+    existing = {}
+    for endpoint in api.endpoints.all():
+        existing.setdefault((endpoint.url, endpoint.method), endpoint)
+
+    created, updated, seen = [], [], set()
+    for spec in specs:
+        key = (spec.url, spec.method)
+        if key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        endpoint = existing.get(key)
+        if endpoint is None:
+            created.append(
+                Endpoint(
+                    url=spec.url,
+                    method=spec.method,
+                    name=spec.name,
+                    description=spec.description,
+                )
+            )
+        elif (endpoint.name, endpoint.description) != (
+            spec.name,
+            spec.description,
+        ):
+            endpoint.name = spec.name
+            endpoint.description = spec.description
+            updated.append(endpoint)
+        else:
+            skipped += 1
+
+    with transaction.atomic():
+        Endpoint.objects.bulk_create(created)
+        Endpoint.objects.bulk_update(updated, ("name", "description"))
+        # add() inserts the links in one query and sends m2m_changed,
+        # which refreshes routes, caches and the catalog
+        api.endpoints.add(*created)
+    if updated and not created:
+        # bulk_update() sends no post_save, names and descriptions are
+        # only part of the catalog
+        catalog.reindex(pk=api.pk)
+        catalog_pages.invalidate()
+    return {
+        "created": len(created),
+        "updated": len(updated),
+        "skipped": skipped,
+    }
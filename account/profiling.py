@@ -0,0 +1,73 @@
+"""
+Opt-in request profiler. With ``REQUEST_TIMING["PROFILE"]`` every
+``PROFILE_EVERY``-th request, and every request slower than
+``PROFILE_SLOW_MS``, is run under cProfile and its stats are dumped into
+``PROFILE_DIRECTORY`` for ``python -m pstats``. Only the newest
+``PROFILE_KEEP`` dumps are kept.
+"""
+import cProfile
+import itertools
+import os
+import re
+import time
+
+from django.conf import settings
+
+_requests = itertools.count(1)
+
+
+class RequestProfile:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+
+    def finish(self, request, seconds):
+        """Dump the stats if the request was sampled or slow."""
+        slow_ms = settings.REQUEST_TIMING["PROFILE_SLOW_MS"]
+        if self.sampled or (slow_ms is not None and seconds * 1000 >= slow_ms):
+            dump(self.profiler, request, seconds)
+
+
+def profile_request():
+    """A ``RequestProfile`` to run the current request under, or None."""
+    config = settings.REQUEST_TIMING
+    if not config["PROFILE"]:
+        return None
+    every = config["PROFILE_EVERY"]
+    sampled = bool(every) and next(_requests) % every == 0
+    if not sampled and config["PROFILE_SLOW_MS"] is None:
+        return None
+    return RequestProfile(sampled)
+
+
+def dump(profiler, request, seconds):
+    directory = settings.REQUEST_TIMING["PROFILE_DIRECTORY"]
+    os.makedirs(directory, exist_ok=True)
+    path = re.sub(r"\W+", "_", request.path).strip("_")[:80] or "root"
+    profiler.dump_stats(
+        os.path.join(
+            directory,
+            f"{time.time_ns()}-{request.method}-{path}-"
+            f"{seconds * 1000:.0f}ms.prof",
+        )
+    )
+    rotate(directory, settings.REQUEST_TIMING["PROFILE_KEEP"])
+
+
+def rotate(directory, keep):
+    dumps = sorted(
+        name for name in os.listdir(directory) if name.endswith(".prof")
+    )
+    for name in dumps[: max(len(dumps) - keep, 0)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            # Removed by a concurrent request
+            pass
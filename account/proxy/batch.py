@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from rest_framework.exceptions import APIException, NotFound
+
+from account import metrics
+
+from . import gateway, responses, service
+
+
+def batch_settings():
+    return settings.PROXY_BATCH
+
+
+def _success(status, content_type, content, cache):
+    data, raw = gateway.decode(content)
+    if not (data or raw):
+        raise NotFound(detail="Not found.", code=404)
+    item = {"status": status}
+    if raw:
+        item["content_type"] = content_type
+        item["data"] = content.decode(errors="replace")
+    else:
+        item["data"] = data
+    if cache is not None:
+        item["cache"] = cache
+    return item
+
+
+def _run_one(call):
+    cached = responses.lookup(call)
+    if cached is not None:
+        return _success(cached.status, cached.content_type, cached.body, "HIT")
+    result = gateway.fetch(call)
+    item = _success(
+        result.status,
+        result.content_type,
+        result.content,
+        "MISS" if responses.is_cacheable(call) else None,
+    )
+    gateway.store(call, result)
+    return item
+
+
+def _run_safely(call):
+    try:
+        return True, _run_one(call)
+    except APIException as exc:
+        return False, {"status": exc.status_code, "detail": exc.detail}
+
+
+def run_batch(user, token, calls):
+    """
+    Run ``calls`` (dicts with ``api_pk`` and ``endpoint_pk``) under one
+    token. The token is resolved and quota reserved once for the whole
+    batch; reservations of calls that fail are handed back. Every call
+    counts against the rate limits on its own. Returns the results and
+    the ``QuotaState`` left after the batch.
+    """
+    application = service.application_record(token)
+    if application is None:
+        raise NotFound(detail="Not found.", code=404)
+
+    resolved, labels = [], []
+    for item in calls:
+        call = service.call_record(item["api_pk"], item["endpoint_pk"])
+        if call is None or call.application_pk != application.pk:
+            labels.append(metrics.UNRESOLVED_CALL)
+            call = {"status": 404, "detail": "Not found."}
+        else:
+            labels.append((call.api_pk, call.endpoint_pk))
+            try:
+                service.check_rate(application, call)
+            except APIException as exc:
+                call = {"status": exc.status_code, "detail": exc.detail}
+        resolved.append(call)
+    runnable = [call for call in resolved if not isinstance(call, dict)]
+    quota = None
+    if runnable:
+        quota = service.charge_request(user, application, count=len(runnable))
+
+    workers = min(batch_settings()["CONCURRENCY"], len(runnable)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = iter(list(executor.map(_run_safely, runnable)))
+
+    results = []
+    failed = 0
+    for item, call, call_labels in zip(calls, resolved, labels):
+        if isinstance(call, dict):
+            outcome = call
+        else:
+            ok, outcome = next(outcomes)
+            failed += not ok
+        metrics.proxy_requests.inc(*call_labels, outcome["status"])
+        results.append({**item, **outcome})
+    service.refund_request(user, application, failed)
+    if quota is not None and failed:
+        quota = quota._replace(remaining=quota.remaining + failed)
+    return results, quota
@@ -0,0 +1,243 @@
+"""
+Bloom filter over every ``Application.token``, so ``application_record``
+turns away tokens that were never issued without running a query.
+
+The bit array lives in a memory-mapped file shared by the worker
+processes on the host, sized for ``CAPACITY`` tokens at ``ERROR_RATE``
+false positives. Tokens are added from the ``Application`` post_save
+signal once the transaction that saved them commits. Deleted and
+replaced tokens only leave the filter when it is rebuilt from the
+database, every ``REFRESH_INTERVAL`` seconds. Lookups keep answering
+from the filter in place while a background thread rebuilds it, only
+the very first lookup on a host waits for the build. A rebuild fills
+the idle one of two buffers and then switches lookups over, so lookups
+never see a half built filter. Tokens added meanwhile are set in both
+buffers, and one worker on the host rebuilds at a time.
+
+Signals only reach the workers of one host: a token issued on another
+host passes here once the filter was rebuilt.
+"""
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+
+from account import runtime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# active buffer, bits, hashes, built at (epoch seconds), tokens added
+HEADER = struct.Struct("=qqqdq")
+
+
+def bloom_settings():
+    return settings.PROXY_TOKEN_FILTER
+
+
+def optimal_size(capacity, error_rate):
+    """Bits and hash functions for ``capacity`` items at ``error_rate``."""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    bits += -bits % 8
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def positions(token, bits, hashes):
+    # Double hashing over one 128-bit digest
+    digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], "little")
+    step = int.from_bytes(digest[8:], "little") | 1
+    return [(first + i * step) % bits for i in range(hashes)]
+
+
+class TokenFilter:
+    def __init__(
+        self, path=None, capacity=None, error_rate=None, refresh_interval=None
+    ):
+        conf = bloom_settings()
+        self._path = path
+        self.capacity = capacity or conf["CAPACITY"]
+        self.error_rate = error_rate or conf["ERROR_RATE"]
+        self.refresh_interval = (
+            conf["REFRESH_INTERVAL"]
+            if refresh_interval is None
+            else refresh_interval
+        )
+        self.bits, self.hashes = optimal_size(self.capacity, self.error_rate)
+        self.buffer_size = self.bits // 8
+        self._map = None
+        self._fd = None
+        self._rebuild_fd = None
+        self._pid = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path or runtime.shared_path(bloom_settings()["PATH"])
+
+    @property
+    def segment(self):
+        # A mapping inherited over fork shares its flock with the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+                    self._pid = os.getpid()
+        return self._map
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._rebuild_fd = os.open(
+            f"{self.path}.rebuild", os.O_RDWR | os.O_CREAT, 0o600
+        )
+        size = HEADER.size + 2 * self.buffer_size
+        with self._flock(self._fd):
+            if os.fstat(self._fd).st_size != size:
+                # New file or new sizing, rebuilt on first lookup
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    @contextmanager
+    def _flock(fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def locked(self):
+        segment = self.segment
+        with self._lock, self._flock(self._fd):
+            yield segment
+
+    def _stale(self, built_at):
+        return time.time() - built_at > self.refresh_interval
+
+    def might_contain(self, token):
+        """False only for tokens that are certainly not issued."""
+        segment = self.segment
+        active, _, _, built_at, _ = HEADER.unpack_from(segment)
+        if not built_at:
+            active = self.rebuild()
+        elif self._stale(built_at):
+            self._refresh_in_background()
+        base = HEADER.size + active * self.buffer_size
+        return all(
+            segment[base + (bit >> 3)] & (1 << (bit & 7))
+            for bit in positions(token, self.bits, self.hashes)
+        )
+
+    def add(self, token):
+        self.add_many((token,))
+
+    def add_many(self, tokens):
+        with self.locked() as segment:
+            active, bits, hashes, built_at, count = HEADER.unpack_from(segment)
+            if not built_at:
+                # Never built, the first lookup loads every token anyway
+                return
+            # The idle buffer too, a running rebuild keeps its bits
+            bases = (HEADER.size, HEADER.size + self.buffer_size)
+            for token in tokens:
+                for bit in positions(token, self.bits, self.hashes):
+                    for base in bases:
+                        segment[base + (bit >> 3)] |= 1 << (bit & 7)
+                count += 1
+            HEADER.pack_into(segment, 0, active, bits, hashes, built_at, count)
+
+    def rebuild(self, force=False):
+        """Refill the filter from the database, returns the new buffer."""
+        segment = self.segment
+        with self._rebuild_lock, self._flock(self._rebuild_fd):
+            active, _, _, built_at, _ = HEADER.unpack_from(segment)
+            if not force and built_at and not self._stale(built_at):
+                # Another worker rebuilt it meanwhile
+                return active
+            idle = 1 - active
+            start = HEADER.size + idle * self.buffer_size
+            end = start + self.buffer_size
+            with self.locked():
+                # Cleared before the query, adds from here on land in it
+                segment[start:end] = bytes(self.buffer_size)
+            bits = bytearray(self.buffer_size)
+            count = 0
+            tokens = (
+                apps.get_model("account", "Application")
+                .objects.exclude(token="")
+                .values_list("token", flat=True)
+            )
+            for token in tokens.iterator():
+                for bit in positions(token, self.bits, self.hashes):
+                    bits[bit >> 3] |= 1 << (bit & 7)
+                count += 1
+            with self.locked():
+                added = int.from_bytes(segment[start:end], "little")
+                bits = int.from_bytes(bits, "little") | added
+                segment[start:end] = bits.to_bytes(self.buffer_size, "little")
+                HEADER.pack_into(
+                    segment,
+                    0,
+                    idle,
+                    self.bits,
+                    self.hashes,
+                    time.time(),
+                    count,
+                )
+            return idle
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._refresh, name="token-filter-refresh", daemon=True
+        ).start()
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Rebuilding the token filter failed")
+        finally:
+            self._refreshing = False
+            connection.close()
+
+    def stats(self):
+        _, _, _, built_at, count = HEADER.unpack_from(self.segment)
+        return {
+            "capacity": self.capacity,
+            "tokens": count,
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "bytes": HEADER.size + 2 * self.buffer_size,
+            "false_positive_rate": (
+                1 - math.exp(-self.hashes * count / self.bits)
+            )
+            ** self.hashes,
+            "built_at": built_at or None,
+        }
+
+
+token_filter = TokenFilter()
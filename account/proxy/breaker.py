@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from .pool import host_key
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class UpstreamUnavailable(APIException):
+    status_code = 503
+    default_detail = "Upstream is unavailable, try again later."
+    default_code = "upstream_unavailable"
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+def breaker_settings():
+    return settings.PROXY_CIRCUIT_BREAKER
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the last ``WINDOW`` calls to one upstream host.
+    Too many failures or slow calls open the breaker; after
+    ``OPEN_SECONDS`` up to ``HALF_OPEN_CALLS`` probes decide whether it
+    closes again or stays open.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = CLOSED
+        self.opened_at = None
+        self._conf = breaker_settings()
+        self._outcomes = deque(maxlen=self._conf["WINDOW"])
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._remaining_open()
+                if remaining > 0:
+                    raise UpstreamUnavailable(wait=int(remaining) + 1)
+                self.state = HALF_OPEN
+                self._probes = self._probe_successes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self._conf["HALF_OPEN_CALLS"]:
+                    raise UpstreamUnavailable(wait=1)
+                self._probes += 1
+
+    def record(self, ok, elapsed):
+        slow = elapsed >= self._conf["SLOW_CALL_SECONDS"]
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if not ok or slow:
+                    self._open()
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self._conf["HALF_OPEN_CALLS"]:
+                        self.state = CLOSED
+                        self._outcomes.clear()
+                return
+            self._outcomes.append((ok, slow))
+            if self.state == CLOSED and self._tripped():
+                self._open()
+
+    def snapshot(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            return {
+                "host": self.host,
+                "state": self.state,
+                "calls": calls,
+                "failures": sum(not ok for ok, _ in self._outcomes),
+                "slow_calls": sum(slow for _, slow in self._outcomes),
+                "retry_after": (
+                    int(self._remaining_open()) + 1
+                    if self.state == OPEN
+                    else None
+                ),
+            }
+
+    def _tripped(self):
+        calls = len(self._outcomes)
+        if calls < self._conf["MIN_CALLS"]:
+            return False
+        failures = sum(not ok for ok, _ in self._outcomes)
+        slow = sum(slow for _, slow in self._outcomes)
+        return (
+            failures / calls >= self._conf["ERROR_RATE"]
+            or slow / calls >= self._conf["SLOW_CALL_RATE"]
+        )
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def _remaining_open(self):
+        elapsed = time.monotonic() - self.opened_at
+        return max(self._conf["OPEN_SECONDS"] - elapsed, 0)
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        key = host_key(url)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(key, CircuitBreaker(key))
+        return breaker
+
+    def clear(self):
+        with self._lock:
+            self._breakers.clear()
+
+
+breakers = BreakerRegistry()
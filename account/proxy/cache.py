@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+ApplicationRecord = namedtuple(
+    "ApplicationRecord",
+    (
+        "pk",
+        "owner_id",
+        "token",
+        "plan_id",
+        "rate_limit",
+        "rate_period",
+        "rate_burst",
+    ),
+)
+
+
+class OwnerRecord(namedtuple("OwnerRecord", ("pk", "plan_id", "is_active"))):
+    """
+    The owner of a header authenticated token's application, standing in
+    for ``request.user`` wherever the proxy needs a user.
+    """
+
+    __slots__ = ()
+    is_authenticated = True
+    is_anonymous = False
+
+    @property
+    def id(self):
+        return self.pk
+
+
+class LRUCache:
+    """
+    Thread-safe LRU mapping with a per-entry TTL and hit/miss counters.
+    With ``max_bytes`` entries are also evicted to keep the summed
+    ``sizeof(value)`` under that budget.
+    """
+
+    def __init__(self, max_entries, ttl, max_bytes=0, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = self._sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires, value, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or (
+                self.max_bytes and self.bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._data)))
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def discard_where(self, predicate):
+        with self._lock:
+            stale = [
+                key
+                for key, (_, value, _) in self._data.items()
+                if predicate(key, value)
+            ]
+            for key in stale:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+        }
+        if self.max_bytes:
+            stats.update(bytes=self.bytes, max_bytes=self.max_bytes)
+        return stats
+
+    def _remove(self, key):
+        self.bytes -= self._data.pop(key)[2]
+
+
+# Signals only reach the current process, the TTL bounds how long other
+# workers may serve a record that changed elsewhere.
+tokens = LRUCache(
+    settings.PROXY_LOOKUP_CACHE["MAX_ENTRIES"],
+    settings.PROXY_LOOKUP_CACHE["TTL"],
+)
+
+owners = LRUCache(
+    settings.PROXY_LOOKUP_CACHE["MAX_ENTRIES"],
+    settings.PROXY_LOOKUP_CACHE["TTL"],
+)
+
+
+def forget_application(pk):
+    tokens.discard_where(lambda token, record: record.pk == pk)
+
+
+def forget_applications(pks):
+    pks = set(pks)
+    tokens.discard_where(lambda token, record: record.pk in pks)
+
+
+def forget_owner(pk):
+    owners.discard(pk)
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+from http.client import HTTPException
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.response import Response
+from urllib3.exceptions import HTTPError
+
+from account import metrics, timing
+
+from . import resilience, responses, service, singleflight, streaming
+from .breaker import breakers
+from .pool import async_timeout, pools
+from .resilience import Deadline, UpstreamFailed
+
+# A fully buffered upstream response, safe to share between callers
+UpstreamResult = namedtuple(
+    "UpstreamResult", ("status", "content_type", "content")
+)
+
+
+def _content_type(response):
+    return response.headers.get("content-type")
+
+
+def decode(content):
+    """
+    Returns ``(data, raw)``: the parsed JSON body, or None and whether the
+    body has to be relayed raw because it is not JSON.
+    """
+    with timing.phase("decode"):
+        try:
+            return json.loads(content), False
+        except ValueError:
+            return None, bool(content)
+
+
+def store(call, result):
+    responses.store(call, result.status, result.content_type, result.content)
+
+
+def _raw_response(result):
+    return HttpResponse(
+        result.content, status=result.status, content_type=result.content_type
+    )
+
+
+def _record(call, breaker, started, status=None):
+    elapsed = time.monotonic() - started
+    ok = status is not None and status < 500
+    breaker.record(ok, elapsed)
+    metrics.upstream_latency.observe(elapsed, call.api_pk, call.endpoint_pk)
+    metrics.upstream_responses.inc(
+        call.api_pk, call.endpoint_pk, "error" if status is None else status
+    )
+
+
+def _read(response, deadline):
+    """
+    The body of ``response``, None once ``deadline`` passed. Reads what
+    arrived rather than whole chunks, so a body trickling in is given up
+    on in time.
+    """
+    raw = response.raw
+    # urllib3 1.26 has no read1(), read from the http.client response and
+    # decode the way urllib3's read() would
+    raw._init_decoder()
+    chunk_size = streaming.streaming_settings()["CHUNK_SIZE"]
+    chunks = []
+    try:
+        while deadline.remaining():
+            chunk = raw._fp.read1(chunk_size)
+            if not chunk:
+                chunks.append(raw._flush_decoder())
+                raw.release_conn()
+                return b"".join(chunks)
+            chunks.append(raw._decode(chunk, True, False))
+    except Exception:
+        response.close()
+        raise
+    # Half read, the connection cannot go back to the pool
+    response.close()
+    return None
+
+
+def _attempt(call, deadline):
+    timeout = deadline.timeout(call)
+    breaker = breakers.get(call.url)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = pools.session(call.url).request(
+            call.method, call.url, timeout=timeout, stream=True
+        )
+        content = _read(response, deadline)
+    except (requests.RequestException, HTTPError, HTTPException, OSError):
+        content = None
+    if content is None:
+        _record(call, breaker, started)
+        raise UpstreamFailed()
+    _record(call, breaker, started, response.status_code)
+    return UpstreamResult(
+        response.status_code, _content_type(response), content
+    )
+
+
+async def _aattempt(call, deadline):
+    connect, read = deadline.timeout(call)
+    breaker = breakers.get(call.url)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = await asyncio.wait_for(
+            pools.async_client(call.url).request(
+                call.method, call.url, timeout=async_timeout(connect, read)
+            ),
+            deadline.remaining(),
+        )
+    except (httpx.HTTPError, asyncio.TimeoutError):
+        _record(call, breaker, started)
+        raise UpstreamFailed()
+    _record(call, breaker, started, response.status_code)
+    return UpstreamResult(
+        response.status_code, _content_type(response), response.content
+    )
+
+
+def _fetch(call):
+    return resilience.run(call, _attempt)
+
+
+async def _afetch(call):
+    return await resilience.arun(call, _aattempt)
+
+
+def fetch(call):
+    with timing.phase("upstream"):
+        if singleflight.applies(call):
+            return singleflight.flights.do(
+                singleflight.flight_key(call), lambda: _fetch(call)
+            )
+        return _fetch(call)
+
+
+async def afetch(call):
+    with timing.phase("upstream"):
+        if singleflight.applies(call):
+            return await singleflight.flights.ado(
+                singleflight.flight_key(call), lambda: _afetch(call)
+            )
+        return await _afetch(call)
+
+
+def proxy(user, application, call):
+    cached = responses.lookup(call)
+    if cached is not None:
+        quota = service.charge_request(user, application)
+        return service.with_quota(responses.hit_response(cached), quota)
+
+    if streaming.is_enabled():
+        return _stream(user, application, call)
+
+    result = fetch(call)
+    data, raw = decode(result.content)
+    if data or raw:
+        quota = service.charge_request(user, application)
+        store(call, result)
+        if raw:
+            response = _raw_response(result)
+        else:
+            response = Response(data, status=200)
+        return service.with_quota(responses.mark(call, response), quota)
+    raise NotFound(detail="Not found.", code=404)
+
+
+async def aproxy(user, application, call):
+    charge_request = sync_to_async(service.charge_request)
+    cached = responses.lookup(call)
+    if cached is not None:
+        quota = await charge_request(user, application)
+        return service.with_quota(responses.hit_response(cached), quota)
+
+    if streaming.is_enabled():
+        return await _astream(user, application, call, charge_request)
+
+    result = await afetch(call)
+    data, raw = decode(result.content)
+    if data or raw:
+        quota = await charge_request(user, application)
+        store(call, result)
+        if raw:
+            response = _raw_response(result)
+        else:
+            response = JsonResponse(data, status=200, safe=False)
+        return service.with_quota(responses.mark(call, response), quota)
+    raise NotFound(detail="Not found.", code=404)
+
+
+def _stream(user, application, call):
+    """
+    Relay the upstream body as it arrives. A relayed body can be neither
+    replayed nor shared, so streamed calls make one attempt: no retries,
+    no hedging and no single-flight.
+    """
+    timeout = Deadline(resilience.retry_settings()["DEADLINE"]).timeout(call)
+    breaker = breakers.get(call.url)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = pools.session(call.url).request(
+            call.method, call.url, timeout=timeout, stream=True
+        )
+    except requests.RequestException:
+        _record(call, breaker, started)
+        raise UpstreamFailed()
+    _record(call, breaker, started, response.status_code)
+    try:
+        streaming.check_declared_size(response.headers)
+        quota = service.charge_request(user, application)
+    except APIException:
+        response.close()
+        raise
+    collector = responses.collector(
+        call, response.status_code, _content_type(response)
+    )
+    return service.with_quota(
+        responses.mark(call, streaming.stream_response(response, collector)),
+        quota,
+    )
+
+
+async def _astream(user, application, call, charge_request):
+    """Spool the upstream body, in one attempt like ``_stream``."""
+    connect, read = Deadline(resilience.retry_settings()["DEADLINE"]).timeout(
+        call
+    )
+    client = pools.async_client(call.url)
+    breaker = breakers.get(call.url)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        try:
+            response = await client.send(
+                client.build_request(
+                    call.method,
+                    call.url,
+                    timeout=async_timeout(connect, read),
+                ),
+                stream=True,
+            )
+        except httpx.HTTPError:
+            _record(call, breaker, started)
+            raise
+        _record(call, breaker, started, response.status_code)
+        collector = responses.collector(
+            call, response.status_code, _content_type(response)
+        )
+        try:
+            spool, size = await streaming.spool_response(response, collector)
+        finally:
+            await response.aclose()
+    except httpx.HTTPError:
+        raise UpstreamFailed()
+    try:
+        quota = await charge_request(user, application)
+    except APIException:
+        spool.close()
+        raise
+    return service.with_quota(
+        responses.mark(
+            call, streaming.spooled_response(response, spool, size)
+        ),
+        quota,
+    )
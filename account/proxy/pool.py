@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 "
+    "(Windows NT 10.0; Win64; x64; rv:99.0) "
+    "Gecko/20100101 Firefox/99.0"
+}
+
+
+def pool_settings():
+    return settings.PROXY_POOL
+
+
+def host_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def async_timeout(connect=None, read=None):
+    conf = pool_settings()
+    return httpx.Timeout(
+        read or conf["READ_TIMEOUT"],
+        connect=connect or conf["CONNECT_TIMEOUT"],
+        pool=conf["POOL_TIMEOUT"],
+    )
+
+
+class ConnectionPools:
+    """
+    Keep-alive connection pools shared by every proxied call, one per
+    upstream host. Sync callers get a ``requests.Session``, async callers
+    an ``httpx.AsyncClient`` bound to the running event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = weakref.WeakKeyDictionary()
+
+    def session(self, url):
+        key = host_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._sessions[key] = self._new_session()
+        return session
+
+    def async_client(self, url):
+        key = host_key(url)
+        loop = asyncio.get_running_loop()
+        clients = self._clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None or client.is_closed:
+            client = clients[key] = self._new_async_client()
+        return client
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        clients = self._clients.pop(loop, {})
+        for client in clients.values():
+            await client.aclose()
+
+    @staticmethod
+    def _new_session():
+        conf = pool_settings()
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=conf["MAX_CONNECTIONS"],
+            pool_block=conf["POOL_BLOCK"],
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(DEFAULT_HEADERS)
+        return session
+
+    @staticmethod
+    def _new_async_client():
+        conf = pool_settings()
+        limits = httpx.Limits(
+            max_connections=conf["MAX_CONNECTIONS"],
+            max_keepalive_connections=conf["MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=conf["KEEPALIVE_EXPIRY"],
+        )
+        return httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            limits=limits,
+            timeout=async_timeout(),
+        )
+
+
+pools = ConnectionPools()
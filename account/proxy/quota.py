@@ -0,0 +1,582 @@
+"""
+Write-behind request quotas for the use-api proxy.
+
+A ``QuotaPlan`` limits the calls of the users and applications on it per
+day, per calendar month and/or in total. Calls are counted in
+``QuotaUsage`` rows, one per account and window (the day ordinal, the
+month number, or 0 for the total, which never rolls over), so a new day
+or month simply starts a new counter: nothing is reset at rollover and
+past windows stay around as usage history.
+
+Every limited account window gets a slot in a file-backed segment shared
+by all worker processes on the host. A slot holds the usage of the
+window last read from the database (``used``) and the calls admitted
+since the last flush (``pending``); a call is admitted while
+``used + pending`` stays within the plan's limit. A flusher thread adds
+the pending counts to the usage rows in batched UPDATEs every
+``FLUSH_INTERVAL`` seconds, or sooner once a slot reaches
+``FLUSH_THRESHOLD`` pending calls. Plans are cached per process.
+
+Failure semantics:
+
+* A crashed worker loses nothing, its pending counts stay in the segment
+  and the next flush of any worker writes them.
+* A failed flush puts the deltas back into the segment for the next try.
+* Losing the segment itself (host crash, file removed) drops the unflushed
+  counts, so an account can overspend by about ``FLUSH_THRESHOLD``
+  calls plus what arrived within one flush interval.
+* Each host keeps its own segment. Usage is re-read from the database
+  every ``REFRESH_INTERVAL`` seconds, which bounds how long hosts can
+  spend the same remaining quota twice.
+"""
+import atexit
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from account import runtime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+USER = 1
+APPLICATION = 2
+DAY = 1
+MONTH = 2
+TOTAL = 3
+PERIODS = (DAY, MONTH, TOTAL)
+EMPTY = 0
+DELETED = -1
+
+# key (kind and period), account pk, window, used, pending
+SLOT = struct.Struct("=qqqqq")
+MAX_PROBES = 64
+BATCH_SIZE = 200
+
+# What the X-Quota-* headers report, for the tightest window. Totals
+# never reset, their reset is None.
+QuotaState = namedtuple("QuotaState", ("limit", "remaining", "reset"))
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, kind):
+        super().__init__(kind)
+        self.kind = kind
+
+
+class SegmentFull(Exception):
+    pass
+
+
+def slot_key(kind, period):
+    return kind * 4 + period
+
+
+def split_key(key):
+    return divmod(key, 4)
+
+
+def current_windows(today=None):
+    """``{period: window}`` of the windows ``today`` falls into."""
+    today = today or timezone.localdate()
+    return {
+        DAY: today.toordinal(),
+        MONTH: today.year * 12 + today.month - 1,
+        TOTAL: 0,
+    }
+
+
+def window_end(period, window):
+    """When the window rolls over, None for the total."""
+    if period == TOTAL:
+        return None
+    if period == DAY:
+        start = date.fromordinal(window + 1)
+    else:
+        year, month = divmod(window + 1, 12)
+        start = date(year, month + 1, 1)
+    return datetime(
+        start.year,
+        start.month,
+        start.day,
+        tzinfo=timezone.get_current_timezone(),
+    )
+
+
+class QuotaSegment:
+    """
+    Open-addressing table of quota slots in a shared memory-mapped file,
+    guarded by a thread lock plus ``flock`` across processes.
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = slots * SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+        with self.locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _probe(self, key, pk, window):
+        start = (pk * 2654435761 + key * 40503 + window) % self.slots
+        for i in range(min(MAX_PROBES, self.slots)):
+            yield ((start + i) % self.slots) * SLOT.size
+
+    def _offset(self, key, pk, window):
+        for offset in self._probe(key, pk, window):
+            slot = SLOT.unpack_from(self._map, offset)
+            if slot[:3] == (key, pk, window):
+                return offset
+            if slot[0] == EMPTY:
+                return None
+        return None
+
+    def read(self, key, pk, window):
+        with self.locked():
+            offset = self._offset(key, pk, window)
+            if offset is None:
+                return None
+            return SLOT.unpack_from(self._map, offset)[3:]
+
+    def seed(self, key, pk, window, used):
+        with self.locked():
+            if self._offset(key, pk, window) is not None:
+                return
+            for offset in self._probe(key, pk, window):
+                if SLOT.unpack_from(self._map, offset)[0] in (EMPTY, DELETED):
+                    SLOT.pack_into(self._map, offset, key, pk, window, used, 0)
+                    return
+        raise SegmentFull()
+
+    def reset(self, key, pk, window, used):
+        with self.locked():
+            offset = self._offset(key, pk, window)
+            if offset is not None:
+                pending = SLOT.unpack_from(self._map, offset)[4]
+                SLOT.pack_into(
+                    self._map, offset, key, pk, window, used, pending
+                )
+
+    def forget(self, kind, pk):
+        """Drop every window of the account, flushed or not."""
+        with self.locked():
+            for index, slot in enumerate(SLOT.iter_unpack(self._map)):
+                key, slot_pk = slot[:2]
+                if key > EMPTY and slot_pk == pk and split_key(key)[0] == kind:
+                    SLOT.pack_into(
+                        self._map, index * SLOT.size, DELETED, 0, 0, 0, 0
+                    )
+
+    def consume(self, limits, threshold, count=1):
+        """
+        Take ``count`` calls from every ``(key, pk, window, limit)`` in
+        ``limits`` or from none of them. Returns whether a slot is due for
+        a flush and the calls left in each window.
+        """
+        with self.locked():
+            offsets = [
+                self._offset(key, pk, window) for key, pk, window, _ in limits
+            ]
+            if None in offsets:
+                raise SegmentFull()
+            slots = [SLOT.unpack_from(self._map, off) for off in offsets]
+            left = []
+            for (key, _, _, limit), slot in zip(limits, slots):
+                used, pending = slot[3:]
+                if used + pending + count > limit:
+                    raise QuotaExceeded(split_key(key)[0])
+                left.append(limit - used - pending - count)
+            due = False
+            for offset, (key, pk, window, used, pending) in zip(
+                offsets, slots
+            ):
+                SLOT.pack_into(
+                    self._map, offset, key, pk, window, used, pending + count
+                )
+                due = due or pending + count >= threshold
+            return due, left
+
+    def release(self, limits, count):
+        """Give back calls taken by ``consume`` that were not made."""
+        with self.locked():
+            for key, pk, window, _ in limits:
+                offset = self._offset(key, pk, window)
+                if offset is None:
+                    raise SegmentFull()
+                used, pending = SLOT.unpack_from(self._map, offset)[3:]
+                # Below zero once a flush already wrote them, the next
+                # flush takes them off the usage row again
+                SLOT.pack_into(
+                    self._map, offset, key, pk, window, used, pending - count
+                )
+
+    def drain(self, windows):
+        """
+        Move every pending count out of the segment for a flush. Flushed
+        slots of windows before ``windows`` are freed.
+        """
+        deltas = []
+        with self.locked():
+            for index, slot in enumerate(SLOT.iter_unpack(self._map)):
+                key, pk, window, used, pending = slot
+                if key <= EMPTY:
+                    continue
+                offset = index * SLOT.size
+                if pending != 0:
+                    SLOT.pack_into(
+                        self._map, offset, key, pk, window, used + pending, 0
+                    )
+                    deltas.append((key, pk, window, pending))
+                elif window < windows[split_key(key)[1]]:
+                    SLOT.pack_into(self._map, offset, DELETED, 0, 0, 0, 0)
+        return deltas
+
+    def restore(self, deltas):
+        with self.locked():
+            for key, pk, window, count in deltas:
+                offset = self._offset(key, pk, window)
+                if offset is not None:
+                    used, pending = SLOT.unpack_from(self._map, offset)[3:]
+                    SLOT.pack_into(
+                        self._map,
+                        offset,
+                        key,
+                        pk,
+                        window,
+                        used - count,
+                        pending + count,
+                    )
+
+    def tracked(self):
+        with self.locked():
+            return [
+                slot[:3]
+                for slot in SLOT.iter_unpack(self._map)
+                if slot[0] > EMPTY
+            ]
+
+
+def quota_settings():
+    return settings.PROXY_QUOTA
+
+
+def usage_model():
+    return apps.get_model("account", "QuotaUsage")
+
+
+def _chunks(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        yield items[start:end]
+
+
+class QuotaPlans:
+    """
+    ``{plan pk: (daily, monthly, total limit)}``, reloaded periodically.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self._plans = None
+        self._lock = threading.Lock()
+
+    def get(self, pk):
+        plans = self._plans
+        if plans is None or self._expired():
+            plans = self.rebuild()
+        return plans.get(pk)
+
+    def rebuild(self):
+        with self._lock:
+            if self._plans is not None and not self._expired():
+                return self._plans
+            plans = apps.get_model("account", "QuotaPlan").objects.values_list(
+                "pk", "daily_limit", "monthly_limit", "total_limit"
+            )
+            self._plans = {pk: limits for pk, *limits in plans}
+            self.loaded_at = time.monotonic()
+            return self._plans
+
+    def clear(self):
+        with self._lock:
+            self._plans = None
+            self.loaded_at = None
+
+    def _expired(self):
+        return time.monotonic() - self.loaded_at > self.refresh_interval
+
+
+class QuotaEngine:
+    def __init__(
+        self, path=None, slots=None, flush_interval=None, threshold=None
+    ):
+        conf = quota_settings()
+        self._path = path
+        self.slots = slots or conf["SLOTS"]
+        self.flush_interval = (
+            conf["FLUSH_INTERVAL"]
+            if flush_interval is None
+            else flush_interval
+        )
+        self.threshold = threshold or conf["FLUSH_THRESHOLD"]
+        self.refresh_interval = conf["REFRESH_INTERVAL"]
+        self._segment = None
+        self._pid = None
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    @property
+    def path(self):
+        return self._path or runtime.shared_path(quota_settings()["PATH"])
+
+    @property
+    def segment(self):
+        # A segment inherited over fork shares its flock with the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._segment = QuotaSegment(self.path, self.slots)
+                    self._pid = os.getpid()
+        return self._segment
+
+    @staticmethod
+    def limits(user, application, windows=None):
+        """``(key, pk, window, limit)`` of every limited account window."""
+        windows = windows or current_windows()
+        limits = []
+        for kind, account in ((USER, user), (APPLICATION, application)):
+            plan = account.plan_id and plans.get(account.plan_id)
+            if not plan:
+                continue
+            for period, limit in zip(PERIODS, plan):
+                if limit is not None:
+                    limits.append(
+                        (
+                            slot_key(kind, period),
+                            account.pk,
+                            windows[period],
+                            limit,
+                        )
+                    )
+        return limits
+
+    def charge(self, user, application, count=1):
+        """
+        Take ``count`` calls from the user's and the application's
+        quota. Returns the ``QuotaState`` of the tightest window, None
+        when neither is limited.
+        """
+        limits = self.limits(user, application)
+        if not limits:
+            return None
+        segment = self.segment
+        if self.flush_interval and self._flusher_pid != os.getpid():
+            self._start_flusher()
+        try:
+            for key, pk, window, _ in limits:
+                if segment.read(key, pk, window) is None:
+                    segment.seed(key, pk, window, self._load(key, pk, window))
+            due, left = segment.consume(limits, self.threshold, count)
+        except SegmentFull:
+            logger.warning("Quota segment %s is full", self.path)
+            return self._charge_directly(limits, count)
+        if due:
+            self._wakeup.set()
+        return _state(limits, left)
+
+    def release(self, user, application, count):
+        limits = self.limits(user, application)
+        if not limits:
+            return
+        try:
+            self.segment.release(limits, count)
+        except SegmentFull:
+            self._charge_directly(limits, -count)
+
+    def used(self, kind, pk, period):
+        """Calls counted in the current window, None when not tracked."""
+        slot = self.segment.read(
+            slot_key(kind, period), pk, current_windows()[period]
+        )
+        return None if slot is None else sum(slot)
+
+    def forget(self, kind, pk):
+        self.segment.forget(kind, pk)
+
+    def flush(self):
+        deltas = self.segment.drain(current_windows())
+        if not deltas:
+            return 0
+        groups = {}
+        for key, pk, window, count in deltas:
+            groups.setdefault((key, window), []).append((pk, count))
+        try:
+            with transaction.atomic():
+                for (key, window), rows in groups.items():
+                    for batch in _chunks(rows):
+                        self._write(key, window, batch)
+        except Exception:
+            self.segment.restore(deltas)
+            raise
+        return len(deltas)
+
+    def refresh(self):
+        """Re-read the usage of tracked windows, other hosts add to it."""
+        groups = {}
+        for key, pk, window in self.segment.tracked():
+            groups.setdefault((key, window), []).append(pk)
+        for (key, window), pks in groups.items():
+            kind, period = split_key(key)
+            for batch in _chunks(pks):
+                counts = dict(
+                    usage_model()
+                    .objects.filter(
+                        kind=kind,
+                        period=period,
+                        window=window,
+                        account_id__in=batch,
+                    )
+                    .values_list("account_id", "count")
+                )
+                for pk in batch:
+                    self.segment.reset(key, pk, window, counts.get(pk, 0))
+
+    @staticmethod
+    def _load(key, pk, window):
+        kind, period = split_key(key)
+        used = (
+            usage_model()
+            .objects.filter(
+                kind=kind, account_id=pk, period=period, window=window
+            )
+            .values_list("count", flat=True)
+            .first()
+        )
+        return used or 0
+
+    @staticmethod
+    def _write(key, window, rows):
+        kind, period = split_key(key)
+        usage = usage_model()
+        usage.objects.bulk_create(
+            (
+                usage(kind=kind, account_id=pk, period=period, window=window)
+                for pk, _ in rows
+            ),
+            ignore_conflicts=True,
+        )
+        delta = Case(
+            *(When(account_id=pk, then=Value(count)) for pk, count in rows),
+            output_field=IntegerField(),
+        )
+        usage.objects.filter(
+            kind=kind,
+            period=period,
+            window=window,
+            account_id__in=[pk for pk, _ in rows],
+        ).update(count=Greatest(F("count") + delta, 0))
+
+    @staticmethod
+    def _charge_directly(limits, count):
+        usage = usage_model()
+        with transaction.atomic():
+            for key, pk, window, limit in limits:
+                kind, period = split_key(key)
+                row = dict(
+                    kind=kind, account_id=pk, period=period, window=window
+                )
+                usage.objects.get_or_create(**row)
+                rows = usage.objects.filter(**row)
+                if count > 0:
+                    rows = rows.filter(count__lte=limit - count)
+                if not rows.update(count=Greatest(F("count") + count, 0)):
+                    raise QuotaExceeded(kind)
+        return None
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        thread = threading.Thread(
+            target=self._run, name="quota-flusher", daemon=True
+        )
+        thread.start()
+        atexit.register(self._flush_quietly)
+
+    def _run(self):
+        refreshed = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_quietly()
+            if time.monotonic() - refreshed >= self.refresh_interval:
+                refreshed = time.monotonic()
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Refreshing quota usage failed")
+                finally:
+                    connection.close()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing quota counters failed")
+        finally:
+            connection.close()
+
+
+def _state(limits, left):
+    index = min(range(len(left)), key=left.__getitem__)
+    key, _, window, limit = limits[index]
+    end = window_end(split_key(key)[1], window)
+    if end is None:
+        return QuotaState(limit, left[index], None)
+    reset = end - timezone.now()
+    return QuotaState(
+        limit, left[index], max(math.ceil(reset.total_seconds()), 0)
+    )
+
+
+plans = QuotaPlans(quota_settings()["REFRESH_INTERVAL"])
+quotas = QuotaEngine()
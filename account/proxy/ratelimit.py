@@ -0,0 +1,212 @@
+"""
+Token-bucket rate limits for the use-api proxy.
+
+Applications and APIs with a ``rate_limit`` get a bucket holding up to
+``rate_burst`` (default ``rate_limit``) calls, refilled at ``rate_limit``
+per ``rate_period`` seconds. The buckets live in a file-backed segment
+shared by all worker processes on the host, like the quota slots, and
+the limits come with the cached ``ApplicationRecord`` and ``CallRecord``,
+so a check never touches the database.
+
+A bucket only stores its tokens and when they were counted. A slot can
+therefore be handed to another bucket once the table is crowded: the
+least recently used slot in the probe window is taken over, and an idle
+bucket comes back full, as it would have refilled anyway.
+
+Tokens are counted against the wall clock: the segment outlives the
+workers, and a monotonic clock starts over when the host reboots. A
+bucket counted at a time the clock has not reached yet, after it was
+stepped back, comes back full too rather than waiting for the clock.
+"""
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from account import runtime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross-process locking
+    fcntl = None
+
+APPLICATION = 1
+API = 2
+EMPTY = 0
+
+# kind, pk, tokens, wall clock time the tokens were counted at
+BUCKET = struct.Struct("=qqdd")
+MAX_PROBES = 16
+
+# What the X-RateLimit-* headers report, for the tightest bucket
+RateLimit = namedtuple("RateLimit", ("limit", "remaining", "reset"))
+
+
+class RateLimited(Exception):
+    def __init__(self, state, wait):
+        super().__init__(wait)
+        self.state = state
+        self.wait = wait
+
+
+def ratelimit_settings():
+    return settings.PROXY_RATE_LIMIT
+
+
+def bucket(kind, pk, record):
+    """``(kind, pk, limit, refill per second, capacity)`` or None."""
+    if not record.rate_limit:
+        return None
+    return (
+        kind,
+        pk,
+        record.rate_limit,
+        record.rate_limit / record.rate_period,
+        record.rate_burst or record.rate_limit,
+    )
+
+
+def headers(state):
+    return {
+        "X-RateLimit-Limit": str(state.limit),
+        "X-RateLimit-Remaining": str(state.remaining),
+        "X-RateLimit-Reset": str(state.reset),
+    }
+
+
+class BucketSegment:
+    """Open-addressing table of buckets in a memory-mapped file."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = slots * BUCKET.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+        with self.locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot(self, kind, pk, capacity, now):
+        """Offset and current contents of the bucket, claiming a slot."""
+        start = (pk * 2654435761 + kind) % self.slots
+        oldest, oldest_stamp = None, None
+        for i in range(min(MAX_PROBES, self.slots)):
+            offset = ((start + i) % self.slots) * BUCKET.size
+            slot_kind, slot_pk, tokens, stamp = BUCKET.unpack_from(
+                self._map, offset
+            )
+            if slot_kind == kind and slot_pk == pk:
+                if stamp > now:
+                    return offset, float(capacity), now
+                return offset, tokens, stamp
+            if slot_kind == EMPTY:
+                return offset, float(capacity), now
+            if oldest is None or stamp < oldest_stamp:
+                oldest, oldest_stamp = offset, stamp
+        return oldest, float(capacity), now
+
+    def take(self, buckets, count=1):
+        """
+        Take ``count`` tokens from every bucket or from none of them.
+        Returns the ``RateLimit`` of the bucket with the fewest tokens
+        left, raises ``RateLimited`` with the seconds to wait otherwise.
+        """
+        now = time.time()
+        with self.locked():
+            states = []
+            for kind, pk, limit, rate, capacity in buckets:
+                offset, tokens, stamp = self._slot(kind, pk, capacity, now)
+                tokens = min(capacity, tokens + (now - stamp) * rate)
+                states.append(
+                    (offset, kind, pk, limit, rate, capacity, tokens)
+                )
+
+            short = [state for state in states if state[6] < count]
+            if short:
+                wait, state = max(
+                    ((count - state[6]) / state[4], state) for state in short
+                )
+                raise RateLimited(_rate_limit(state, state[6]), wait)
+
+            for offset, kind, pk, _, _, _, tokens in states:
+                BUCKET.pack_into(
+                    self._map, offset, kind, pk, tokens - count, now
+                )
+        tightest = min(states, key=lambda state: state[6])
+        return _rate_limit(tightest, tightest[6] - count)
+
+
+def _rate_limit(state, tokens):
+    _, _, _, limit, rate, capacity, _ = state
+    return RateLimit(
+        limit,
+        max(math.floor(tokens), 0),
+        math.ceil((capacity - tokens) / rate),
+    )
+
+
+class RateLimiter:
+    def __init__(self, path=None, slots=None):
+        conf = ratelimit_settings()
+        self._path = path
+        self.slots = slots or conf["SLOTS"]
+        self._segment = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path or runtime.shared_path(ratelimit_settings()["PATH"])
+
+    @property
+    def segment(self):
+        # A segment inherited over fork shares its flock with the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._segment = BucketSegment(self.path, self.slots)
+                    self._pid = os.getpid()
+        return self._segment
+
+    def acquire(self, application, call, count=1):
+        """
+        Take ``count`` calls from the application's and the API's bucket.
+        Returns None when neither is limited.
+        """
+        buckets = [
+            limit
+            for limit in (
+                bucket(APPLICATION, application.pk, application),
+                bucket(API, call.api_pk, call),
+            )
+            if limit is not None
+        ]
+        if not buckets:
+            return None
+        return self.segment.take(buckets, count)
+
+
+limiter = RateLimiter()
@@ -0,0 +1,192 @@
+"""
+Deadlines, retries and hedging around single upstream attempts.
+
+An attempt is a callable ``attempt(call, deadline)`` returning an
+``UpstreamResult`` or raising ``UpstreamFailed``. It connects and reads
+with ``deadline.timeout(call)`` and stops reading the body once the
+call's overall ``DEADLINE`` has passed.
+
+Hedging only applies to async calls: a sync attempt holds the calling
+thread until it settles, so a hedge could never answer first.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+
+from .service import UPSTREAM_ERROR
+
+IDEMPOTENT_METHODS = frozenset(("GET", "PUT", "DELETE"))
+RETRYABLE_STATUSES = frozenset((502, 503, 504))
+
+
+class UpstreamFailed(NotFound):
+    default_detail = UPSTREAM_ERROR
+
+
+def retry_settings():
+    return settings.PROXY_RETRY
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0)
+
+    def timeout(self, call):
+        conf = settings.PROXY_POOL
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise UpstreamFailed()
+        connect = call.connect_timeout or conf["CONNECT_TIMEOUT"]
+        read = call.read_timeout or conf["READ_TIMEOUT"]
+        return min(connect, remaining), min(read, remaining)
+
+
+class LatencyTracker:
+    """Recent successful attempt latencies per (api, endpoint)."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, call, seconds):
+        key = (call.api_pk, call.endpoint_pk)
+        with self._lock:
+            latencies = self._latencies.get(key)
+            if latencies is None:
+                latencies = self._latencies[key] = deque(maxlen=self.samples)
+            latencies.append(seconds)
+
+    def p95(self, call):
+        with self._lock:
+            latencies = sorted(
+                self._latencies.get((call.api_pk, call.endpoint_pk), ())
+            )
+        if len(latencies) < retry_settings()["HEDGE_MIN_SAMPLES"]:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+
+def retries_for(call):
+    if call.method not in IDEMPOTENT_METHODS:
+        return 0
+    return call.max_retries
+
+
+def hedges(call):
+    return call.hedged and call.method in IDEMPOTENT_METHODS
+
+
+def hedge_delay(call):
+    p95 = latencies.p95(call)
+    return retry_settings()["HEDGE_DELAY"] if p95 is None else p95
+
+
+def backoff(retry):
+    """Full jitter: a random pause up to the capped exponential step."""
+    conf = retry_settings()
+    step = min(conf["BACKOFF_BASE"] * 2**retry, conf["BACKOFF_MAX"])
+    return random.uniform(0, step)
+
+
+def _timed(attempt, call, deadline):
+    started = time.monotonic()
+    result = attempt(call, deadline)
+    latencies.record(call, time.monotonic() - started)
+    return result
+
+
+async def _atimed(attempt, call, deadline):
+    started = time.monotonic()
+    result = await attempt(call, deadline)
+    latencies.record(call, time.monotonic() - started)
+    return result
+
+
+def _winner(done, pending):
+    """The first successful attempt, or the last one if all of them failed."""
+    for future in done:
+        if future.exception() is None:
+            return future
+    return None if pending else next(iter(done))
+
+
+async def _ahedged(attempt, call, deadline):
+    first = asyncio.ensure_future(_atimed(attempt, call, deadline))
+    done, _ = await asyncio.wait([first], timeout=hedge_delay(call))
+    if done:
+        return first.result()
+    pending = {first, asyncio.ensure_future(_atimed(attempt, call, deadline))}
+    try:
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = _winner(done, pending)
+            if winner is not None:
+                return winner.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _retry_pause(result, error, retry, retries, deadline):
+    """The pause before the next try, or None when the call is settled."""
+    if error is None and result.status not in RETRYABLE_STATUSES:
+        return None
+    if retry >= retries:
+        return None
+    pause = backoff(retry)
+    return pause if pause < deadline.remaining() else None
+
+
+def run(call, attempt):
+    deadline = Deadline(retry_settings()["DEADLINE"])
+    retries = retries_for(call)
+    retry = 0
+    while True:
+        result = error = None
+        try:
+            result = _timed(attempt, call, deadline)
+        except UpstreamFailed as exc:
+            error = exc
+        pause = _retry_pause(result, error, retry, retries, deadline)
+        if pause is None:
+            if error is not None:
+                raise error
+            return result
+        time.sleep(pause)
+        retry += 1
+
+
+async def arun(call, attempt):
+    deadline = Deadline(retry_settings()["DEADLINE"])
+    retries = retries_for(call)
+    retry = 0
+    while True:
+        result = error = None
+        try:
+            if hedges(call):
+                result = await _ahedged(attempt, call, deadline)
+            else:
+                result = await _atimed(attempt, call, deadline)
+        except UpstreamFailed as exc:
+            error = exc
+        pause = _retry_pause(result, error, retry, retries, deadline)
+        if pause is None:
+            if error is not None:
+                raise error
+            return result
+        await asyncio.sleep(pause)
+        retry += 1
+
+
+latencies = LatencyTracker(settings.PROXY_RETRY["HEDGE_SAMPLES"])
@@ -0,0 +1,140 @@
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from account import metrics
+
+from .cache import LRUCache
+
+CachedResponse = namedtuple(
+    "CachedResponse", ("status", "content_type", "body")
+)
+
+
+class ResponseCache(LRUCache):
+    """
+    Upstream bodies of GET endpoints that opted in with ``cache_ttl``,
+    keyed by (api_pk, endpoint_pk), plus hit/miss counters per endpoint.
+    """
+
+    def __init__(self, max_entries, max_bytes, max_entry_bytes):
+        super().__init__(
+            max_entries,
+            0,
+            max_bytes=max_bytes,
+            sizeof=lambda cached: len(cached.body),
+        )
+        self.max_entry_bytes = max_entry_bytes
+        self._endpoints = {}
+        self._counter_lock = threading.Lock()
+
+    def lookup(self, call):
+        cached = self.get((call.api_pk, call.endpoint_pk))
+        self._count(call.endpoint_pk, cached is not None)
+        return cached
+
+    def store(self, call, status, content_type, body):
+        if 200 <= status < 300 and len(body) <= self.max_entry_bytes:
+            self.set(
+                (call.api_pk, call.endpoint_pk),
+                CachedResponse(status, content_type, body),
+                ttl=call.cache_ttl,
+            )
+
+    def endpoint_stats(self, endpoint_pk):
+        hits, misses = self._endpoints.get(endpoint_pk, (0, 0))
+        return {"hits": hits, "misses": misses}
+
+    def _count(self, endpoint_pk, hit):
+        with self._counter_lock:
+            hits, misses = self._endpoints.get(endpoint_pk, (0, 0))
+            self._endpoints[endpoint_pk] = (
+                (hits + 1, misses) if hit else (hits, misses + 1)
+            )
+
+
+class Collector:
+    """Buffers a relayed body and caches it once it arrived completely."""
+
+    def __init__(self, call, status, content_type):
+        self.call = call
+        self.status = status
+        self.content_type = content_type
+        self.size = 0
+        self.parts = []
+
+    def feed(self, chunk):
+        if self.parts is None:
+            return
+        self.size += len(chunk)
+        if self.size > responses.max_entry_bytes:
+            self.parts = None
+        else:
+            self.parts.append(chunk)
+
+    def finish(self):
+        if self.parts is not None:
+            responses.store(
+                self.call, self.status, self.content_type, b"".join(self.parts)
+            )
+
+
+def is_cacheable(call):
+    return call.method == "GET" and call.cache_ttl > 0
+
+
+def lookup(call):
+    if is_cacheable(call):
+        cached = responses.lookup(call)
+        metrics.proxy_cache.inc(
+            call.api_pk, call.endpoint_pk, "miss" if cached is None else "hit"
+        )
+        return cached
+    return None
+
+
+def store(call, status, content_type, body):
+    if is_cacheable(call):
+        responses.store(call, status, content_type, body)
+
+
+def collector(call, status, content_type):
+    if is_cacheable(call):
+        return Collector(call, status, content_type)
+    return None
+
+
+def hit_response(cached):
+    response = HttpResponse(
+        cached.body, status=cached.status, content_type=cached.content_type
+    )
+    response["X-Cache"] = "HIT"
+    return response
+
+
+def mark(call, response):
+    if is_cacheable(call):
+        response["X-Cache"] = "MISS"
+    return response
+
+
+def forget_api(pk):
+    responses.discard_where(lambda key, cached: key[0] == pk)
+
+
+def forget_apis(pks):
+    pks = set(pks)
+    responses.discard_where(lambda key, cached: key[0] in pks)
+
+
+def forget_endpoint(pk):
+    responses.discard_where(lambda key, cached: key[1] == pk)
+
+
+responses = ResponseCache(
+    settings.PROXY_RESPONSE_CACHE["MAX_ENTRIES"],
+    settings.PROXY_RESPONSE_CACHE["MAX_BYTES"],
+    settings.PROXY_RESPONSE_CACHE["MAX_ENTRY_BYTES"],
+)
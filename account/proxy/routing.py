@@ -0,0 +1,207 @@
+"""
+Routing table for the use-api proxy: every (api, endpoint) pair linked
+through ``API.endpoints`` mapped to a prejoined ``CallRecord``.
+
+The table is loaded with one query on first use and patched per API or
+endpoint from model and ``m2m_changed`` signals. Signals only reach the
+current process, so it is also reloaded every ``REFRESH_INTERVAL``, by a
+background thread while lookups keep using the expired table.
+
+Patches go into the table in place, new records before stale ones are
+dropped, so a lookup finds the old or the new record of a route but
+never neither. Patches made while a reload runs its query are replayed
+onto the new table before it replaces the old one.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+CallRecord = namedtuple(
+    "CallRecord",
+    (
+        "api_pk",
+        "endpoint_pk",
+        "application_pk",
+        "method",
+        "url",
+        "is_public",
+        "cache_ttl",
+        "connect_timeout",
+        "read_timeout",
+        "max_retries",
+        "hedged",
+        "rate_limit",
+        "rate_period",
+        "rate_burst",
+    ),
+)
+
+
+def load_routes(**filters):
+    from account.models import API, EndpointChoices
+
+    rows = API.endpoints.through.objects.filter(**filters).values_list(
+        "api_id",
+        "endpoint_id",
+        "api__parent_id",
+        "endpoint__method",
+        "api__base_url",
+        "endpoint__url",
+        "api__is_public",
+        "endpoint__cache_ttl",
+        "endpoint__connect_timeout",
+        "api__connect_timeout",
+        "endpoint__read_timeout",
+        "api__read_timeout",
+        "endpoint__max_retries",
+        "endpoint__hedged",
+        "api__rate_limit",
+        "api__rate_period",
+        "api__rate_burst",
+    )
+    for row in rows.iterator():
+        (
+            api_pk,
+            endpoint_pk,
+            application_pk,
+            method,
+            base_url,
+            url,
+            is_public,
+            cache_ttl,
+            connect_timeout,
+            api_connect_timeout,
+            read_timeout,
+            api_read_timeout,
+            max_retries,
+            hedged,
+            rate_limit,
+            rate_period,
+            rate_burst,
+        ) = row
+        yield CallRecord(
+            api_pk,
+            endpoint_pk,
+            application_pk,
+            EndpointChoices(method).label,
+            f"{base_url}{url}",
+            is_public,
+            cache_ttl,
+            connect_timeout or api_connect_timeout,
+            read_timeout or api_read_timeout,
+            max_retries,
+            hedged,
+            rate_limit,
+            rate_period,
+            rate_burst,
+        )
+
+
+def patch(routes, stale, records):
+    """Replace the routes whose key is ``stale`` by ``records``."""
+    fresh = {(record.api_pk, record.endpoint_pk): record for record in records}
+    routes.update(fresh)
+    for key in [key for key in routes if stale(key) and key not in fresh]:
+        del routes[key]
+
+
+class RoutingTable:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self._routes = None
+        # Patches since the running rebuild started its query, if any
+        self._patches = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def get(self, api_pk, endpoint_pk):
+        routes = self._routes
+        if routes is None:
+            routes = self.rebuild()
+        elif self._expired():
+            self._refresh_in_background()
+        return routes.get((api_pk, endpoint_pk))
+
+    def rebuild(self):
+        with self._load_lock:
+            if self._routes is not None and not self._expired():
+                return self._routes
+            with self._lock:
+                self._patches = []
+            try:
+                routes = {
+                    (record.api_pk, record.endpoint_pk): record
+                    for record in load_routes()
+                }
+                with self._lock:
+                    for stale, records in self._patches:
+                        patch(routes, stale, records)
+                    self._routes = routes
+                    self.loaded_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._patches = None
+            return routes
+
+    def reload_api(self, pk):
+        self._replace(lambda key: key[0] == pk, load_routes(api_id=pk))
+
+    def reload_apis(self, pks):
+        pks = set(pks)
+        self._replace(lambda key: key[0] in pks, load_routes(api_id__in=pks))
+
+    def reload_endpoint(self, pk):
+        self._replace(lambda key: key[1] == pk, load_routes(endpoint_id=pk))
+
+    def drop_api(self, pk):
+        self._replace(lambda key: key[0] == pk, ())
+
+    def drop_endpoint(self, pk):
+        self._replace(lambda key: key[1] == pk, ())
+
+    def clear(self):
+        with self._lock:
+            self._routes = None
+            self.loaded_at = None
+
+    def _expired(self):
+        return time.monotonic() - self.loaded_at > self.refresh_interval
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._refresh, name="routing-refresh", daemon=True
+        ).start()
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Reloading the routing table failed")
+        finally:
+            self._refreshing = False
+            connection.close()
+
+    def _replace(self, stale, records):
+        if self._routes is None and self._patches is None:
+            return
+        records = list(records)
+        with self._lock:
+            if self._patches is not None:
+                self._patches.append((stale, records))
+            if self._routes is not None:
+                patch(self._routes, stale, records)
+
+
+routes = RoutingTable(settings.PROXY_ROUTING["REFRESH_INTERVAL"])
@@ -0,0 +1,114 @@
+from rest_framework.exceptions import NotAcceptable, NotFound, Throttled
+
+from account import metrics, timing
+from account.models import Application, User
+
+from . import bloom, cache, quota, ratelimit, routing
+from .quota import USER, QuotaExceeded
+from .ratelimit import RateLimited
+
+UPSTREAM_ERROR = "Not found.Validate your url and method type."
+
+
+def application_record(token):
+    if not token:
+        return None
+    record = cache.tokens.get(token)
+    metrics.lookup_cache.inc("tokens", "miss" if record is None else "hit")
+    if record is None:
+        if not bloom.token_filter.might_contain(token):
+            metrics.token_filter.inc("rejected")
+            return None
+        app = (
+            Application.objects.filter(token=token)
+            .values_list(*cache.ApplicationRecord._fields)
+            .first()
+        )
+        if app is None:
+            metrics.token_filter.inc("false_positive")
+            return None
+        record = cache.ApplicationRecord(*app)
+        cache.tokens.set(token, record)
+    return record
+
+
+def owner_record(pk):
+    record = cache.owners.get(pk)
+    metrics.lookup_cache.inc("owners", "miss" if record is None else "hit")
+    if record is None:
+        owner = (
+            User.objects.filter(pk=pk)
+            .values_list(*cache.OwnerRecord._fields)
+            .first()
+        )
+        if owner is None:
+            return None
+        record = cache.OwnerRecord(*owner)
+        cache.owners.set(pk, record)
+    return record
+
+
+def call_record(api_pk, endpoint_pk):
+    return routing.routes.get(api_pk, endpoint_pk)
+
+
+def resolve_call(api_pk, endpoint_pk, token):
+    with timing.phase("resolve"):
+        call = call_record(api_pk, endpoint_pk)
+        application = None if call is None else application_record(token)
+    if application is not None and application.pk == call.application_pk:
+        return application, call
+    raise NotFound(detail="Not found.", code=404)
+
+
+class RateLimitExceeded(Throttled):
+    def __init__(self, rate_limit, wait):
+        super().__init__(wait=wait)
+        self.rate_limit = rate_limit
+
+
+def check_rate(application, call):
+    """
+    Take one call from the rate limits of ``application`` and the API.
+    Returns the ``RateLimit`` to report, None when neither is limited.
+    """
+    try:
+        with timing.phase("rate"):
+            return ratelimit.limiter.acquire(application, call)
+    except RateLimited as exc:
+        metrics.rate_limited.inc(call.api_pk)
+        raise RateLimitExceeded(exc.state, exc.wait)
+
+
+def charge_request(user, application, count=1):
+    """
+    Take ``count`` calls from the quotas of ``user`` and ``application``.
+    Returns the ``QuotaState`` to report, None when neither is limited.
+    """
+    try:
+        with timing.phase("quota"):
+            return quota.quotas.charge(user, application, count)
+    except QuotaExceeded as exc:
+        metrics.quota_rejections.inc(
+            "user" if exc.kind == USER else "application"
+        )
+        if exc.kind == USER:
+            detail = "The limit of your requests has been reached."
+        else:
+            detail = "The limit of requests to applications has been reached."
+        raise NotAcceptable(detail=detail, code=406)
+
+
+def refund_request(user, application, count):
+    if count:
+        quota.quotas.release(user, application, count)
+
+
+def with_quota(response, state):
+    if state is not None:
+        response["X-Quota-Limit"] = str(state.limit)
+        response["X-Quota-Remaining"] = str(state.remaining)
+        # Totals never reset
+        if state.reset is not None:
+            response["X-Quota-Reset"] = str(state.reset)
+    return response
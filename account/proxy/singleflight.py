@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from django.conf import settings
+
+
+def normalized_query(url):
+    return urlencode(sorted(parse_qsl(urlsplit(url).query, True)))
+
+
+def flight_key(call):
+    return (
+        call.api_pk,
+        call.endpoint_pk,
+        call.method,
+        normalized_query(call.url),
+    )
+
+
+def applies(call):
+    # Only idempotent reads may share one upstream response
+    return settings.PROXY_SINGLE_FLIGHT and call.method == "GET"
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution whose
+    result (or exception) every caller shares. ``do`` serves threads,
+    ``ado`` coroutines on the same event loop. ``ado`` runs the call in a
+    task of its own, so a caller that is cancelled, say by a client
+    disconnect, leaves it running for the others.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._tasks = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key, fn):
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get((loop, key))
+        if task is None:
+            task = self._tasks[(loop, key)] = loop.create_task(fn())
+            task.add_done_callback(functools.partial(self._land, loop, key))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        return await asyncio.shield(task)
+
+    def _land(self, loop, key, task):
+        del self._tasks[(loop, key)]
+        if not task.cancelled():
+            # Mark it retrieved, the callers re-raise it if any are left
+            task.exception()
+
+    def stats(self):
+        return {"leaders": self.leaders, "followers": self.followers}
+
+
+flights = SingleFlight()
@@ -0,0 +1,122 @@
+import logging
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamTooLarge(APIException):
+    status_code = 502
+    default_detail = "Upstream response exceeds the size limit."
+    default_code = "upstream_too_large"
+
+
+def streaming_settings():
+    return settings.PROXY_STREAMING
+
+
+def is_enabled():
+    return streaming_settings()["ENABLED"]
+
+
+def relay_headers(upstream_headers, content_length=None):
+    headers = {}
+    if "content-type" in upstream_headers:
+        headers["Content-Type"] = upstream_headers["content-type"]
+    # Bodies are relayed decoded, so an encoded upstream length is wrong
+    if content_length is None and "content-encoding" not in upstream_headers:
+        content_length = upstream_headers.get("content-length")
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+    return headers
+
+
+def check_declared_size(upstream_headers):
+    cap = streaming_settings()["MAX_BODY_SIZE"]
+    declared = upstream_headers.get("content-length")
+    if cap and declared and declared.isdigit() and int(declared) > cap:
+        raise UpstreamTooLarge()
+
+
+def _capped(chunks, url, collector=None):
+    cap = streaming_settings()["MAX_BODY_SIZE"]
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if cap and total > cap:
+            # Headers are already sent, the only option left is to cut
+            logger.warning("Truncated upstream response from %s", url)
+            return
+        if collector is not None:
+            collector.feed(chunk)
+        yield chunk
+    if collector is not None:
+        collector.finish()
+
+
+def stream_response(response, collector=None):
+    """
+    Relay a ``requests`` response opened with ``stream=True`` chunk by
+    chunk, closing the upstream connection once the client is served.
+    A ``collector`` sees every chunk and the end of a complete body.
+    """
+    chunk_size = streaming_settings()["CHUNK_SIZE"]
+
+    def content():
+        try:
+            yield from _capped(
+                response.iter_content(chunk_size), response.url, collector
+            )
+        finally:
+            response.close()
+
+    return StreamingHttpResponse(
+        content(),
+        status=response.status_code,
+        headers=relay_headers(response.headers),
+    )
+
+
+async def spool_response(response, collector=None):
+    """
+    Drain an ``httpx`` response opened with ``stream=True`` into a spooled
+    file. Django 4.0 iterates streaming bodies synchronously on the event
+    loop, so async upstream bodies are spooled (in memory up to
+    ``SPOOL_MAX_MEMORY``, on disk beyond) rather than held whole.
+    """
+    conf = streaming_settings()
+    check_declared_size(response.headers)
+    spool = SpooledTemporaryFile(max_size=conf["SPOOL_MAX_MEMORY"])
+    size = 0
+    try:
+        async for chunk in response.aiter_bytes(conf["CHUNK_SIZE"]):
+            size += len(chunk)
+            if conf["MAX_BODY_SIZE"] and size > conf["MAX_BODY_SIZE"]:
+                raise UpstreamTooLarge()
+            spool.write(chunk)
+            if collector is not None:
+                collector.feed(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    if collector is not None:
+        collector.finish()
+    spool.seek(0)
+    return spool, size
+
+
+def spooled_response(response, spool, size):
+    chunk_size = streaming_settings()["CHUNK_SIZE"]
+
+    def content():
+        with spool:
+            yield from iter(lambda: spool.read(chunk_size), b"")
+
+    return StreamingHttpResponse(
+        content(),
+        status=response.status_code,
+        headers=relay_headers(response.headers, content_length=size),
+    )
@@ -0,0 +1,29 @@
+"""
+Files shared by the worker processes on a host: the token filter, the
+quota and rate limit segments and the metrics snapshots. Relative paths
+are resolved in a directory per database under
+``SHARED_STATE_DIRECTORY``, like the ``authcache`` keys carry the
+database name, so a staging database or a test run on the same host
+never reads or writes the files of another.
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import connections
+
+
+def namespace(name):
+    """Directory name of the database called ``name``."""
+    return hashlib.sha1(str(name).encode()).hexdigest()[:12]
+
+
+def shared_path(path):
+    """``path`` in the directory of the database in use, absolute as is."""
+    if os.path.isabs(path):
+        return path
+    # The test runner renames the database once settings are loaded
+    name = connections["default"].settings_dict["NAME"]
+    directory = os.path.join(settings.SHARED_STATE_DIRECTORY, namespace(name))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, path)
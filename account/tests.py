@@ -1,3 +1,2589 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from account import authcache, loadtest, metrics, middleware, runtime
+from account.catalog import pages
+from account.catalog import search as catalog_search
+from account.catalog.search import catalog, highlight
+from account.api import serializers as api_serializers
+from account.api.views import CursorPaginationByTen
+from account.models import (
+    API,
+    Application,
+    Category,
+    Endpoint,
+    QuotaPlan,
+    QuotaUsage,
+    User,
+)
+from account.proxy import (
+    bloom,
+    breaker,
+    cache,
+    gateway,
+    pool,
+    quota,
+    ratelimit,
+    resilience,
+    responses,
+    routing,
+    service,
+    singleflight,
+)
+from account.proxy.quota import (
+    APPLICATION,
+    DAY,
+    MONTH,
+    TOTAL,
+    USER,
+    QuotaEngine,
+    QuotaExceeded,
+    QuotaSegment,
+    current_windows,
+    slot_key,
+)
+
+
+def _temp_segment_path(test):
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    return os.path.join(directory.name, "quota.seg")
+
+
+def _patch(test, target, name, value):
+    patcher = mock.patch.object(target, name, value)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return value
+
+
+def _temp_auth_cache(test):
+    caches = dict(
+        settings.CACHES,
+        auth={
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": test.id(),
+        },
+    )
+    override = override_settings(CACHES=caches)
+    override.enable()
+    test.addCleanup(override.disable)
+
+
+class SharedStateTestCase(TestCase):
+    """
+    Points the quota and rate limit segments, the token filter, metrics
+    snapshots and the auth cache at temporary files, so neither proxied
+    calls nor signal receivers touch those of a server on the host.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.quotas = _patch(
+            self,
+            quota,
+            "quotas",
+            QuotaEngine(
+                path=os.path.join(directory.name, "quota.seg"),
+                flush_interval=0,
+            ),
+        )
+        self.token_filter = _patch(
+            self,
+            bloom,
+            "token_filter",
+            bloom.TokenFilter(
+                path=os.path.join(directory.name, "tokens.bloom"),
+                capacity=1000,
+                error_rate=0.01,
+            ),
+        )
+        _patch(
+            self,
+            ratelimit,
+            "limiter",
+            ratelimit.RateLimiter(
+                path=os.path.join(directory.name, "rates.seg"), slots=64
+            ),
+        )
+        override = override_settings(
+            METRICS=dict(
+                settings.METRICS,
+                DIRECTORY=os.path.join(directory.name, "metrics"),
+            )
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        _temp_auth_cache(self)
+
+
+def _consume_in_process(path, attempts, admitted):
+    segment = QuotaSegment(path, 64)
+    count = 0
+    for _ in range(attempts):
+        try:
+            segment.consume([(APP_MONTH, 1, 1, 250)], threshold=10**9)
+            count += 1
+        except QuotaExceeded:
+            pass
+    admitted.put(count)
+
+
+APP_MONTH = slot_key(APPLICATION, MONTH)
+USER_DAY = slot_key(USER, DAY)
+
+
+class QuotaSegmentTests(SimpleTestCase):
+    def setUp(self):
+        self.path = _temp_segment_path(self)
+        self.segment = QuotaSegment(self.path, 64)
+        self.addCleanup(self.segment.close)
+
+    def test_processes_never_overspend(self):
+        self.segment.seed(APP_MONTH, 1, 1, 0)
+        context = multiprocessing.get_context("fork")
+        admitted = context.Queue()
+        workers = [
+            context.Process(
+                target=_consume_in_process, args=(self.path, 100, admitted)
+            )
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        total = sum(admitted.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(total, 250)
+        self.assertEqual(self.segment.read(APP_MONTH, 1, 1), (0, 250))
+
+    def test_consume_is_all_or_nothing(self):
+        self.segment.seed(USER_DAY, 1, 1, 0)
+        self.segment.seed(APP_MONTH, 1, 1, 7)
+
+        with self.assertRaises(QuotaExceeded) as raised:
+            self.segment.consume(
+                [(USER_DAY, 1, 1, 5), (APP_MONTH, 1, 1, 7)], 10
+            )
+
+        self.assertEqual(raised.exception.kind, APPLICATION)
+        self.assertEqual(self.segment.read(USER_DAY, 1, 1), (0, 0))
+
+    def test_drain_frees_flushed_past_windows(self):
+        self.segment.seed(USER_DAY, 1, 1, 0)
+        self.segment.consume([(USER_DAY, 1, 1, 5)], 10)
+
+        self.assertEqual(
+            self.segment.drain({DAY: 2, MONTH: 1}), [(USER_DAY, 1, 1, 1)]
+        )
+        self.assertEqual(self.segment.read(USER_DAY, 1, 1), (1, 0))
+        self.assertEqual(self.segment.drain({DAY: 2, MONTH: 1}), [])
+        self.assertIsNone(self.segment.read(USER_DAY, 1, 1))
+
+
+class QuotaEngineTests(SharedStateTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = QuotaEngine(
+            path=_temp_segment_path(self), flush_interval=0, threshold=10
+        )
+        self.user = User.objects.create_user(
+            "developer@example.com", "password"
+        )
+        self.app = Application.objects.get(owner=self.user)
+        self.app.plan = QuotaPlan.objects.create(
+            name="Starter", monthly_limit=120
+        )
+        self.app.save()
+
+    def usage(self, kind, pk, period):
+        return (
+            QuotaUsage.objects.filter(
+                kind=kind,
+                account_id=pk,
+                period=period,
+                window=current_windows()[period],
+            )
+            .values_list("count", flat=True)
+            .first()
+        )
+
+    def test_concurrent_charges_flush_exact_deltas(self):
+        self.engine.charge(self.user, self.app)
+        admitted = []
+
+        def charge_many():
+            count = 0
+            for _ in range(50):
+                try:
+                    self.engine.charge(self.user, self.app)
+                    count += 1
+                except QuotaExceeded:
+                    pass
+            admitted.append(count)
+
+        threads = [threading.Thread(target=charge_many) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(admitted) + 1, 120)
+        self.assertEqual(self.engine.flush(), 1)
+        self.assertEqual(self.usage(APPLICATION, self.app.pk, MONTH), 120)
+        self.assertFalse(QuotaUsage.objects.filter(kind=USER).exists())
+        with self.assertRaises(QuotaExceeded):
+            self.engine.charge(self.user, self.app)
+
+    def test_failed_flush_keeps_pending_counts(self):
+        for _ in range(3):
+            self.engine.charge(self.user, self.app)
+
+        with mock.patch.object(
+            QuotaEngine, "_write", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            self.engine.flush()
+
+        self.assertEqual(self.engine.used(APPLICATION, self.app.pk, MONTH), 3)
+        self.engine.flush()
+        self.assertEqual(self.usage(APPLICATION, self.app.pk, MONTH), 3)
+
+    def test_refresh_picks_up_database_changes(self):
+        self.engine.charge(self.user, self.app)
+        self.engine.flush()
+        QuotaUsage.objects.filter(kind=APPLICATION).update(count=100)
+
+        self.engine.refresh()
+
+        self.assertEqual(
+            self.engine.used(APPLICATION, self.app.pk, MONTH), 100
+        )
+
+    def test_new_day_starts_a_new_window(self):
+        self.user.plan = QuotaPlan.objects.create(name="Daily", daily_limit=2)
+        self.user.save()
+        today = timezone.localdate()
+        state = self.engine.charge(self.user, self.app)
+        self.assertEqual(state.limit, 2)
+        self.assertEqual(state.remaining, 1)
+        self.engine.charge(self.user, self.app)
+        with self.assertRaises(QuotaExceeded) as raised:
+            self.engine.charge(self.user, self.app)
+        self.assertEqual(raised.exception.kind, USER)
+
+        tomorrow = today + datetime.timedelta(days=1)
+        with mock.patch.object(
+            quota.timezone, "localdate", return_value=tomorrow
+        ):
+            self.assertEqual(
+                self.engine.charge(self.user, self.app).remaining, 1
+            )
+            self.engine.flush()
+        self.assertEqual(
+            sorted(
+                QuotaUsage.objects.filter(kind=USER).values_list(
+                    "window", "count"
+                )
+            ),
+            [(today.toordinal(), 2), (tomorrow.toordinal(), 1)],
+        )
+
+    def test_totals_never_roll_over(self):
+        self.app.plan = QuotaPlan.objects.create(
+            name="Legacy 2 in total", total_limit=2
+        )
+        self.app.save()
+        state = self.engine.charge(self.user, self.app)
+        self.assertEqual((state.limit, state.remaining), (2, 1))
+        self.assertIsNone(state.reset)
+        self.engine.charge(self.user, self.app)
+        self.engine.flush()
+
+        next_year = timezone.localdate() + datetime.timedelta(days=400)
+        with mock.patch.object(
+            quota.timezone, "localdate", return_value=next_year
+        ), self.assertRaises(QuotaExceeded):
+            self.engine.charge(self.user, self.app)
+        self.assertEqual(self.usage(APPLICATION, self.app.pk, TOTAL), 2)
+
+
+class _Upstream(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/drip"):
+            return self.drip()
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        # Without a length the body ends when the connection closes
+        if not self.path.startswith("/unsized"):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def drip(self):
+        # A byte every 50ms, each read well within its timeout
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        try:
+            for _ in range(40):
+                self.wfile.write(b" ")
+                self.wfile.flush()
+                time.sleep(0.05)
+            self.wfile.write(b"[1]")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(
+    QUERY_BUDGET={"ENABLED": True, "RAISE": True, "HEADERS": False}
+)
+class QueryBudgetTests(SharedStateTestCase):
+    """
+    Pins the queries every route in account/api/urls.py runs against a
+    catalog of 50 APIs with 4 endpoints each. Routes served from
+    in-process caches are pinned once those are warm.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = ThreadingHTTPServer(("127.0.0.1", 0), _Upstream)
+        threading.Thread(
+            target=cls.upstream.serve_forever, daemon=True
+        ).start()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.upstream.shutdown()
+        cls.upstream.server_close()
+
+    @classmethod
+    def setUpTestData(cls):
+        base_url = f"http://127.0.0.1:{cls.upstream.server_port}"
+        categories = Category.objects.bulk_create(
+            Category(name=f"category-{i}") for i in range(5)
+        )
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+        cls.app = Application.objects.get(owner=cls.user)
+        Application.objects.bulk_create(
+            Application(owner=cls.user, name=f"app-{i}", token=f"token-{i}")
+            for i in range(10)
+        )
+        other = User.objects.create_user(
+            "other@example.com", "password", is_active=True
+        )
+        other_app = Application.objects.get(owner=other)
+        apis = API.objects.bulk_create(
+            API(
+                parent=cls.app if i % 2 else other_app,
+                owner=cls.user if i % 2 else other,
+                category=categories[i % 5],
+                name=f"weather api {i}",
+                short_description="Forecasts",
+                base_url=base_url,
+            )
+            for i in range(50)
+        )
+        endpoints = Endpoint.objects.bulk_create(
+            Endpoint(url=f"/{i}", name=f"endpoint {i}", description="d")
+            for i in range(200)
+        )
+        API.endpoints.through.objects.bulk_create(
+            API.endpoints.through(api=api, endpoint=endpoints[i * 4 + j])
+            for i, api in enumerate(apis)
+            for j in range(4)
+        )
+        cls.api = apis[1]
+        cls.endpoint = endpoints[4]
+
+    def setUp(self):
+        super().setUp()
+        routing.routes.clear()
+        catalog.clear()
+        cache.tokens.clear()
+        pages.pages.clear()
+        self.login(self.user)
+
+    def login(self, user):
+        # Steady state: the session and its user come from the auth cache
+        self.client.force_login(user)
+        authcache.cache_user(user)
+
+    def assertQueries(self, count, method, url, status=200, **kwargs):
+        with self.assertNumQueries(count):
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertEqual(response.status_code, status, response.content)
+        return response
+
+    def test_app_list(self):
+        self.assertQueries(2, "get", reverse("app-list"))
+
+    def test_app_create(self):
+        self.assertQueries(
+            1, "post", reverse("app-create"), 201, data={"name": "new"}
+        )
+
+    def test_app_detail(self):
+        url = reverse("app-detail", args=[self.app.pk])
+        self.assertQueries(3, "get", url)
+        self.assertQueries(
+            2,
+            "patch",
+            url,
+            data={"name": "renamed"},
+            content_type="application/json",
+        )
+
+    def test_app_detail_of_other_owner(self):
+        self.login(User.objects.get(email="other@example.com"))
+        url = reverse("app-detail", args=[self.app.pk])
+        self.assertQueries(1, "get", url, 404)
+
+    def test_api_list(self):
+        self.assertQueries(4, "get", reverse("api-list", args=[self.app.pk]))
+
+    def test_api_list_cursor_pages(self):
+        url = reverse("api-list", args=[self.app.pk])
+        seen = []
+        response = self.assertQueries(
+            3, "get", url, data={"cursor": "", "limit": 10}
+        )
+        while True:
+            body = response.json()
+            self.assertNotIn("count", body)
+            seen.extend(api["id"] for api in body["results"])
+            if body["next"] is None:
+                break
+            # Deep pages cost as much as the first one
+            response = self.assertQueries(3, "get", body["next"])
+
+        self.assertEqual(
+            seen,
+            list(self.app.apis.order_by("pk").values_list("pk", flat=True)),
+        )
+        previous = self.client.get(body["previous"]).json()
+        self.assertEqual(
+            [api["id"] for api in previous["results"]], seen[-15:-5]
+        )
+
+    def test_cursor_counts(self):
+        url = reverse("app-list")
+        exact = self.client.get(url, {"cursor": "", "count": "exact"}).json()
+        self.assertEqual((exact["count"], exact["count_is_exact"]), (11, True))
+        with mock.patch.object(
+            CursorPaginationByTen, "approximate_count_cap", 5
+        ):
+            approximate = self.client.get(
+                url, {"cursor": "", "count": "approximate"}
+            ).json()
+        self.assertEqual(
+            (approximate["count"], approximate["count_is_exact"]), (5, False)
+        )
+        self.assertQueries(0, "get", url, 404, data={"cursor": "nope"})
+
+    def test_search_cursor_pages(self):
+        url = reverse("search-list")
+        first = self.client.get(url, {"search": "weather", "cursor": ""})
+        second = self.client.get(first.json()["next"])
+
+        everything = self.client.get(url, {"search": "weather"}).json()
+        self.assertEqual(
+            first.json()["results"] + second.json()["results"],
+            everything[:20],
+        )
+
+    def test_api_create(self):
+        self.assertQueries(
+            3,
+            "post",
+            reverse("api-create", args=[self.app.pk]),
+            201,
+            data={
+                "category": self.api.category_id,
+                "name": "new",
+                "short_description": "new",
+                "base_url": "http://127.0.0.1:9",
+            },
+        )
+
+    def test_api_detail(self):
+        url = reverse("api-detail", args=[self.app.pk, self.api.pk])
+        self.assertQueries(2, "get", url)
+        self.assertQueries(
+            3,
+            "patch",
+            url,
+            data={"name": "renamed"},
+            content_type="application/json",
+        )
+
+    def test_api_health(self):
+        self.assertQueries(1, "get", reverse("api-health", args=[self.api.pk]))
+
+    def test_endpoint_list(self):
+        url = reverse("endpoint-list", args=[self.api.pk])
+        self.assertQueries(2, "get", url)
+        self.assertQueries(
+            4,
+            "post",
+            url,
+            201,
+            data={"url": "/new", "name": "new", "description": "new"},
+        )
+
+    def test_endpoint_detail(self):
+        url = reverse("endpoint-detail", args=[self.api.pk, self.endpoint.pk])
+        self.assertQueries(1, "get", url)
+        self.assertQueries(
+            2,
+            "patch",
+            url,
+            data={"name": "renamed"},
+            content_type="application/json",
+        )
+
+    def test_deletes(self):
+        self.assertQueries(
+            3,
+            "delete",
+            reverse("endpoint-detail", args=[self.api.pk, self.endpoint.pk]),
+            204,
+        )
+        self.assertQueries(
+            4,
+            "delete",
+            reverse("api-detail", args=[self.app.pk, self.api.pk]),
+            204,
+        )
+        self.assertQueries(
+            6, "delete", reverse("app-detail", args=[self.app.pk]), 204
+        )
+
+    def test_use_api(self):
+        url = reverse("use-api", args=[self.api.pk, self.endpoint.pk])
+        data = {"token": self.app.token}
+        self.client.post(url, data)
+        self.assertQueries(0, "post", url, data=data)
+        # Unknown tokens are turned away by the token filter
+        self.assertQueries(0, "post", url, 404, data={"token": "unknown"})
+        # Header authentication loads neither the session nor the user
+        header = {"HTTP_AUTHORIZATION": f"Token {self.app.token}"}
+        self.client.post(url, **header)
+        self.assertQueries(0, "post", url, **header)
+
+    def test_use_api_batch(self):
+        url = reverse("use-api-batch")
+        data = {
+            "token": self.app.token,
+            "calls": [{"api_pk": self.api.pk, "endpoint_pk": self.endpoint.pk}]
+            * 5,
+        }
+        self.client.post(url, data, content_type="application/json")
+        self.assertQueries(
+            0, "post", url, data=data, content_type="application/json"
+        )
+
+    def test_use_api_async(self):
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        data = f"token={self.app.token}"
+        post = async_to_sync(client.post)
+        post(url, data, content_type="application/x-www-form-urlencoded")
+        with self.assertNumQueries(0):
+            response = post(
+                url, data, content_type="application/x-www-form-urlencoded"
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+
+    @override_settings(
+        QUERY_BUDGET={"ENABLED": True, "RAISE": True, "HEADERS": True}
+    )
+    def test_async_requests_are_counted(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(
+            iscoroutinefunction(middleware.QueryBudgetMiddleware(get_response))
+        )
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        post = async_to_sync(client.post)
+        # Cold caches, the queries run on the sync thread of the request
+        with CaptureQueriesContext(connection) as queries:
+            response = post(
+                url,
+                f"token={self.app.token}",
+                content_type="application/x-www-form-urlencoded",
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(response["X-DB-Queries"], str(len(queries)))
+
+    def test_search(self):
+        self.client.logout()
+        url = reverse("search-list")
+        self.assertQueries(4, "get", url, data={"search": "weath"})
+        self.assertQueries(0, "get", url, data={"search": "weath"})
+        self.assertQueries(3, "get", url, data={"category": 1})
+
+
+class ProxyTestCase(SharedStateTestCase):
+    """One API with one endpoint on a local upstream, owner logged in."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = ThreadingHTTPServer(("127.0.0.1", 0), _Upstream)
+        threading.Thread(
+            target=cls.upstream.serve_forever, daemon=True
+        ).start()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.upstream.shutdown()
+        cls.upstream.server_close()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+        cls.app = Application.objects.get(owner=cls.user)
+        cls.api = API.objects.create(
+            parent=cls.app,
+            owner=cls.user,
+            category=Category.objects.create(name="weather"),
+            name="weather api",
+            short_description="Forecasts",
+            base_url=f"http://127.0.0.1:{cls.upstream.server_port}",
+        )
+        cls.endpoint = Endpoint.objects.create(url="/today", name="today")
+        cls.api.endpoints.add(cls.endpoint)
+
+    def setUp(self):
+        super().setUp()
+        routing.routes.clear()
+        catalog.clear()
+        cache.tokens.clear()
+        self.client.force_login(self.user)
+        self.url = reverse("use-api", args=[self.api.pk, self.endpoint.pk])
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def post(self):
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+
+class RequestTimingTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = {
+            "HEADER": True,
+            "PROFILE": False,
+            "PROFILE_EVERY": 2,
+            "PROFILE_SLOW_MS": None,
+            "PROFILE_DIRECTORY": self.directory.name,
+            "PROFILE_KEEP": 2,
+        }
+
+    def test_server_timing_phases(self):
+        with override_settings(REQUEST_TIMING=self.config):
+            response = self.post()
+        phases = [
+            metric.split(";")[0]
+            for metric in response["Server-Timing"].split(", ")
+        ]
+        for name in (
+            "auth",
+            "resolve",
+            "upstream",
+            "decode",
+            "quota",
+            "render",
+            "db",
+            "total",
+        ):
+            self.assertIn(name, phases)
+
+    def test_no_header_when_disabled(self):
+        self.config["HEADER"] = False
+        with override_settings(REQUEST_TIMING=self.config):
+            response = self.post()
+        self.assertNotIn("Server-Timing", response)
+
+    def test_async_server_timing(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(
+            iscoroutinefunction(
+                middleware.RequestTimingMiddleware(get_response)
+            )
+        )
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        with override_settings(REQUEST_TIMING=self.config):
+            response = async_to_sync(client.post)(
+                url,
+                f"token={self.app.token}",
+                content_type="application/x-www-form-urlencoded",
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        phases = [
+            metric.split(";")[0]
+            for metric in response["Server-Timing"].split(", ")
+        ]
+        # Timed on the sync thread and in the event loop
+        for name in ("auth", "resolve", "upstream", "db", "total"):
+            self.assertIn(name, phases)
+
+    def test_profiles_every_nth_request_and_rotates(self):
+        self.config.update(HEADER=False, PROFILE=True)
+        with override_settings(REQUEST_TIMING=self.config):
+            for _ in range(8):
+                self.post()
+        dumps = os.listdir(self.directory.name)
+        self.assertEqual(len(dumps), 2)
+        self.assertTrue(all(name.endswith(".prof") for name in dumps))
+
+    def test_profiles_slow_requests(self):
+        self.config.update(PROFILE=True, PROFILE_EVERY=0, PROFILE_SLOW_MS=0)
+        with override_settings(REQUEST_TIMING=self.config):
+            self.post()
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pools = pool.ConnectionPools()
+        self.addCleanup(self.pools.close)
+
+    def test_one_session_per_host(self):
+        session = self.pools.session("http://Example.com/a")
+        self.assertIs(self.pools.session("http://example.com/b?c=1"), session)
+        self.assertIsNot(self.pools.session("https://example.com/"), session)
+        self.assertIsNot(self.pools.session("http://example.com:81/"), session)
+        adapter = session.get_adapter("http://example.com/")
+        self.assertEqual(
+            adapter._pool_maxsize, settings.PROXY_POOL["MAX_CONNECTIONS"]
+        )
+        self.pools.close()
+        self.assertIsNot(self.pools.session("http://example.com/"), session)
+
+    def test_one_async_client_per_loop_and_host(self):
+        async def clients():
+            client = self.pools.async_client("http://example.com/a")
+            same = self.pools.async_client("http://EXAMPLE.com/b")
+            other = self.pools.async_client("http://example.org/")
+            await self.pools.aclose()
+            self.assertTrue(client.is_closed)
+            return client, same, other
+
+        client, same, other = asyncio.run(clients())
+        self.assertIs(same, client)
+        self.assertIsNot(other, client)
+        # A client is bound to the loop it was opened on
+        self.assertIsNot(asyncio.run(clients())[0], client)
+
+    def test_closed_clients_are_replaced(self):
+        async def replaced():
+            client = self.pools.async_client("http://example.com/")
+            await client.aclose()
+            fresh = self.pools.async_client("http://example.com/")
+            await self.pools.aclose()
+            return fresh is not client
+
+        self.assertTrue(asyncio.run(replaced()))
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_evicts_the_least_recently_used(self):
+        lru = cache.LRUCache(2, 60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.set("c", 3)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual((lru.get("a"), lru.get("c")), (1, 3))
+        self.assertEqual(
+            lru.stats(),
+            {"hits": 3, "misses": 1, "entries": 2, "max_entries": 2},
+        )
+
+    def test_evicts_over_max_bytes(self):
+        lru = cache.LRUCache(10, 60, max_bytes=5, sizeof=len)
+        lru.set("a", "abc")
+        lru.set("b", "de")
+        lru.set("c", "f")
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.bytes, 3)
+        # Values over the whole budget are not cached
+        lru.set("d", "abcdef")
+        self.assertIsNone(lru.get("d"))
+        self.assertEqual(len(lru), 2)
+
+    def test_ttl(self):
+        lru = cache.LRUCache(10, 60)
+        now = time.monotonic()
+        lru.set("default", 1)
+        lru.set("short", 2, ttl=1)
+        with mock.patch.object(cache.time, "monotonic", return_value=now + 2):
+            self.assertIsNone(lru.get("short"))
+            self.assertEqual(lru.get("default"), 1)
+        with mock.patch.object(cache.time, "monotonic", return_value=now + 61):
+            self.assertIsNone(lru.get("default"))
+        self.assertEqual(len(lru), 0)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flights = singleflight.SingleFlight()
+        self.calls = 0
+
+    def test_threads_share_one_call(self):
+        release = threading.Event()
+        results = []
+
+        def fetch():
+            self.calls += 1
+            release.wait(5)
+            return "response"
+
+        def call():
+            results.append(self.flights.do("key", fetch))
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        threads[0].start()
+        while not self.flights._flights:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while self.flights.followers < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ["response"] * 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.stats(), {"leaders": 1, "followers": 3})
+
+    def test_threads_share_errors(self):
+        release = threading.Event()
+        errors = []
+
+        def fetch():
+            release.wait(5)
+            raise ValueError("upstream")
+
+        def call():
+            try:
+                self.flights.do("key", fetch)
+            except ValueError as exc:
+                errors.append(exc)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        while not self.flights._flights:
+            time.sleep(0.001)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while not self.flights.followers:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    async def fetch(self, release):
+        self.calls += 1
+        await release.wait()
+        return "response"
+
+    def test_coroutines_share_one_call(self):
+        async def main():
+            release = asyncio.Event()
+            calls = [
+                asyncio.create_task(
+                    self.flights.ado("key", lambda: self.fetch(release))
+                )
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            return await asyncio.gather(*calls)
+
+        self.assertEqual(asyncio.run(main()), ["response"] * 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.stats(), {"leaders": 1, "followers": 2})
+        self.assertEqual(self.flights._tasks, {})
+
+    def test_leader_cancellation_spares_followers(self):
+        async def main():
+            release = asyncio.Event()
+            leader, follower = (
+                asyncio.create_task(
+                    self.flights.ado("key", lambda: self.fetch(release))
+                )
+                for _ in range(2)
+            )
+            await asyncio.sleep(0)
+            leader.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        self.assertEqual(asyncio.run(main()), "response")
+        self.assertEqual(self.calls, 1)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        conf = dict(
+            settings.PROXY_CIRCUIT_BREAKER,
+            WINDOW=4,
+            MIN_CALLS=4,
+            HALF_OPEN_CALLS=2,
+        )
+        override = override_settings(PROXY_CIRCUIT_BREAKER=conf)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.now = 1000.0
+        _patch(self, breaker.time, "monotonic", lambda: self.now)
+        self.breaker = breaker.CircuitBreaker("upstream:80")
+
+    def calls(self, *outcomes, elapsed=0.1):
+        for ok in outcomes:
+            self.breaker.before_call()
+            self.breaker.record(ok, elapsed)
+
+    def open(self):
+        self.calls(True, False, True, False)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_failures_open_it(self):
+        self.calls(False, False, False)
+        # Not before MIN_CALLS
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.calls(True)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.now += 10
+        with self.assertRaises(breaker.UpstreamUnavailable) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.wait, 21)
+        self.assertEqual(self.breaker.snapshot()["retry_after"], 21)
+
+    def test_slow_calls_open_it(self):
+        self.calls(True, True, True, elapsed=1)
+        self.calls(True, elapsed=5)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.calls(True, True, True, elapsed=5)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_probes_close_it(self):
+        self.open()
+        self.now += 30
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.before_call()
+        # Only HALF_OPEN_CALLS probes at a time
+        with self.assertRaises(breaker.UpstreamUnavailable) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.wait, 1)
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertEqual(self.breaker.snapshot()["calls"], 0)
+
+    def test_failed_probe_reopens_it(self):
+        self.open()
+        self.now += 30
+        self.calls(False)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.now += 29
+        with self.assertRaises(breaker.UpstreamUnavailable):
+            self.breaker.before_call()
+        self.now += 1
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+
+    def test_one_breaker_per_host(self):
+        registry = breaker.BreakerRegistry()
+        self.assertIs(
+            registry.get("http://upstream/a"),
+            registry.get("http://upstream/b?c=d"),
+        )
+        self.assertIsNot(
+            registry.get("http://upstream/a"), registry.get("http://other/a")
+        )
+
+
+class ResilienceTests(SimpleTestCase):
+    def setUp(self):
+        conf = dict(settings.PROXY_RETRY, DEADLINE=5.0, HEDGE_DELAY=0.05)
+        override = override_settings(PROXY_RETRY=conf)
+        override.enable()
+        self.addCleanup(override.disable)
+        _patch(self, resilience, "backoff", lambda retry: 0)
+        _patch(
+            self,
+            resilience,
+            "latencies",
+            resilience.LatencyTracker(conf["HEDGE_SAMPLES"]),
+        )
+        self.call = _route(1, 1)._replace(
+            method="GET", max_retries=2, hedged=False
+        )
+        self.ok = gateway.UpstreamResult(200, "application/json", b"{}")
+        self.attempts = []
+
+    def attempt(self, *outcomes):
+        outcomes = list(outcomes)
+
+        def attempt(call, deadline):
+            self.attempts.append((threading.current_thread(), deadline))
+            outcome = outcomes.pop(0)
+            if callable(outcome):
+                outcome = outcome()
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return attempt
+
+    def test_retries(self):
+        busy = self.ok._replace(status=503)
+        failed = resilience.UpstreamFailed()
+        attempt = self.attempt(failed, busy, self.ok)
+        self.assertEqual(resilience.run(self.call, attempt), self.ok)
+        self.assertEqual(len(self.attempts), 3)
+        attempt = self.attempt(failed, failed, failed)
+        with self.assertRaises(resilience.UpstreamFailed):
+            resilience.run(self.call, attempt)
+        # Only idempotent methods are retried
+        self.attempts.clear()
+        post = self.call._replace(method="POST")
+        with self.assertRaises(resilience.UpstreamFailed):
+            resilience.run(post, self.attempt(failed, self.ok))
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_deadline(self):
+        call = self.call._replace(connect_timeout=10, read_timeout=10)
+        connect, read = resilience.Deadline(1).timeout(call)
+        self.assertLessEqual(max(connect, read), 1)
+        with self.assertRaises(resilience.UpstreamFailed):
+            resilience.Deadline(0).timeout(call)
+        # No retry once the pause would run past the deadline
+        _patch(self, resilience, "backoff", lambda retry: 10)
+        with self.assertRaises(resilience.UpstreamFailed):
+            resilience.run(
+                call, self.attempt(resilience.UpstreamFailed(), self.ok)
+            )
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_sync_calls_do_not_hedge(self):
+        call = self.call._replace(hedged=True, max_retries=0)
+        slow = self.ok._replace(content=b"slow")
+
+        def slow_answer():
+            time.sleep(0.1)
+            return slow
+
+        self.assertEqual(resilience.run(call, self.attempt(slow_answer)), slow)
+        self.assertEqual(
+            [thread for thread, _ in self.attempts],
+            [threading.current_thread()],
+        )
+
+    def test_async_hedge_first_success_wins(self):
+        call = self.call._replace(hedged=True, max_retries=0)
+        slow = self.ok._replace(content=b"slow")
+        outcomes = [(5, slow), (0, self.ok)]
+
+        async def attempt(call, deadline):
+            delay, result = outcomes.pop(0)
+            await asyncio.sleep(delay)
+            return result
+
+        started = time.monotonic()
+        self.assertEqual(asyncio.run(resilience.arun(call, attempt)), self.ok)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+def _route(api_pk, endpoint_pk, url="/"):
+    return routing.CallRecord._make(
+        (api_pk, endpoint_pk) + (None,) * 12
+    )._replace(url=url)
+
+
+class RoutingTableTests(SimpleTestCase):
+    def setUp(self):
+        self.table = routing.RoutingTable(60)
+        self.loaded = [_route(1, 1), _route(1, 2)]
+        self.patched = []
+        _patch(self, routing, "load_routes", self.load_routes)
+
+    def load_routes(self, **filters):
+        return list(self.patched if filters else self.loaded)
+
+    def test_patches_in_place(self):
+        self.assertEqual(self.table.get(1, 1), _route(1, 1))
+        routes = self.table._routes
+        self.patched = [_route(1, 1, "/new")]
+        self.table.reload_api(1)
+        self.assertIs(self.table._routes, routes)
+        self.assertEqual(self.table.get(1, 1).url, "/new")
+        self.assertIsNone(self.table.get(1, 2))
+        self.table.drop_endpoint(1)
+        self.assertEqual(routes, {})
+
+    def test_rebuilds_in_the_background(self):
+        self.table.get(1, 1)
+        self.table.refresh_interval = -1
+        loading, release = threading.Event(), threading.Event()
+
+        def load_routes(**filters):
+            if filters:
+                return list(self.patched)
+            loading.set()
+            release.wait(5)
+            return [_route(1, 1, "/reloaded")]
+
+        threads = []
+        start = threading.Thread
+
+        def thread(*args, **kwargs):
+            threads.append(start(*args, **kwargs))
+            return threads[-1]
+
+        _patch(self, routing, "load_routes", load_routes)
+        _patch(self, routing.threading, "Thread", thread)
+        # The expired table keeps answering while the reload runs
+        self.assertEqual(self.table.get(1, 1).url, "/")
+        self.assertTrue(loading.wait(5))
+        self.assertEqual(self.table.get(1, 2), _route(1, 2))
+        self.assertEqual(len(threads), 1)
+        # A patch made meanwhile survives the new table
+        self.patched = [_route(2, 1)]
+        self.table.reload_api(2)
+        self.assertEqual(self.table.get(2, 1), _route(2, 1))
+        self.table.refresh_interval = 60
+        release.set()
+        threads[0].join(5)
+        self.assertEqual(self.table.get(1, 1).url, "/reloaded")
+        self.assertIsNone(self.table.get(1, 2))
+        self.assertEqual(self.table.get(2, 1), _route(2, 1))
+
+
+class CatalogSearchTests(SharedStateTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+        app = Application.objects.get(owner=cls.user)
+        category = Category.objects.create(name="data")
+
+        def api(name, short, long=None):
+            return API.objects.create(
+                parent=app,
+                owner=cls.user,
+                category=category,
+                name=name,
+                short_description=short,
+                long_description=long,
+                base_url="http://127.0.0.1:9",
+            )
+
+        cls.forecast = api("weather forecast", "Forecasts")
+        cls.climate = api("climate", "Records", "Past weather records")
+        cls.wind = api("wind", "We measure gusts", "Weatherproof")
+
+    def setUp(self):
+        super().setUp()
+        catalog.clear()
+        pages.pages.clear()
+
+    def pks(self, query):
+        hits, _ = catalog.search(query)
+        return [hit.pk for hit in hits]
+
+    def test_rebuilds_in_the_background(self):
+        self.assertEqual(self.pks("wind"), [self.wind.pk])
+        _patch(self, catalog, "refresh_interval", -1)
+        thread = _patch(self, catalog_search.threading, "Thread", mock.Mock())
+        # The expired index keeps answering, one reload is started
+        with self.assertNumQueries(0):
+            self.assertEqual(self.pks("wind"), [self.wind.pk])
+            self.assertEqual(self.pks("climate"), [self.climate.pk])
+        thread.assert_called_once()
+        self.assertEqual(thread.call_args.kwargs["target"], catalog._refresh)
+
+        load_documents = catalog_search.load_documents
+
+        def loading(**filters):
+            documents = list(load_documents(**filters))
+            if not filters:
+                # Removed while the reload reads the table
+                catalog.remove(self.wind.pk)
+            return documents
+
+        _patch(self, catalog_search, "load_documents", loading)
+        # What the thread runs, on this connection to see the test's rows
+        catalog.rebuild()
+        self.assertEqual(self.pks("wind"), [])
+        self.assertEqual(self.pks("climate"), [self.climate.pk])
+
+    def test_ranking(self):
+        # A name match outweighs descriptions
+        self.assertEqual(self.pks("weather forecasts"), [self.forecast.pk])
+        hits, truncated = catalog.search("weather")
+        self.assertEqual(hits[0].pk, self.forecast.pk)
+        self.assertGreater(hits[0].score, hits[1].score)
+        self.assertEqual(len(hits), 3)
+        self.assertFalse(truncated)
+
+    def test_prefix_matching(self):
+        self.assertEqual(
+            set(self.pks("weath")),
+            {self.forecast.pk, self.climate.pk, self.wind.pk},
+        )
+        self.assertEqual(self.pks("weath forec"), [self.forecast.pk])
+        # Below MIN_PREFIX_LENGTH a word only matches itself
+        self.assertEqual(self.pks("we"), [self.wind.pk])
+        self.assertEqual(self.pks("fo"), [])
+
+    def test_highlight(self):
+        self.assertEqual(
+            highlight("We <3 weatherproof", "weath"),
+            "We &lt;3 <mark>weatherproof</mark>",
+        )
+        self.assertEqual(
+            highlight("We <3 weatherproof", "we"),
+            "<mark>We</mark> &lt;3 weatherproof",
+        )
+        self.assertEqual(highlight("Weather", "other"), "Weather")
+
+    def test_truncated_results(self):
+        url = reverse("search-list")
+        conf = dict(settings.CATALOG_SEARCH, MAX_RESULTS=2)
+        with override_settings(CATALOG_SEARCH=conf):
+            hits, truncated = catalog.search("weath")
+            body = self.client.get(
+                url, {"search": "weath", "cursor": "", "count": "exact"}
+            ).json()
+        self.assertEqual(len(hits), 2)
+        self.assertTrue(truncated)
+        self.assertEqual((body["count"], body["count_is_exact"]), (2, False))
+        pages.pages.clear()
+        body = self.client.get(
+            url, {"search": "weath", "cursor": "", "count": "exact"}
+        ).json()
+        self.assertEqual((body["count"], body["count_is_exact"]), (3, True))
+
+    def test_patches_leave_snapshots_alone(self):
+        self.assertEqual(self.pks("storm"), [])
+        before = catalog._index
+        pk = self.wind.pk
+        self.wind.name = "storm"
+        self.wind.save()
+        self.assertEqual(self.pks("storm"), [pk])
+        self.assertIsNot(catalog._index, before)
+        self.assertEqual(before.search("storm", 10, 10).hits, [])
+        self.assertEqual(before.search("wind", 10, 10).hits[0].pk, pk)
+        self.wind.delete()
+        self.assertEqual(self.pks("storm"), [])
+        self.assertEqual(before.search("wind", 10, 10).hits[0].pk, pk)
+
+
+class FastSerializerTests(SharedStateTestCase):
+    """The list fast paths answer what the DRF serializers would."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+        cls.app = Application.objects.get(owner=cls.user)
+        cls.app.image = "applications/2022/01/01/logo.png"
+        cls.app.ip = "10.0.0.1"
+        cls.app.save()
+        Application.objects.create(
+            owner=cls.user, name="second", description="Plain"
+        )
+        category = Category.objects.create(name="data")
+        endpoints = [
+            Endpoint.objects.create(
+                url=f"/{i}", name=f"endpoint {i}", method=method
+            )
+            for i, method in enumerate((2, 1, 5))
+        ]
+        for i in range(3):
+            api = API.objects.create(
+                parent=cls.app,
+                owner=cls.user,
+                category=category,
+                name=f"weather {i}",
+                short_description="Forecasts",
+                base_url="http://127.0.0.1:9",
+                image="api/2022/01/01/logo.png" if i else None,
+                is_public=bool(i % 2),
+            )
+            api.endpoints.add(*endpoints[:i])
+
+    def setUp(self):
+        super().setUp()
+        catalog.clear()
+        pages.pages.clear()
+        self.client.force_login(self.user)
+
+    def results(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        return body["results"] if isinstance(body, dict) else body
+
+    def assertSerialized(self, results, serializer, queryset, key):
+        expected = json.loads(json.dumps(serializer(queryset, many=True).data))
+        self.assertEqual(len(results), len(expected))
+        self.assertEqual(sorted(results, key=key), sorted(expected, key=key))
+
+    def test_application_list(self):
+        self.assertSerialized(
+            self.results(reverse("app-list")),
+            api_serializers.ApplicationSerializer,
+            Application.objects.filter(owner=self.user),
+            lambda app: app["token"],
+        )
+
+    def test_api_list(self):
+        for params in ({}, {"cursor": ""}):
+            self.assertSerialized(
+                self.results(
+                    reverse("api-list", args=[self.app.pk]), **params
+                ),
+                api_serializers.APIListSerializer,
+                self.app.apis.all(),
+                lambda api: api["id"],
+            )
+
+    def test_search_list(self):
+        self.assertSerialized(
+            self.results(reverse("search-list")),
+            api_serializers.APIListSerializer,
+            API.objects.all(),
+            lambda api: api["id"],
+        )
+        ranked = self.results(reverse("search-list"), search="weather")
+        for api in ranked:
+            del api["score"], api["highlight"]
+        self.assertSerialized(
+            ranked,
+            api_serializers.APIListSerializer,
+            API.objects.all(),
+            lambda api: api["id"],
+        )
+
+
+class CatalogPageTests(SharedStateTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+        cls.category = Category.objects.create(name="data")
+        cls.api = API.objects.create(
+            parent=Application.objects.get(owner=cls.user),
+            owner=cls.user,
+            category=cls.category,
+            name="weather",
+            short_description="Forecasts",
+            base_url="http://127.0.0.1:9",
+            is_public=True,
+        )
+        cls.endpoint = Endpoint.objects.create(url="/today", name="today")
+
+    def setUp(self):
+        super().setUp()
+        catalog.clear()
+        pages.pages.clear()
+        self.url = reverse("search-list")
+
+    def get(self, **headers):
+        return self.client.get(self.url, {"search": "weather"}, **headers)
+
+    def test_etag_and_not_modified(self):
+        miss = self.get()
+        self.assertEqual(miss["X-Cache"], "MISS")
+        with self.assertNumQueries(0):
+            hit = self.get()
+        self.assertEqual(hit["X-Cache"], "HIT")
+        self.assertEqual(hit["ETag"], miss["ETag"])
+        self.assertEqual(hit.content, miss.content)
+        response = self.get(HTTP_IF_NONE_MATCH=miss["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        response = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_changes_bump_the_version(self):
+        changes = (
+            lambda: self.api.save(),
+            lambda: self.endpoint.save(),
+            lambda: self.category.save(),
+            lambda: self.api.endpoints.add(self.endpoint),
+            lambda: API.objects.bulk_update([self.api], ["name"]),
+            lambda: self.user.save(update_fields=["email"]),
+        )
+        for change in changes:
+            self.get()
+            version = pages.version.value
+            change()
+            self.assertGreater(pages.version.value, version)
+            self.assertEqual(self.get()["X-Cache"], "MISS")
+
+    def test_logins_keep_the_version(self):
+        self.get()
+        version = pages.version.value
+        self.client.force_login(self.user)
+        self.assertEqual(pages.version.value, version)
+        self.assertEqual(self.get()["X-Cache"], "HIT")
+
+
+class MetricsRegistryTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(
+            METRICS={
+                "ENABLED": True,
+                "DIRECTORY": self.directory,
+                "FLUSH_INTERVAL": 5.0,
+                "ALLOWED_IPS": ["127.0.0.1"],
+            }
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.registry = metrics.Registry()
+        self.calls = self.registry.counter("calls_total", "Calls.", ("api",))
+        self.busy = self.registry.gauge("busy", "Busy.")
+        self.latency = self.registry.histogram(
+            "latency_seconds", "Latency.", ("api",), (0.1, 1.0)
+        )
+
+    def write_exited(self, pid=2**22 + 1):
+        # Far above any pid_max, so never a live process
+        path = os.path.join(self.directory, f"{pid}.json")
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "pid": pid,
+                    "metrics": {
+                        "calls_total": [[["1"], [5.0]]],
+                        "busy": [[[], [3.0]]],
+                    },
+                },
+                file,
+            )
+        return path
+
+    def test_render(self):
+        self.calls.inc(1)
+        self.calls.inc(1, amount=2)
+        self.busy.inc()
+        for value in (0.05, 0.5, 5):
+            self.latency.observe(value, 1)
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP calls_total Calls.\n"
+            "# TYPE calls_total counter\n"
+            'calls_total{api="1"} 3\n'
+            "# HELP busy Busy.\n"
+            "# TYPE busy gauge\n"
+            "busy 1\n"
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{api="1",le="0.1"} 1\n'
+            'latency_seconds_bucket{api="1",le="1.0"} 2\n'
+            'latency_seconds_bucket{api="1",le="+Inf"} 3\n'
+            'latency_seconds_sum{api="1"} 5.55\n'
+            'latency_seconds_count{api="1"} 3\n',
+        )
+
+    def test_exited_processes_are_archived(self):
+        self.calls.inc(1)
+        self.busy.inc()
+        path = self.write_exited()
+        totals = self.registry.collect()
+        self.assertEqual(totals["calls_total"], {("1",): [6.0]})
+        # Gauges of exited processes are dropped
+        self.assertEqual(totals["busy"], {(): [1.0]})
+        self.assertFalse(os.path.exists(path))
+
+        self.write_exited()
+        totals = self.registry.collect()
+        self.assertEqual(totals["calls_total"], {("1",): [11.0]})
+
+
+class MetricsTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(
+            METRICS={
+                "ENABLED": True,
+                "DIRECTORY": self.directory.name,
+                "FLUSH_INTERVAL": 5.0,
+                "ALLOWED_IPS": ["127.0.0.1"],
+            }
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        for metric in metrics.registry.metrics.values():
+            metric.reset()
+
+    def test_proxy_metrics(self):
+        self.post()
+        self.client.get(reverse("app-list"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        api, endpoint = self.api.pk, self.endpoint.pk
+        for line in (
+            f'rapid_proxy_requests_total{{api="{api}",'
+            f'endpoint="{endpoint}",status="200"}} 1',
+            f'rapid_upstream_responses_total{{api="{api}",'
+            f'endpoint="{endpoint}",status="200"}} 1',
+            f'rapid_upstream_duration_seconds_count{{api="{api}",'
+            f'endpoint="{endpoint}"}} 1',
+            'rapid_http_requests_total{route="app-list",method="GET",'
+            'status="200"} 1',
+            "rapid_proxy_in_flight 0",
+            'rapid_lookup_cache_total{cache="tokens",result="miss"} 1',
+        ):
+            self.assertIn(line, body)
+
+    def test_lookup_cache_metrics(self):
+        self.post()
+        self.post()
+        body = self.client.get(reverse("metrics")).content.decode()
+        for line in (
+            'rapid_lookup_cache_total{cache="tokens",result="miss"} 1',
+            'rapid_lookup_cache_total{cache="tokens",result="hit"} 1',
+        ):
+            self.assertIn(line, body)
+
+    def test_async_proxy_metrics(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(
+            iscoroutinefunction(middleware.MetricsMiddleware(get_response))
+        )
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        response = async_to_sync(client.post)(
+            url,
+            f"token={self.app.token}",
+            content_type="application/x-www-form-urlencoded",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        body = self.client.get(reverse("metrics")).content.decode()
+        api, endpoint = self.api.pk, self.endpoint.pk
+        for line in (
+            f'rapid_proxy_requests_total{{api="{api}",'
+            f'endpoint="{endpoint}",status="200"}} 1',
+            'rapid_http_requests_total{route="use-api-async",method="POST",'
+            'status="200"} 1',
+            "rapid_proxy_in_flight 0",
+        ):
+            self.assertIn(line, body)
+
+    def test_unresolved_calls_share_one_series(self):
+        anonymous = Client()
+        for pk in range(100, 105):
+            url = reverse("use-api", args=[pk, pk])
+            self.assertEqual(anonymous.post(url).status_code, 401)
+        self.client.post(
+            reverse("use-api-batch"),
+            {
+                "token": self.app.token,
+                "calls": [{"api_pk": 100, "endpoint_pk": 100}],
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(
+            metrics.proxy_requests.snapshot(),
+            [
+                [["unresolved", "unresolved", "401"], [5.0]],
+                [["unresolved", "unresolved", "404"], [1.0]],
+            ],
+        )
+
+    def test_hidden_from_other_addresses(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 404)
+
+
+class RateLimitTests(ProxyTestCase):
+    def test_application_limit(self):
+        self.app.rate_limit = 2
+        self.app.rate_period = 60
+        self.app.save()
+        first = self.post()
+        self.assertEqual(first["X-RateLimit-Limit"], "2")
+        self.assertEqual(first["X-RateLimit-Remaining"], "1")
+        self.assertEqual(first["X-RateLimit-Reset"], "30")
+        self.post()
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertEqual(response["X-RateLimit-Remaining"], "0")
+
+    def test_api_limit_async(self):
+        self.api.rate_limit = 1
+        self.api.rate_burst = 1
+        self.api.save()
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        post = async_to_sync(client.post)
+        data = f"token={self.app.token}"
+        content_type = "application/x-www-form-urlencoded"
+        self.assertEqual(
+            post(url, data, content_type=content_type).status_code, 200
+        )
+        response = post(url, data, content_type=content_type)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(response["X-RateLimit-Limit"], "1")
+
+    def test_batch_calls_count_separately(self):
+        self.api.rate_limit = 2
+        self.api.rate_period = 60
+        self.api.save()
+        response = self.client.post(
+            reverse("use-api-batch"),
+            {
+                "token": self.app.token,
+                "calls": [
+                    {"api_pk": self.api.pk, "endpoint_pk": self.endpoint.pk}
+                ]
+                * 3,
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(
+            [item["status"] for item in response.json()["results"]],
+            [200, 200, 429],
+        )
+
+    def test_unlimited_skips_the_segment(self):
+        response = self.post()
+        self.assertNotIn("X-RateLimit-Limit", response)
+        self.assertIsNone(ratelimit.limiter._segment)
+
+    def test_buckets_refill(self):
+        limit = (ratelimit.API, 1, 10, 10.0, 10)
+        with mock.patch.object(ratelimit.time, "time", return_value=100):
+            segment = ratelimit.limiter.segment
+            for _ in range(10):
+                segment.take([limit])
+            with self.assertRaises(ratelimit.RateLimited) as raised:
+                segment.take([limit])
+        self.assertAlmostEqual(raised.exception.wait, 0.1)
+        with mock.patch.object(ratelimit.time, "time", return_value=100.5):
+            self.assertEqual(segment.take([limit]).remaining, 4)
+
+    def test_stamps_from_the_future(self):
+        limit = (ratelimit.API, 1, 10, 10.0, 10)
+        segment = ratelimit.limiter.segment
+        segment.take([limit])
+        # An empty bucket counted by a clock that was since stepped back
+        offset, _, _ = segment._slot(ratelimit.API, 1, 10, 0)
+        ratelimit.BUCKET.pack_into(
+            segment._map, offset, ratelimit.API, 1, 0.0, time.time() + 3600
+        )
+        self.assertEqual(segment.take([limit]).remaining, 9)
+        self.assertEqual(segment.take([limit]).remaining, 8)
+
+
+class BatchTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batch_url = reverse("use-api-batch")
+
+    def batch(self, *endpoints, **extra):
+        calls = [
+            {"api_pk": self.api.pk, "endpoint_pk": pk} for pk in endpoints
+        ]
+        return self.client.post(
+            self.batch_url,
+            {"token": self.app.token, "calls": calls, **extra},
+            content_type="application/json",
+        )
+
+    def test_results_per_call(self):
+        response = self.batch(self.endpoint.pk, 0)
+        self.assertEqual(response.status_code, 200, response.content)
+        ok, missing = response.json()["results"]
+        self.assertEqual(ok["status"], 200)
+        self.assertEqual(ok["data"], {"path": "/today"})
+        self.assertEqual(ok["endpoint_pk"], self.endpoint.pk)
+        self.assertEqual(missing, {**missing, "status": 404, "endpoint_pk": 0})
+
+    def test_quota_is_charged_once_and_refunded(self):
+        self.app.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=5)
+        self.app.save()
+        broken = Endpoint.objects.create(url="/broken", name="broken")
+        self.api.endpoints.add(broken)
+
+        def fetch(call):
+            if call.endpoint_pk == broken.pk:
+                raise resilience.UpstreamFailed()
+            return gateway.UpstreamResult(200, "application/json", b"[1]")
+
+        _patch(self, gateway, "fetch", mock.Mock(side_effect=fetch))
+        with mock.patch.object(
+            self.quotas, "charge", wraps=self.quotas.charge
+        ) as charge:
+            response = self.batch(self.endpoint.pk, broken.pk, 0)
+        charge.assert_called_once()
+        self.assertEqual(
+            [item["status"] for item in response.json()["results"]],
+            [200, 404, 404],
+        )
+        # Only the answered call is left charged, the unknown one never was
+        self.assertEqual(response["X-Quota-Remaining"], "4")
+        self.assertEqual(self.quotas.used(APPLICATION, self.app.pk, DAY), 1)
+
+    def test_concurrency_is_capped(self):
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def fetch(call):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return gateway.UpstreamResult(200, "application/json", b"[1]")
+
+        _patch(self, gateway, "fetch", fetch)
+        with override_settings(PROXY_BATCH={"MAX_CALLS": 8, "CONCURRENCY": 3}):
+            response = self.batch(*[self.endpoint.pk] * 8)
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(peak[0], 3)
+            response = self.batch(*[self.endpoint.pk] * 9)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("calls", response.json())
+
+    def test_unknown_token(self):
+        response = self.batch(self.endpoint.pk, token="unknown")
+        self.assertEqual(response.status_code, 404)
+
+
+class DeadlineTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        conf = dict(settings.PROXY_RETRY, DEADLINE=0.3)
+        override = override_settings(PROXY_RETRY=conf)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.endpoint.url = "/drip"
+        self.endpoint.save()
+
+    def test_slow_bodies_stop_at_the_deadline(self):
+        started = time.monotonic()
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], service.UPSTREAM_ERROR)
+
+    def test_async_slow_bodies_stop_at_the_deadline(self):
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        started = time.monotonic()
+        response = async_to_sync(client.post)(
+            url,
+            f"token={self.app.token}",
+            content_type="application/x-www-form-urlencoded",
+        )
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], service.UPSTREAM_ERROR)
+
+
+class StreamingTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = dict(settings.PROXY_STREAMING, ENABLED=True)
+        self.body = json.dumps({"path": "/today"}).encode()
+
+    def stream(self, url=None, **config):
+        """The response and its body, read under ``config`` as well."""
+        with override_settings(PROXY_STREAMING=dict(self.config, **config)):
+            response = self.client.post(
+                url or self.url, {"token": self.app.token}
+            )
+            return response, b"".join(response)
+
+    def astream(self, endpoint=None, **config):
+        endpoint = endpoint or self.endpoint
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        url = reverse("use-api-async", args=[self.api.pk, endpoint.pk])
+        with override_settings(PROXY_STREAMING=dict(self.config, **config)):
+            response = async_to_sync(client.post)(
+                url,
+                f"token={self.app.token}",
+                content_type="application/x-www-form-urlencoded",
+            )
+            return response, b"".join(response)
+
+    def unsized(self):
+        endpoint = Endpoint.objects.create(url="/unsized", name="unsized")
+        self.api.endpoints.add(endpoint)
+        return endpoint
+
+    def test_relays_the_body(self):
+        response, body = self.stream(CHUNK_SIZE=4)
+        self.assertTrue(response.streaming)
+        self.assertEqual(body, self.body)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(response["Content-Length"], str(len(self.body)))
+
+    def test_async_relays_the_body(self):
+        response, body = self.astream(CHUNK_SIZE=4)
+        self.assertTrue(response.streaming)
+        self.assertEqual(body, self.body)
+        self.assertEqual(response["Content-Length"], str(len(self.body)))
+
+    def test_declared_size_cap(self):
+        self.app.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=1)
+        self.app.save()
+        cap = len(self.body) - 1
+        self.assertEqual(self.stream(MAX_BODY_SIZE=cap)[0].status_code, 502)
+        self.assertEqual(self.astream(MAX_BODY_SIZE=cap)[0].status_code, 502)
+        # Refused bodies cost no quota
+        self.assertEqual(self.stream()[0].status_code, 200)
+
+    def test_actual_size_cap(self):
+        endpoint = self.unsized()
+        url = reverse("use-api", args=[self.api.pk, endpoint.pk])
+        expected = json.dumps({"path": "/unsized"}).encode()
+        response, body = self.stream(url, MAX_BODY_SIZE=8, CHUNK_SIZE=4)
+        self.assertNotIn("Content-Length", response)
+        # The headers are sent, so the body is cut short
+        self.assertEqual(body, expected[:8])
+        response, _ = self.astream(endpoint, MAX_BODY_SIZE=8, CHUNK_SIZE=4)
+        self.assertEqual(response.status_code, 502)
+        response, body = self.astream(endpoint)
+        self.assertEqual(body, expected)
+        self.assertEqual(response["Content-Length"], str(len(expected)))
+
+
+class ResponseCacheTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint.cache_ttl = 60
+        self.endpoint.save()
+        responses.responses.clear()
+        self.addCleanup(responses.responses.clear)
+        self.fetch = _patch(
+            self, gateway, "fetch", mock.Mock(wraps=gateway.fetch)
+        )
+
+    def test_hit_and_miss(self):
+        miss = self.post()
+        self.assertEqual(miss["X-Cache"], "MISS")
+        hit = self.post()
+        self.assertEqual(hit["X-Cache"], "HIT")
+        self.assertEqual(hit.json(), miss.json())
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(
+            responses.responses.endpoint_stats(self.endpoint.pk),
+            {"hits": 1, "misses": 1},
+        )
+
+    def test_uncached_endpoints(self):
+        self.endpoint.cache_ttl = 0
+        self.endpoint.save()
+        self.assertNotIn("X-Cache", self.post())
+        self.assertNotIn("X-Cache", self.post())
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_ttl_expiry(self):
+        self.post()
+        later = time.monotonic() + 61
+        with mock.patch.object(cache.time, "monotonic", return_value=later):
+            self.assertEqual(self.post()["X-Cache"], "MISS")
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_saves_invalidate(self):
+        self.post()
+        self.endpoint.description = "changed"
+        self.endpoint.save()
+        self.assertEqual(self.post()["X-Cache"], "MISS")
+        self.api.short_description = "changed"
+        self.api.save()
+        self.assertEqual(self.post()["X-Cache"], "MISS")
+        self.assertEqual(self.post()["X-Cache"], "HIT")
+        self.assertEqual(self.fetch.call_count, 3)
+
+    def test_hits_charge_quota(self):
+        self.app.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=2)
+        self.app.save()
+        self.assertEqual(self.post()["X-Quota-Remaining"], "1")
+        hit = self.post()
+        self.assertEqual(hit["X-Cache"], "HIT")
+        self.assertEqual(hit["X-Quota-Remaining"], "0")
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 406)
+
+    def test_eviction(self):
+        cached = responses.ResponseCache(2, 10, 4)
+        call = _route(1, 1)._replace(cache_ttl=60)
+        cached.store(call, 200, "text/plain", b"abcd")
+        # Too large for an entry, or not a success
+        cached.store(call._replace(endpoint_pk=2), 200, "text/plain", b"abcde")
+        cached.store(call._replace(endpoint_pk=3), 500, "text/plain", b"a")
+        self.assertEqual(len(cached), 1)
+        cached.store(call._replace(endpoint_pk=4), 200, "text/plain", b"ab")
+        cached.lookup(call)
+        cached.store(call._replace(endpoint_pk=5), 200, "text/plain", b"ab")
+        # Over max_entries and max_bytes: the least recently used goes
+        self.assertIsNotNone(cached.lookup(call))
+        self.assertIsNone(cached.lookup(call._replace(endpoint_pk=4)))
+        self.assertIsNotNone(cached.lookup(call._replace(endpoint_pk=5)))
+        self.assertEqual(cached.bytes, 6)
+
+
+class QuotaPlanTests(ProxyTestCase):
+    def test_quota_headers_and_refusal(self):
+        self.app.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=1)
+        self.app.save()
+        response = self.post()
+        self.assertEqual(response["X-Quota-Limit"], "1")
+        self.assertEqual(response["X-Quota-Remaining"], "0")
+        self.assertLessEqual(int(response["X-Quota-Reset"]), 24 * 3600)
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 406)
+
+    def test_total_has_no_reset(self):
+        self.app.plan = QuotaPlan.objects.create(name="Once", total_limit=1)
+        self.app.save()
+        response = self.post()
+        self.assertEqual(response["X-Quota-Remaining"], "0")
+        self.assertNotIn("X-Quota-Reset", response)
+
+    def test_unlimited_without_plan(self):
+        self.assertNotIn("X-Quota-Limit", self.post())
+
+    def test_deleted_accounts_leave_the_segment(self):
+        self.app.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=5)
+        self.app.save()
+        self.post()
+        pk = self.app.pk
+        self.assertEqual(self.quotas.used(APPLICATION, pk, DAY), 1)
+        self.app.delete()
+        self.assertIsNone(self.quotas.used(APPLICATION, pk, DAY))
+
+
+class TokenFilterTests(ProxyTestCase):
+    def test_sizing(self):
+        self.assertEqual(bloom.optimal_size(1000, 0.01), (9592, 7))
+
+    def test_unknown_token_skips_the_lookup(self):
+        self.post()
+        cache.tokens.clear()
+        with self.assertNumQueries(0):
+            # The session, its user and the token filter are all warm
+            response = self.client.post(self.url, {"token": "unknown"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_tokens_pass_once_committed(self):
+        self.assertTrue(self.token_filter.might_contain(self.app.token))
+        with self.captureOnCommitCallbacks() as callbacks:
+            app = Application.objects.create(owner=self.user, name="second")
+        # A rebuild before the commit would not see the row either
+        self.assertFalse(self.token_filter.might_contain(app.token))
+        for callback in callbacks:
+            callback()
+        self.assertTrue(self.token_filter.might_contain(app.token))
+        self.assertEqual(self.token_filter.stats()["tokens"], 2)
+
+    def test_rebuild_drops_deleted_tokens(self):
+        app = Application.objects.create(owner=self.user, name="second")
+        self.assertTrue(self.token_filter.might_contain(app.token))
+        app.delete()
+        self.token_filter.rebuild(force=True)
+        self.assertFalse(self.token_filter.might_contain(app.token))
+        self.assertTrue(self.token_filter.might_contain(self.app.token))
+
+    def test_stale_filter_is_rebuilt_in_the_background(self):
+        self.token_filter.might_contain(self.app.token)
+        Application.objects.filter(pk=self.app.pk).update(token="rotated")
+        self.assertFalse(self.token_filter.might_contain("rotated"))
+        self.token_filter.refresh_interval = -1
+        thread = _patch(self, bloom.threading, "Thread", mock.Mock())
+        # The stale filter keeps answering, one rebuild is started
+        with self.assertNumQueries(0):
+            self.assertFalse(self.token_filter.might_contain("rotated"))
+            self.assertTrue(self.token_filter.might_contain(self.app.token))
+        thread.assert_called_once()
+        self.assertEqual(
+            thread.call_args.kwargs["target"], self.token_filter._refresh
+        )
+        # What the thread runs, on this connection to see the test's rows
+        self.token_filter.rebuild()
+        self.assertTrue(self.token_filter.might_contain("rotated"))
+        self.assertFalse(self.token_filter.might_contain(self.app.token))
+
+    def test_tokens_added_during_a_rebuild_are_kept(self):
+        self.token_filter.might_contain(self.app.token)
+
+        def tokens():
+            # Committed after the rebuild read the table
+            self.token_filter.add("late")
+            yield self.app.token
+
+        model = mock.Mock()
+        model.objects.exclude().values_list().iterator = tokens
+        _patch(
+            self, bloom, "apps", mock.Mock(**{"get_model.return_value": model})
+        )
+        self.token_filter.rebuild(force=True)
+        self.assertTrue(self.token_filter.might_contain("late"))
+        self.assertTrue(self.token_filter.might_contain(self.app.token))
+
+    def test_false_positive_rate(self):
+        Application.objects.bulk_create(
+            Application(owner=self.user, name=f"app-{i}", token=f"token-{i}")
+            for i in range(999)
+        )
+        passed = sum(
+            self.token_filter.might_contain(f"unknown-{i}")
+            for i in range(10000)
+        )
+        stats = self.token_filter.stats()
+        self.assertEqual(stats["tokens"], 1000)
+        self.assertAlmostEqual(stats["false_positive_rate"], 0.01, delta=0.002)
+        self.assertLess(passed / 10000, 0.02)
+
+
+class LoadtestDatabaseTests(SimpleTestCase):
+    def test_default_database(self):
+        for engine, name, expected in (
+            ("sqlite3", "/srv/db.sqlite3", "/srv/db-loadtest.sqlite3"),
+            ("postgresql", "gw", "gw_loadtest"),
+        ):
+            databases = {
+                "default": {
+                    "ENGINE": f"django.db.backends.{engine}",
+                    "NAME": name,
+                }
+            }
+            with mock.patch.object(settings, "DATABASES", databases):
+                self.assertEqual(loadtest.default_database(), expected)
+
+
+class SharedPathTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def shared_path(self, database, path):
+        with override_settings(SHARED_STATE_DIRECTORY=self.root):
+            with mock.patch.dict(
+                connections["default"].settings_dict, NAME=database
+            ):
+                return runtime.shared_path(path)
+
+    def test_namespaced_by_database(self):
+        production = self.shared_path("/srv/db.sqlite3", "tokens.bloom")
+        staging = self.shared_path("/srv/staging.sqlite3", "tokens.bloom")
+        self.assertNotEqual(production, staging)
+        self.assertEqual(
+            os.path.dirname(production),
+            os.path.dirname(self.shared_path("/srv/db.sqlite3", "quota.seg")),
+        )
+        self.assertTrue(production.startswith(self.root))
+        self.assertTrue(os.path.isdir(os.path.dirname(staging)))
+
+    def test_absolute_paths_are_kept(self):
+        path = os.path.join(self.root, "rates.seg")
+        self.assertEqual(self.shared_path("/srv/db.sqlite3", path), path)
+
+
+class HeaderAuthenticationTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.owners.clear()
+        self.client = Client(enforce_csrf_checks=True)
+        self.header = {"HTTP_AUTHORIZATION": f"Token {self.app.token}"}
+
+    def test_no_session_or_csrf(self):
+        self.assertEqual(
+            self.client.post(self.url, **self.header).status_code, 200
+        )
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, **self.header)
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_session_still_works(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_invalid_token(self):
+        for header in ("Token unknown", "Token", "Token a b"):
+            response = self.client.post(self.url, HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 401, header)
+            self.assertEqual(response["WWW-Authenticate"], "Token")
+
+    def test_inactive_owner(self):
+        self.client.post(self.url, **self.header)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.post(self.url, **self.header)
+        self.assertEqual(response.status_code, 401)
+
+    def test_owner_quota_is_charged(self):
+        self.user.plan = QuotaPlan.objects.create(name="Tiny", daily_limit=1)
+        self.user.save()
+        self.assertEqual(
+            self.client.post(self.url, **self.header).status_code, 200
+        )
+        response = self.client.post(self.url, **self.header)
+        self.assertEqual(response.status_code, 406)
+
+    def test_batch(self):
+        response = self.client.post(
+            reverse("use-api-batch"),
+            {
+                "calls": [
+                    {"api_pk": self.api.pk, "endpoint_pk": self.endpoint.pk}
+                ]
+            },
+            content_type="application/json",
+            **self.header,
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()["results"][0]["status"], 200)
+
+    def test_async(self):
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        post = async_to_sync(AsyncClient(enforce_csrf_checks=True).post)
+        # AsyncClient takes raw header names
+        header = {"authorization": f"Token {self.app.token}"}
+        self.assertEqual(post(url, **header).status_code, 200)
+        response = post(url, authorization="Token unknown")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["WWW-Authenticate"], "Token")
+
+    def test_async_session_needs_csrf(self):
+        url = reverse("use-api-async", args=[self.api.pk, self.endpoint.pk])
+        client = AsyncClient(enforce_csrf_checks=True)
+        login = Client()
+        login.force_login(self.user)
+        client.cookies = login.cookies
+        client.cookies["csrftoken"] = "a" * 32
+        post = async_to_sync(client.post)
+        data = f"token={self.app.token}"
+        form = "application/x-www-form-urlencoded"
+        response = post(url, data, content_type=form)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("CSRF", response.json()["detail"])
+        response = post(url, data, content_type=form, x_csrftoken="a" * 32)
+        self.assertEqual(response.status_code, 200, response.content)
+
+
+class SessionCacheTests(SharedStateTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            "owner@example.com", "password", is_active=True
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(email="owner@example.com", password="password")
+        self.url = reverse("app-list")
+
+    def test_warm_requests_skip_session_and_user(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        with self.assertNumQueries(2):
+            # The application count and page only
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_user_changes_are_picked_up(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_password_change_ends_sessions(self):
+        self.client.get(self.url)
+        self.user.set_password("changed")
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_logout_ends_the_cached_session(self):
+        other = Client()
+        session = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        other.cookies[settings.SESSION_COOKIE_NAME] = session
+        self.assertEqual(other.get(self.url).status_code, 200)
+        self.client.logout()
+        self.assertEqual(other.get(self.url).status_code, 403)
+
+    def test_sessions_of_either_backend_are_cached(self):
+        self.assertEqual(
+            self.client.session[BACKEND_SESSION_KEY],
+            "django.contrib.auth.backends.ModelBackend",
+        )
+        for backend in (
+            "django.contrib.auth.backends.ModelBackend",
+            "account.backends.CachedModelBackend",
+        ):
+            authcache.forget_user(self.user.pk)
+            self.client.force_login(self.user, backend)
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+            self.assertEqual(authcache.get_user(self.user.pk), self.user)
+            with self.assertNumQueries(2):
+                self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_cached_users_need_a_matching_session_hash(self):
+        self.client.get(self.url)
+        session = self.client.session
+        session[HASH_SESSION_KEY] = "forged"
+        session.save()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_wrong_passwords_are_checked_once(self):
+        with mock.patch.object(
+            User, "check_password", autospec=True, return_value=False
+        ) as check_password:
+            self.assertFalse(
+                Client().login(email="owner@example.com", password="wrong")
+            )
+        check_password.assert_called_once()
+
+
+def _openapi_document(count, **extra):
+    paths = {
+        f"/items/{i}": {
+            "get": {"operationId": f"item-{i}", "summary": f"Item {i}"},
+            "parameters": [],
+        }
+        for i in range(count)
+    }
+    return {"openapi": "3.0.0", "paths": {**paths, **extra}}
+
+
+class OpenAPIImportTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.import_url = reverse("endpoint-import", args=[self.api.pk])
+
+    def test_import_is_bulk(self):
+        document = _openapi_document(
+            200,
+            **{
+                "/today": {
+                    "get": {"operationId": "today", "description": "Now"},
+                    "head": {"operationId": "today-head"},
+                    "post": {"summary": "Submit", "description": "Posts"},
+                },
+            },
+        )
+        # User, API, its endpoints, savepoint, two endpoint inserts
+        # (SQLite batches), the update, add()'s lookup of existing links,
+        # the link insert and release
+        with self.assertNumQueries(10):
+            response = self.client.post(
+                self.import_url, document, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            response.json(), {"created": 201, "updated": 1, "skipped": 1}
+        )
+        self.assertEqual(self.api.endpoints.count(), 202)
+        submit = self.api.endpoints.get(url="/today", method=2)
+        self.assertEqual(
+            (submit.name, submit.description), ("Submit", "Posts")
+        )
+
+        response = self.client.post(
+            self.import_url, document, content_type="application/json"
+        )
+        self.assertEqual(
+            response.json(), {"created": 0, "updated": 0, "skipped": 203}
+        )
+
+    def test_imported_endpoints_are_routed(self):
+        self.post()
+        response = self.client.post(
+            self.import_url,
+            _openapi_document(1),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["created"], 1)
+        endpoint = self.api.endpoints.get(url="/items/0")
+        url = reverse("use-api", args=[self.api.pk, endpoint.pk])
+        response = self.client.post(url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_updates_reach_the_catalog(self):
+        catalog.clear()
+        self.assertEqual(catalog.search("sunrise").hits, [])
+        document = {
+            "openapi": "3.0.0",
+            "paths": {"/today": {"get": {"operationId": "sunrise"}}},
+        }
+        response = self.client.post(
+            self.import_url, document, content_type="application/json"
+        )
+        self.assertEqual(response.json()["updated"], 1)
+        hits, _ = catalog.search("sunrise")
+        self.assertEqual([hit.pk for hit in hits], [self.api.pk])
+
+    def test_yaml(self):
+        response = self.client.post(
+            self.import_url,
+            "swagger: '2.0'\n"
+            "paths:\n"
+            "  /new:\n"
+            "    delete:\n"
+            "      summary: Drop\n",
+            content_type="application/yaml",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.api.endpoints.get(url="/new").method, 4)
+
+    def test_invalid_documents(self):
+        for document in ({"openapi": "3.0.0"}, {"paths": []}):
+            response = self.client.post(
+                self.import_url, document, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400, document)
+        with override_settings(ENDPOINT_IMPORT={"MAX_ENDPOINTS": 5}):
+            response = self.client.post(
+                self.import_url,
+                _openapi_document(6),
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.api.endpoints.count(), 1)
+
+    def test_other_owner(self):
+        self.client.force_login(
+            User.objects.create_user(
+                "other@example.com", "password", is_active=True
+            )
+        )
+        response = self.client.post(
+            self.import_url,
+            _openapi_document(1),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_command_dry_run(self):
+        path = os.path.join(self.directory.name, "openapi.json")
+        with open(path, "w") as file:
+            json.dump(_openapi_document(3), file)
+        out = io.StringIO()
+        call_command(
+            "import_openapi", self.api.pk, path, "--dry-run", stdout=out
+        )
+        self.assertEqual(json.loads(out.getvalue())["created"], 3)
+        self.assertEqual(self.api.endpoints.count(), 1)
+        call_command("import_openapi", self.api.pk, path, stdout=io.StringIO())
+        self.assertEqual(self.api.endpoints.count(), 4)
+
+
+class BulkWriteTests(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app_url = reverse("app-bulk")
+        self.api_url = reverse("api-bulk", args=[self.app.pk])
+
+    def bulk(self, method, url, items, **params):
+        if params:
+            url = f"{url}?{urlencode(params)}"
+        return getattr(self.client, method)(
+            url, items, content_type="application/json"
+        )
+
+    def test_create_applications(self):
+        self.post()
+        # A savepoint, four inserts (SQLite batches) and its release
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertNumQueries(6):
+                response = self.bulk(
+                    "post",
+                    self.app_url,
+                    [{"name": f"partner-{i}"} for i in range(300)],
+                )
+        self.assertEqual(response.status_code, 201, response.content)
+        results = response.json()["results"]
+        self.assertEqual(len(results), 300)
+        tokens = {result["token"] for result in results}
+        self.assertEqual(len(tokens), 300)
+        # The tokens join the filter once the transaction commits
+        self.assertFalse(any(map(self.token_filter.might_contain, tokens)))
+        for callback in callbacks:
+            callback()
+        self.assertTrue(all(map(self.token_filter.might_contain, tokens)))
+        response = self.client.post(self.url, {"token": results[0]["token"]})
+        # A valid token, of an application that does not own the API
+        self.assertEqual(response.status_code, 404)
+
+    def test_all_or_nothing(self):
+        response = self.bulk(
+            "post", self.app_url, [{"name": "ok"}, {"name": ""}, {}]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [error["index"] for error in response.json()["errors"]], [1, 2]
+        )
+        self.assertEqual(Application.objects.filter(name="ok").count(), 0)
+
+    def test_partial(self):
+        response = self.bulk(
+            "post",
+            self.app_url,
+            [{"name": "ok"}, {"name": ""}],
+            mode="partial",
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        body = response.json()
+        self.assertEqual([app["name"] for app in body["results"]], ["ok"])
+        self.assertEqual(body["errors"][0]["index"], 1)
+        self.assertIn("name", body["errors"][0]["errors"])
+
+    def test_limits(self):
+        with override_settings(BULK_WRITE={"MAX_ITEMS": 2}):
+            response = self.bulk("post", self.app_url, [{"name": "a"}] * 3)
+        self.assertEqual(response.status_code, 400)
+        for body in ([], {"name": "a"}):
+            self.assertEqual(
+                self.bulk("post", self.app_url, body).status_code, 400
+            )
+        response = self.bulk("post", self.app_url, [{"name": "a"}], mode="x")
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_applications(self):
+        other = User.objects.create_user("other@example.com", "password")
+        foreign = Application.objects.get(owner=other)
+        response = self.bulk(
+            "patch",
+            self.app_url,
+            [
+                {"id": self.app.pk, "description": "Partner"},
+                {"id": foreign.pk, "name": "taken"},
+                {"id": self.app.pk, "name": "again"},
+            ],
+            mode="partial",
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual(
+            [(e["index"], e["errors"]) for e in body["errors"]],
+            [
+                (1, {"id": ["Not found."]}),
+                (2, {"id": ["Repeated in this request."]}),
+            ],
+        )
+        self.app.refresh_from_db()
+        self.assertEqual(self.app.description, "Partner")
+        foreign.refresh_from_db()
+        self.assertNotEqual(foreign.name, "taken")
+
+    def test_create_apis(self):
+        category = self.api.category_id
+        items = [
+            {
+                "category": category,
+                "name": f"partner api {i}",
+                "short_description": "Partner",
+                "base_url": "http://127.0.0.1:9",
+                "is_public": True,
+            }
+            for i in range(100)
+        ]
+        # User, parent, all categories at once, savepoint, two inserts
+        # (SQLite batches) and release
+        with self.assertNumQueries(7):
+            response = self.bulk("post", self.api_url, items)
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self.app.apis.count(), 101)
+        names = {
+            api["name"]
+            for api in self.client.get(
+                reverse("search-list"), {"search": "partner"}
+            ).json()
+        }
+        self.assertIn("partner api 99", names)
+
+        items[0]["category"] = 0
+        response = self.bulk("post", self.api_url, items[:2])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"][0]["index"], 0)
+
+    def test_update_apis_reroutes(self):
+        self.post()
+        response = self.bulk(
+            "patch",
+            self.api_url,
+            [{"id": self.api.pk, "rate_limit": 1, "rate_period": 60}],
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.post()
+        response = self.client.post(self.url, {"token": self.app.token})
+        self.assertEqual(response.status_code, 429)
@@ -0,0 +1,56 @@
+"""
+Per-request phase timers. ``RequestTimingMiddleware`` starts a ``Timings``
+for every request when ``REQUEST_TIMING["HEADER"]`` is set, code on the
+request path wraps its work in ``phase(name)`` and the totals end up in
+the ``Server-Timing`` header. Without a current ``Timings`` ``phase`` only
+does a context variable lookup.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("request_timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self, **extra):
+        phases = dict(self.phases, **extra)
+        phases["total"] = time.perf_counter() - self.started
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.2f}"
+            for name, seconds in phases.items()
+        )
+
+
+def start():
+    """Make a new ``Timings`` current, returns it and the reset token."""
+    timings = Timings()
+    return timings, _current.set(timings)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
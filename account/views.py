@@ -1,3 +1,20 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, HttpResponse
 
-# Create your views here.
+from account import metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics_view(request):
+    """Prometheus scrape target, hidden from everyone but ALLOWED_IPS."""
+    config = settings.METRICS
+    if (
+        not config["ENABLED"]
+        or request.META.get("REMOTE_ADDR") not in config["ALLOWED_IPS"]
+    ):
+        raise Http404()
+    return HttpResponse(metrics.registry.render(), content_type=CONTENT_TYPE)
+
+
+metrics_view.query_budget = 0
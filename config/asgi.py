@@ -3,6 +3,10 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it under an ASGI server (e.g. ``uvicorn config.asgi:application``) to
+serve ``use-api-async/`` natively: its upstream calls share one keep-alive
+httpx pool per upstream host for the lifetime of the worker's event loop.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import tempfile
 from pathlib import Path
 
 from .local_settings import *
@@ -27,11 +29,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "account.middleware.MetricsMiddleware",
+    "account.middleware.RequestTimingMiddleware",
+    "account.middleware.QueryBudgetMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "account.middleware.CachedAuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -63,6 +68,12 @@ DATABASES = {
     }
 }
 
+# manage.py loadtest seeds a database of its own and starts its servers
+# on it through this variable
+LOADTEST_DATABASE = os.environ.get("LOADTEST_DATABASE")
+if LOADTEST_DATABASE:
+    DATABASES["default"]["NAME"] = LOADTEST_DATABASE
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -95,9 +106,42 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 AUTH_USER_MODEL = "account.User"
+# Session users are resolved through authcache by
+# CachedAuthenticationMiddleware, whichever backend logged them in
+AUTHENTICATION_BACKENDS = [
+    "django.contrib.auth.backends.ModelBackend",
+    "account.backends.CachedModelBackend",
+]
 # LOGIN_URL = ""
 # LOGIN_REDIRECT_URL = ""
 
+# Files shared by the workers on a host: the token filter, the quota and
+# rate limit segments, metrics snapshots and the auth cache. Relative
+# paths below are resolved in a directory per database, see
+# account/runtime.py, so a staging database or a test run on the same
+# host never shares them with another.
+SHARED_STATE_DIRECTORY = os.path.join(tempfile.gettempdir(), "rapid-api")
+
+# Sessions and their users are written through to the database and read
+# from a file-based cache shared by the workers on the host. The key
+# prefix keeps the sessions of other databases apart.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "auth": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(SHARED_STATE_DIRECTORY, "auth"),
+        "KEY_PREFIX": hashlib.sha1(
+            str(DATABASES["default"]["NAME"]).encode()
+        ).hexdigest()[:12],
+        "TIMEOUT": 3600,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = "auth"
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.SessionAuthentication",
@@ -115,3 +159,152 @@ REST_FRAMEWORK = {
     ],
     "DATETIME_FORMAT": "%Y-%m-%d %H:%M:%S",
 }
+
+# Upstream connection pools used by the use-api proxy (sizes are per host)
+PROXY_POOL = {
+    "MAX_CONNECTIONS": 100,
+    "MAX_KEEPALIVE_CONNECTIONS": 20,
+    "KEEPALIVE_EXPIRY": 30.0,
+    "POOL_BLOCK": False,
+    "CONNECT_TIMEOUT": 5.0,
+    "READ_TIMEOUT": 30.0,
+    "POOL_TIMEOUT": 5.0,
+}
+
+# Relay upstream bodies chunk by chunk instead of parsing them as JSON
+PROXY_STREAMING = {
+    "ENABLED": False,
+    "CHUNK_SIZE": 64 * 1024,
+    "MAX_BODY_SIZE": 50 * 1024 * 1024,
+    "SPOOL_MAX_MEMORY": 1024 * 1024,
+}
+
+# Application tokens resolved by the use-api proxy
+PROXY_LOOKUP_CACHE = {
+    "MAX_ENTRIES": 10000,
+    "TTL": 300,
+}
+
+# Bloom filter of issued Application tokens, shared by the workers.
+# The default sizing takes 1.7 MiB for a million tokens at 0.1% false
+# positives, twice over as the rebuild fills a second buffer.
+PROXY_TOKEN_FILTER = {
+    "PATH": "tokens.bloom",
+    "CAPACITY": 1_000_000,
+    "ERROR_RATE": 0.001,
+    "REFRESH_INTERVAL": 300,
+}
+
+# Seconds between full reloads of the (api, endpoint) routing table
+PROXY_ROUTING = {
+    "REFRESH_INTERVAL": 60,
+}
+
+# Write-behind request quotas, see account/proxy/quota.py
+PROXY_QUOTA = {
+    "PATH": "quota.seg",
+    "SLOTS": 16384,
+    "FLUSH_INTERVAL": 5.0,
+    "FLUSH_THRESHOLD": 100,
+    "REFRESH_INTERVAL": 60.0,
+}
+
+# Token buckets of Application/API rate limits, shared by the workers
+PROXY_RATE_LIMIT = {
+    "PATH": "rates.seg",
+    "SLOTS": 16384,
+}
+
+# Responses of GET endpoints with a cache TTL, bounded per worker process
+PROXY_RESPONSE_CACHE = {
+    "MAX_ENTRIES": 1000,
+    "MAX_BYTES": 64 * 1024 * 1024,
+    "MAX_ENTRY_BYTES": 1024 * 1024,
+}
+
+# Share one upstream response between identical concurrent GET calls
+PROXY_SINGLE_FLIGHT = True
+
+# Per upstream host circuit breaker, see account/proxy/breaker.py
+PROXY_CIRCUIT_BREAKER = {
+    "WINDOW": 20,
+    "MIN_CALLS": 10,
+    "ERROR_RATE": 0.5,
+    "SLOW_CALL_SECONDS": 5.0,
+    "SLOW_CALL_RATE": 0.8,
+    "OPEN_SECONDS": 30,
+    "HALF_OPEN_CALLS": 3,
+}
+
+# Overall deadline, retries and hedging of proxied calls. Per call timeouts
+# come from Endpoint/API, falling back to PROXY_POOL. Only use-api-async
+# hedges, a sync call holds its thread until the first attempt settles.
+PROXY_RETRY = {
+    "DEADLINE": 30.0,
+    "BACKOFF_BASE": 0.1,
+    "BACKOFF_MAX": 2.0,
+    "HEDGE_DELAY": 1.0,
+    "HEDGE_SAMPLES": 100,
+    "HEDGE_MIN_SAMPLES": 20,
+}
+
+# use-api/batch: calls per request and upstream calls in flight per batch
+PROXY_BATCH = {
+    "MAX_CALLS": 50,
+    "CONCURRENCY": 8,
+}
+
+# Objects accepted per request by developer/app/bulk and .../api/bulk
+BULK_WRITE = {
+    "MAX_ITEMS": 1000,
+}
+
+# Operations accepted per OpenAPI document by developer/.../endpoints/import
+ENDPOINT_IMPORT = {
+    "MAX_ENDPOINTS": 2000,
+}
+
+# In-process full-text index behind search/
+CATALOG_SEARCH = {
+    "MAX_RESULTS": 100,
+    "MAX_PREFIX_EXPANSIONS": 50,
+    "MIN_PREFIX_LENGTH": 3,
+    "REFRESH_INTERVAL": 300,
+}
+
+# Rendered search/ pages, dropped whenever the catalog changes
+CATALOG_PAGE_CACHE = {
+    "MAX_ENTRIES": 1000,
+    "MAX_BYTES": 32 * 1024 * 1024,
+    "TTL": 60,
+}
+
+# Per-request query counting, views declare their limit as query_budget
+QUERY_BUDGET = {
+    "ENABLED": True,
+    "RAISE": False,
+    # The loadtest report reads the query counts from X-DB-Queries
+    "HEADERS": DEBUG or bool(LOADTEST_DATABASE),
+}
+
+# Phase timings in a Server-Timing header, and cProfile dumps of every
+# PROFILE_EVERY-th request and of requests slower than PROFILE_SLOW_MS
+REQUEST_TIMING = {
+    "HEADER": DEBUG,
+    "PROFILE": False,
+    "PROFILE_EVERY": 100,
+    "PROFILE_SLOW_MS": None,
+    "PROFILE_DIRECTORY": os.path.join(
+        tempfile.gettempdir(), "rapid-api-profiles"
+    ),
+    "PROFILE_KEEP": 50,
+}
+
+# Prometheus metrics served at /metrics to ALLOWED_IPS. Every worker
+# process writes a snapshot into DIRECTORY each FLUSH_INTERVAL seconds.
+METRICS = {
+    "ENABLED": True,
+    "DIRECTORY": "metrics",
+    "FLUSH_INTERVAL": 5.0,
+    "ALLOWED_IPS": ["127.0.0.1"],
+}
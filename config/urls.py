@@ -4,11 +4,14 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from account.views import metrics_view
+
 from .yasg import urlpatterns as doc_urls
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/v1/", include("account.api.urls")),
+    path("metrics", metrics_view, name="metrics"),
 ]
 
 urlpatterns += doc_urls